@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+
+# Copyright International Business Machines Corp, 2020
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import logging
+import tempfile
+import resource
+import threading
+import subprocess
+import importlib.util
+
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+
+# LSF and PPM commands replaced by stubs, which log their calls with the
+# LSF_ENVDIR of the cluster and take BENCH_STUB_SLEEP seconds. bhosts and
+# lshosts list BENCH_HOSTS hosts.
+stub_names = ['lsadmin', 'badmin', 'bhosts', 'lshosts', 'jsub', 'jrelease', 'jtrigger']
+stub_template = '''#!/bin/sh
+echo "$(date +%s) ${LSF_ENVDIR:--} $(basename "$0") $*" >> "$BENCH_CALLS"
+case "$(basename "$0")" in
+    bhosts|lshosts)
+        echo HOST_NAME
+        i=0
+        while [ $i -lt ${BENCH_HOSTS:-8} ]; do echo host$i; i=$((i + 1)); done ;;
+esac
+[ -n "$BENCH_STUB_SLEEP" ] && sleep $BENCH_STUB_SLEEP
+exit 0
+'''
+
+# Number of subprocesses started by the benchmark process
+fork_lock = threading.Lock()
+fork_count = 0
+
+
+class CountingPopen(subprocess.Popen):
+    def __init__(self, *args, **kwargs):
+        global fork_count
+        with fork_lock:
+            fork_count += 1
+        super(CountingPopen, self).__init__(*args, **kwargs)
+
+
+def load_script(path, name):
+    # the scripts are not packages, load them from their files
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def git(cwd, *args, **kwargs):
+    proc = subprocess.run(['git'] + list(args), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          input=kwargs.get('input'), check=True)
+    return proc.stdout.decode('utf8')
+
+
+def make_stubs(workdir):
+    stub_dir = os.path.join(workdir, 'bin')
+    os.makedirs(stub_dir)
+    for name in stub_names:
+        path = os.path.join(stub_dir, name)
+        with open(path, 'w') as f:
+            f.write(stub_template)
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = stub_dir + os.pathsep + os.environ['PATH']
+    os.environ['BENCH_CALLS'] = os.path.join(workdir, 'calls.log')
+
+
+def make_repo(workdir, name, files, commits):
+    # A bare upstream with files in the first commit and commits - 1 more
+    # commits on a history file, and a clone of it for the tool and one for
+    # pushing changes. Returns the paths of the two clones.
+    bare = os.path.join(workdir, name + '.git')
+    git(workdir, 'init', '-q', '--bare', bare)
+    git(bare, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+
+    stream = []
+    date = int(time.time()) - commits
+    for i in range(1, commits + 1):
+        message = 'commit %d' % i
+        stream.append('commit refs/heads/master\nmark :%d\ncommitter Bench <bench@example.com> %d +0000\n'
+                      'data %d\n%s\n' % (i, date + i, len(message), message))
+        if i > 1:
+            stream.append('from :%d\n' % (i - 1))
+        changed = files.items() if i == 1 else [('history.txt', 'history %d\n' % i)]
+        for path, content in changed:
+            data = content.encode('utf8')
+            stream.append('M 100644 inline %s\ndata %d\n%s\n' % (path, len(data), content))
+    git(bare, 'fast-import', '--quiet', input=''.join(stream).encode('utf8'))
+
+    clones = []
+    for clone in ('work', 'client'):
+        path = os.path.join(workdir, name, clone)
+        git(workdir, 'clone', '-q', bare, path)
+        git(path, 'config', 'user.email', 'bench@example.com')
+        git(path, 'config', 'user.name', 'Bench')
+        clones.append(path)
+    return clones
+
+
+def push_change(client, path, content, append=False):
+    with open(os.path.join(client, path), 'a' if append else 'w') as f:
+        f.write(content)
+    git(client, 'add', path)
+    git(client, 'commit', '-q', '-m', 'change %s' % path)
+    git(client, 'push', '-q')
+
+
+def cpu_seconds():
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def measure(fn, *args):
+    # wall and CPU seconds, and subprocesses of a call
+    forks = fork_count
+    cpu = cpu_seconds()
+    start = time.time()
+    result = fn(*args)
+    return result, {'wall': time.time() - start, 'cpu': cpu_seconds() - cpu, 'forks': fork_count - forks}
+
+
+def summarize(samples, per=1):
+    # per is the number of items a sample is for, such as flows
+    walls = sorted(sample['wall'] for sample in samples)
+    n = len(samples)
+    return {
+        'runs': n,
+        'wall_median': walls[n // 2],
+        'wall_p95': walls[min(n - 1, int(n * 0.95))],
+        'cpu_mean': sum(sample['cpu'] for sample in samples) / n,
+        'forks_mean': sum(sample['forks'] for sample in samples) / n,
+        'forks_per_item': sum(sample['forks'] for sample in samples) / float(n * per),
+    }
+
+
+def lsf_files(params, cluster, include):
+    conf = ['# LSF configuration generated by bench.py', 'LSF_LOG_MASK=LOG_WARNING', 'LSB_DEBUG_MBD="LC_TRACE"']
+    for i in range(params):
+        if i % 10 == 0:
+            conf.append('# section %d' % (i // 10))
+        conf.append('LSB_BENCH_PARAM_%d=value%d' % (i, i))
+    queues = ''.join('Begin Queue\nQUEUE_NAME=q%d\nPRIORITY=%d\nEnd Queue\n\n' % (i, i) for i in range(50))
+    queues += '#INCLUDE "%s"\n' % include
+    return {
+        'lsf.conf': '\n'.join(conf) + '\n',
+        'lsf.shared': 'Begin Cluster\nClusterName\n%s\nEnd Cluster\n' % cluster,
+        'lsf.cluster.%s' % cluster: 'Begin Host\nHOSTNAME model type\nhost0 ! !\nEnd Host\n',
+        'lsbatch/%s/configdir/lsb.queues' % cluster: queues,
+        'lsbatch/%s/configdir/lsb.params' % cluster: 'Begin Parameters\nMBD_SLEEP_TIME=10\nEnd Parameters\n',
+    }
+
+
+def lsf_cycle(module, lsf_envdir, shared_envdir, graph):
+    # one poll cycle of a cluster, as Cluster.poll without coalescing
+    if graph is None:
+        _, private_operations = module.git_manager_private(lsf_envdir, None)
+        _, shared_operations = module.git_manager_shared(shared_envdir, None)
+    else:
+        _, private_operations = module.git_manager_private(lsf_envdir, None, None, graph)
+        _, shared_operations = module.git_manager_shared(shared_envdir, None, None, graph)
+    operations = private_operations | shared_operations
+    if len(operations) > 0:
+        module.do_actions(None, operations)
+    return operations
+
+
+def bench_lsf(module, workdir, args, results):
+    shared_files = {'lsb.queues.common': 'Begin Queue\nQUEUE_NAME=common\nEnd Queue\n'}
+    shared_envdir, shared_client = make_repo(workdir, 'shared', shared_files, args.commits)
+    include = os.path.join(shared_envdir, 'lsb.queues.common')
+    lsf_envdir, lsf_client = make_repo(workdir, 'private', lsf_files(args.conf_params, 'bench', include), args.commits)
+    # versions before the include graph take the operations of the shared file names
+    graph = module.IncludeGraph(lsf_envdir, shared_envdir) if hasattr(module, 'IncludeGraph') else None
+
+    # the first cycle finds the upstreams
+    lsf_cycle(module, lsf_envdir, shared_envdir, graph)
+
+    samples = [measure(lsf_cycle, module, lsf_envdir, shared_envdir, graph)[1] for i in range(args.cycles)]
+    results['lsf_idle_cycle'] = summarize(samples)
+
+    # the time from a push landing to the LSF operations done, when a cycle starts right away
+    samples = []
+    for i in range(args.cycles):
+        push_change(lsf_client, 'lsf.conf', 'LSB_DEBUG_MBD="LC_TRACE LC_%d"\n' % i, append=True)
+        operations, sample = measure(lsf_cycle, module, lsf_envdir, shared_envdir, graph)
+        samples.append(sample)
+    results['lsf_private_change_to_action'] = summarize(samples)
+
+    samples = []
+    for i in range(args.cycles):
+        push_change(shared_client, 'lsb.queues.common', 'Begin Queue\nQUEUE_NAME=common%d\nEnd Queue\n' % i, append=True)
+        samples.append(measure(lsf_cycle, module, lsf_envdir, shared_envdir, graph)[1])
+    results['lsf_shared_change_to_action'] = summarize(samples)
+
+    # a burst of pushes acted on by one cycle
+    samples = []
+    for i in range(max(1, args.cycles // 5)):
+        for j in range(args.burst):
+            path = ['lsf.conf', 'lsbatch/bench/configdir/lsb.queues', 'lsf.shared'][j % 3]
+            push_change(lsf_client, path, '# burst %d %d\n' % (i, j), append=True)
+        samples.append(measure(lsf_cycle, module, lsf_envdir, shared_envdir, graph)[1])
+    results['lsf_burst_cycle'] = summarize(samples, args.burst)
+
+
+def operation_calls(lsf_envdir):
+    # number of LSF operations the stubs logged for a cluster
+    path = os.environ['BENCH_CALLS']
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return sum(1 for line in f if line.split()[1:3] in ([lsf_envdir, 'lsadmin'], [lsf_envdir, 'badmin']))
+
+
+def wait_until(predicate, timeout=300):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise RuntimeError('Timed out after %d seconds.' % timeout)
+        time.sleep(0.01)
+
+
+def process_cpu(pid):
+    # user and system CPU seconds of a process and its waited children
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return sum(int(v) for v in fields[11:15]) / float(os.sysconf('SC_CLK_TCK'))
+
+
+class Daemon(object):
+    # lsf-git-configure.py running as a service on the synthetic repositories.
+    # Its CPU time is read from /proc and its subprocesses from its trace.
+
+    def __init__(self, script, workdir, name, options, env):
+        self.log_path = os.path.join(workdir, name + '.log')
+        self.trace_path = os.path.join(workdir, name + '.trace')
+        with open(self.log_path, 'w') as log:
+            self.proc = subprocess.Popen([sys.executable, script, '--trace', self.trace_path] + options,
+                                         stdout=log, stderr=subprocess.STDOUT, env=env)
+
+    def count(self, text, path):
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return f.read().count(text)
+
+    def wait_polled(self, count):
+        # every repository polled once, with the checkpoints written
+        wait_until(lambda: self.proc.poll() is None and self.count('Next poll', self.log_path) >= count)
+
+    def measure(self, fn, *args):
+        forks = self.count('"kind": "execute"', self.trace_path)
+        cpu = process_cpu(self.proc.pid)
+        start = time.time()
+        result = fn(*args)
+        return result, {'wall': time.time() - start, 'cpu': process_cpu(self.proc.pid) - cpu,
+                        'forks': self.count('"kind": "execute"', self.trace_path) - forks}
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def lsf_daemon_script(module, args):
+    # the daemon scenarios need a version with watching and tracing
+    if not all(hasattr(module, name) for name in ('create_watcher', 'PollScheduler', 'Tracer', 'run_controller')):
+        logging.warning('The scripts of %s cannot run the watch and clusters scenarios.' % args.src)
+        return None
+    return os.path.join(args.src, 'lsf', 'lsf-git-configure.py')
+
+
+def bench_watch(module, workdir, args, results):
+    # A push after an idle period, picked up by polling backed off to
+    # --poll_max_interval and by watching the upstream refs, measured to the
+    # first LSF operation started. The idle samples are the CPU time and
+    # subprocesses of the idle periods.
+    script = lsf_daemon_script(module, args)
+    if script is None:
+        return
+    modes = [
+        ('polling', ['--interval', str(args.poll_interval), '--max_interval', str(args.poll_max_interval)]),
+        ('watch', ['--watch', '--interval', '300']),
+    ]
+    for mode, options in modes:
+        lsf_envdir, lsf_client = make_repo(workdir, 'watch-' + mode, lsf_files(100, 'bench', os.devnull), 10)
+        daemon = Daemon(script, workdir, 'watch-' + mode, options, dict(os.environ, LSF_ENVDIR=lsf_envdir))
+        idle, latency = [], []
+        try:
+            daemon.wait_polled(1)
+            for i in range(args.daemon_cycles):
+                idle.append(daemon.measure(time.sleep, args.idle)[1])
+                count = operation_calls(lsf_envdir)
+                push_change(lsf_client, 'lsf.conf', 'LSB_DEBUG_MBD="LC_TRACE LC_%d"\n' % i, append=True)
+                latency.append(daemon.measure(wait_until, lambda: operation_calls(lsf_envdir) > count)[1])
+        finally:
+            daemon.stop()
+        results['lsf_%s_idle' % mode] = summarize(idle)
+        results['lsf_%s_push_to_action' % mode] = summarize(latency)
+
+
+def push_clusters(clusters, i):
+    counts = [operation_calls(lsf_envdir) for lsf_envdir, lsf_client in clusters]
+    for lsf_envdir, lsf_client in clusters:
+        push_change(lsf_client, 'lsf.conf', 'LSB_DEBUG_MBD="LC_TRACE LC_%d"\n' % i, append=True)
+    wait_until(lambda: all(operation_calls(lsf_envdir) > count for (lsf_envdir, _), count in zip(clusters, counts)))
+
+
+def bench_clusters(module, workdir, args, results):
+    # --clusters clusters managed by one watching process, each pushed to in
+    # turn, measured from the first push to the LSF operations of all of them started
+    script = lsf_daemon_script(module, args)
+    if script is None:
+        return
+    clusters = []
+    for i in range(args.clusters):
+        name = 'cluster%d' % i
+        clusters.append(make_repo(workdir, name, lsf_files(100, name, os.devnull), 10))
+    clusters_file = os.path.join(workdir, 'clusters.json')
+    with open(clusters_file, 'w') as f:
+        json.dump({'clusters': [{'envdir': lsf_envdir} for lsf_envdir, lsf_client in clusters]}, f)
+
+    daemon = Daemon(script, workdir, 'clusters', ['--clusters', clusters_file, '--watch', '--interval', '300'], dict(os.environ))
+    idle, latency = [], []
+    try:
+        daemon.wait_polled(len(clusters))
+        for i in range(args.daemon_cycles):
+            idle.append(daemon.measure(time.sleep, args.idle)[1])
+            latency.append(daemon.measure(push_clusters, clusters, i)[1])
+    finally:
+        daemon.stop()
+    results['lsf_clusters_idle'] = summarize(idle, args.clusters)
+    results['lsf_clusters_push_to_action'] = summarize(latency, args.clusters)
+
+
+def ppm_files(flows, work, template):
+    files = {}
+    for i in range(flows):
+        name = 'flow%d' % i
+        content = template.replace('your_path', work).replace('simpleflow', name)
+        files['workflow/%s/%s.xml' % (name, name)] = content
+        files['workflow/%s/data/job1_data' % name] = 'data\n'
+    return files
+
+
+def bench_ppm(module, workdir, args, results):
+    with open(os.path.join(args.src, 'ppm', 'samples', 'workflow', 'simpleflow', 'simpleflow.xml')) as f:
+        template = f.read()
+    work = os.path.join(workdir, 'ppm', 'work')
+    work, client = make_repo(workdir, 'ppm', ppm_files(args.flows, work, template), args.commits)
+    state_file = os.path.join(workdir, 'ppm.state')
+    ppm_args = argparse.Namespace(repo=None, path=work, operation='trigger', parallel=args.parallel,
+                                  retries=0, backoff=0, state_file=state_file)
+
+    cwd = os.getcwd()
+    try:
+        # all the flows submitted on the first start
+        sample = measure(module.init_submit, ppm_args)[1]
+        results['ppm_init_submit'] = summarize([sample], args.flows)
+
+        # a restart with nothing changed
+        sample = measure(module.init_submit, ppm_args)[1]
+        results['ppm_restart'] = summarize([sample], args.flows)
+
+        samples = [measure(module.git_manager, ppm_args)[1] for i in range(args.cycles)]
+        results['ppm_idle_cycle'] = summarize(samples)
+
+        # changed flows submitted, from a push landing
+        samples = []
+        for i in range(args.cycles):
+            for j in range(args.changed):
+                name = 'flow%d' % ((i * args.changed + j) % args.flows)
+                push_path = 'workflow/%s/%s.xml' % (name, name)
+                with open(os.path.join(client, push_path)) as f:
+                    content = f.read()
+                with open(os.path.join(client, push_path), 'w') as f:
+                    f.write(content.replace('sleep 1', 'sleep %d' % (i + 2), 1))
+                git(client, 'add', push_path)
+            git(client, 'commit', '-q', '-m', 'change flows')
+            git(client, 'push', '-q')
+            samples.append(measure(module.git_manager, ppm_args)[1])
+        results['ppm_flow_change_to_submit'] = summarize(samples, args.changed)
+    finally:
+        os.chdir(cwd)
+
+
+def print_results(results):
+    print('%-30s %6s %10s %10s %10s %10s %10s' % ('SCENARIO', 'RUNS', 'MEDIAN(s)', 'P95(s)', 'CPU(s)', 'FORKS', 'FORKS/ITEM'))
+    for name, stat in sorted(results.items()):
+        print('%-30s %6d %10.4f %10.4f %10.4f %10.1f %10.2f' % (name, stat['runs'], stat['wall_median'], stat['wall_p95'],
+                                                                stat['cpu_mean'], stat['forks_mean'], stat['forks_per_item']))
+
+
+def print_comparison(baseline, results):
+    # relative change of each metric from a baseline written with --output
+    print('%-30s %-16s %12s %12s %9s' % ('SCENARIO', 'METRIC', 'BASELINE', 'CURRENT', 'CHANGE'))
+    for name, stat in sorted(results.items()):
+        old_stat = baseline['results'].get(name)
+        if old_stat is None:
+            continue
+        for metric in ('wall_median', 'wall_p95', 'cpu_mean', 'forks_mean', 'forks_per_item'):
+            old, new = old_stat[metric], stat[metric]
+            change = '%+8.1f%%' % (100.0 * (new - old) / old) if old else '%9s' % '-'
+            print('%-30s %-16s %12.4f %12.4f %s' % (name, metric, old, new, change))
+
+
+def main(argv):
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(process)d: %(message)s')
+
+    parser = argparse.ArgumentParser(description='Benchmark of the LSF and PPM git operation scripts on synthetic repositories.')
+    parser.add_argument('--src', type=str, default=os.path.join(os.path.dirname(bench_dir), 'src'), help='src directory of the version to be measured')
+    parser.add_argument('--scenarios', type=str, default='lsf,ppm,watch,clusters', help='comma separated scenarios to run: lsf, ppm, watch, clusters')
+    parser.add_argument('--commits', type=int, default=2000, help='commits in the history of each synthetic repository')
+    parser.add_argument('--conf_params', type=int, default=5000, help='parameters in the synthetic lsf.conf')
+    parser.add_argument('--flows', type=int, default=200, help='flows in the synthetic PPM repository')
+    parser.add_argument('--changed', type=int, default=10, help='flows changed by each PPM push')
+    parser.add_argument('--burst', type=int, default=10, help='pushes in each burst acted on by one cycle')
+    parser.add_argument('--cycles', type=int, default=20, help='runs of each measured cycle')
+    parser.add_argument('--parallel', type=int, default=4, help='flows submitted at the same time')
+    parser.add_argument('--clusters', type=int, default=20, help='clusters managed by one process in the clusters scenario')
+    parser.add_argument('--daemon_cycles', type=int, default=5, help='pushes after an idle period in the watch and clusters scenarios')
+    parser.add_argument('--idle', type=float, default=5, help='seconds of each idle period in the watch and clusters scenarios')
+    parser.add_argument('--poll_interval', type=int, default=1, help='--interval of the polling in the watch scenario')
+    parser.add_argument('--poll_max_interval', type=int, default=4, help='--max_interval of the polling in the watch scenario')
+    parser.add_argument('--stub_sleep', type=float, default=0, help='seconds taken by each stub LSF and PPM command')
+    parser.add_argument('--workdir', type=str, default=None, help='directory of the synthetic repositories, a temporary one by default')
+    parser.add_argument('--keep', action="store_true", help='keep the synthetic repositories')
+    parser.add_argument('-o', '--output', type=str, default=None, help='write the results as JSON to this file')
+    parser.add_argument('--compare', type=str, default=None, help='JSON results of a previous run to compare with')
+    args = parser.parse_args(argv)
+
+    args.src = os.path.abspath(args.src)
+    workdir = tempfile.mkdtemp(prefix='lsf_git_bench_', dir=args.workdir)
+    make_stubs(workdir)
+    if args.stub_sleep > 0:
+        os.environ['BENCH_STUB_SLEEP'] = str(args.stub_sleep)
+    subprocess.Popen = CountingPopen
+
+    results = {}
+    try:
+        scenarios = args.scenarios.split(',')
+        if 'lsf' in scenarios:
+            module = load_script(os.path.join(args.src, 'lsf', 'lsf-git-configure.py'), 'lsf_git_configure')
+            bench_lsf(module, workdir, args, results)
+        if 'watch' in scenarios or 'clusters' in scenarios:
+            module = load_script(os.path.join(args.src, 'lsf', 'lsf-git-configure.py'), 'lsf_git_configure')
+            if 'watch' in scenarios:
+                bench_watch(module, workdir, args, results)
+            if 'clusters' in scenarios:
+                bench_clusters(module, workdir, args, results)
+        if 'ppm' in scenarios:
+            module = load_script(os.path.join(args.src, 'ppm', 'ppm-git-trigger.py'), 'ppm_git_trigger')
+            bench_ppm(module, workdir, args, results)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        print_comparison(baseline, results)
+    if args.output:
+        settings = dict((k, v) for k, v in vars(args).items() if k not in ('workdir', 'keep', 'output', 'compare'))
+        with open(args.output, 'w') as f:
+            json.dump({'settings': settings, 'results': results}, f, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
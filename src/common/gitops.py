@@ -0,0 +1,855 @@
+# Copyright International Business Machines Corp, 2020
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Code shared by lsf-git-configure.py and ppm-git-trigger.py, which import it
+# from this directory
+
+import os
+import re
+import time
+import logging
+import select
+import socket
+import atexit
+import ctypes
+import ctypes.util
+import threading
+import contextvars
+import json
+import random
+import http.server
+import collections
+import binascii
+import mmap
+import struct
+import zlib
+
+
+# All zero SHA standing for a missing file in a git diff
+NULL_SHA = '0' * 40
+
+# Fields of the trace spans in the current context, such as the cycle, the
+# LSF operation or the flow
+trace_group = contextvars.ContextVar('trace_group', default=None)
+
+
+class RefWatcher(object):
+    # inotify events raised when git updates a ref, directly or via lock file
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    def __init__(self, ref_files, socket_path=None, settle=0.05):
+        self.settle = settle
+        self.inotify_fd = None
+        self.sock = None
+        self.socket_path = None
+        if ref_files:
+            self.init_inotify(ref_files)
+        if socket_path:
+            self.init_socket(socket_path)
+
+    def init_inotify(self, ref_files):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            logging.warning('inotify is not available, only polling and socket notification are used.')
+            return
+        if fd < 0:
+            logging.warning('Failed to initialize inotify, due to %s.' % os.strerror(ctypes.get_errno()))
+            return
+
+        # a ref is either a loose file or an entry of packed-refs in git dir
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        for git_dir, ref in ref_files:
+            for path in set([git_dir, os.path.dirname(os.path.join(git_dir, ref))]):
+                if libc.inotify_add_watch(fd, path.encode('utf8'), mask) < 0:
+                    logging.warning('Failed to watch %s, due to %s.' % (path, os.strerror(ctypes.get_errno())))
+                else:
+                    logging.info('Watching %s for upstream changes.' % path)
+        self.inotify_fd = fd
+
+    def init_socket(self, socket_path):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(socket_path)
+        self.sock.setblocking(False)
+        self.socket_path = socket_path
+        atexit.register(self.close)
+        logging.info('Listening on %s for upstream changes.' % socket_path)
+
+    def wait(self, timeout):
+        # Return True when woken up by a change, False when timed out
+        fds = [fd for fd in (self.inotify_fd, self.sock) if fd is not None]
+        if len(fds) == 0:
+            time.sleep(timeout)
+            return False
+
+        readable, _, _ = select.select(fds, [], [], timeout)
+        if len(readable) == 0:
+            return False
+
+        # one push touches several files, let them settle before draining
+        time.sleep(self.settle)
+        self.drain()
+        return True
+
+    def drain(self):
+        while self.inotify_fd is not None:
+            try:
+                os.read(self.inotify_fd, 65536)
+            except (BlockingIOError, InterruptedError):
+                break
+        while self.sock is not None:
+            try:
+                self.sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                break
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+class Metrics(object):
+    # Counters and histograms in the Prometheus text format, served over HTTP
+    # or written for the textfile collector of the node exporter
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.help = {}
+        self.values = {}
+
+    def describe(self, name, kind, text):
+        self.kinds[name] = kind
+        self.help[name] = text
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.values.get(key)
+            if hist is None:
+                hist = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            # bucket counts are cumulative
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @staticmethod
+    def format_labels(labels):
+        if len(labels) == 0:
+            return ''
+        escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+        return '{%s}' % ','.join('%s="%s"' % pair for pair in escaped)
+
+    def render(self):
+        with self.lock:
+            values = [(key, [list(v[0]), v[1], v[2]] if isinstance(v, list) else v)
+                      for key, v in self.values.items()]
+
+        lines = []
+        for name in sorted(self.kinds):
+            full_name = self.prefix + '_' + name
+            lines.append('# HELP %s %s' % (full_name, self.help[name]))
+            lines.append('# TYPE %s %s' % (full_name, self.kinds[name]))
+            for (series, labels), value in sorted(values):
+                if series != name:
+                    continue
+                if self.kinds[name] == 'counter':
+                    lines.append('%s%s %s' % (full_name, self.format_labels(labels), value))
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('%s_bucket%s %d' % (full_name, self.format_labels(labels + (('le', bound),)), bucket_count))
+                lines.append('%s_bucket%s %d' % (full_name, self.format_labels(labels + (('le', '+Inf'),)), count))
+                lines.append('%s_sum%s %.6f' % (full_name, self.format_labels(labels), total))
+                lines.append('%s_count%s %d' % (full_name, self.format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        # serve the metrics on http://<host>:<port>/metrics in a daemon thread
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def write(self, path):
+        # replace the file at once, so the collector never reads a partial one
+        tmp = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+def git_subcommand(cmd):
+    # the subcommand of a git command line, after the -C and -c options
+    i = 1
+    while i < len(cmd) and cmd[i] in ('-C', '-c'):
+        i += 2
+    return cmd[i] if i < len(cmd) else None
+
+
+def command_label(cmd):
+    # the command and its subcommand, such as "git pull" or "badmin reconfig",
+    # other arguments such as flow and host names are left out
+    command = os.path.basename(cmd[0])
+    if command == 'git':
+        subcommand = git_subcommand(cmd)
+        return command if subcommand is None else command + ' ' + subcommand
+    if command in ('badmin', 'lsadmin') and len(cmd) > 1:
+        return command + ' ' + cmd[1]
+    return command
+
+
+class Tracer(object):
+    # Spans of the subprocesses and poll cycles appended to a JSONL file. A
+    # span carries the fields of trace_group of its context, so the spans of
+    # one cycle, operation or flow can be grouped.
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def record(self, kind, start, duration, **fields):
+        span = dict(trace_group.get() or {}, kind=kind, start=round(start, 6), duration=round(duration, 6))
+        span.update(fields)
+        line = json.dumps(span, sort_keys=True)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+
+def profile_report(trace_file, top):
+    # Print where the wall time of a trace goes, as top lists of commands and
+    # cycles by the time their subprocesses took
+    commands = {}
+    cycles = {}
+    cycle_seconds = 0.0
+    with open(trace_file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            span = json.loads(line)
+            if span.get('kind') == 'cycle':
+                cycle_seconds += span['duration']
+                continue
+            label = command_label(span['argv'])
+            stat = commands.setdefault(label, {'calls': 0, 'seconds': 0.0, 'max': 0.0, 'failed': 0})
+            stat['calls'] += 1
+            stat['seconds'] += span['duration']
+            stat['max'] = max(stat['max'], span['duration'])
+            stat['failed'] += 1 if span['ret'] != 0 else 0
+            cycle = cycles.setdefault(span.get('cycle'), {})
+            cycle[label] = cycle.get(label, 0.0) + span['duration']
+
+    total = sum(stat['seconds'] for stat in commands.values())
+    print('%d subprocesses took %.3f seconds, in poll cycles taking %.3f seconds.'
+          % (sum(stat['calls'] for stat in commands.values()), total, cycle_seconds))
+    print()
+    print('%-32s %8s %10s %6s %10s %10s %7s' % ('COMMAND', 'CALLS', 'SECONDS', 'SHARE', 'MEAN', 'MAX', 'FAILED'))
+    for label, stat in sorted(commands.items(), key=lambda item: -item[1]['seconds'])[:top]:
+        print('%-32s %8d %10.3f %5.1f%% %10.4f %10.4f %7d'
+              % (label, stat['calls'], stat['seconds'], 100 * stat['seconds'] / total if total > 0 else 0,
+                 stat['seconds'] / stat['calls'], stat['max'], stat['failed']))
+    print()
+    print('%-32s %10s  %s' % ('CYCLE', 'SECONDS', 'DOMINATED BY'))
+    for cycle, stat in sorted(cycles.items(), key=lambda item: -sum(item[1].values()))[:top]:
+        label = max(stat, key=stat.get)
+        print('%-32s %10.3f  %s %.3f' % (cycle, sum(stat.values()), label, stat[label]))
+
+
+class PollScheduler(object):
+    # Poll schedule of each repository. The interval drops to the minimum
+    # after a change and doubles on each idle poll up to the maximum, failed
+    # polls back off exponentially, and each delay is jittered so the hosts
+    # started together do not poll the git server in lockstep.
+
+    def __init__(self, repos, min_interval, max_interval, jitter):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.jitter = jitter
+        self.state = dict((repo, {'interval': min_interval, 'errors': 0, 'due': 0}) for repo in repos)
+
+    def due(self):
+        now = time.time()
+        return set(repo for repo, state in self.state.items() if state['due'] <= now)
+
+    def record(self, repo, changed, failed):
+        # schedule the next poll of a repository after a poll
+        state = self.state[repo]
+        if failed:
+            state['errors'] += 1
+        else:
+            state['errors'] = 0
+            if changed:
+                state['interval'] = self.min_interval
+            else:
+                state['interval'] = min(self.max_interval, state['interval'] * 2)
+
+        delay = min(self.max_interval, state['interval'] * 2 ** state['errors'])
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        state['due'] = time.time() + delay
+        logging.debug('Next poll of %s in %.1f seconds%s.'
+                      % (repo, delay, ' after %d failed polls' % state['errors'] if state['errors'] else ''))
+        return delay
+
+    def wait(self):
+        # seconds to the next poll due
+        return max(0, min(state['due'] for state in self.state.values()) - time.time())
+
+    def wake(self):
+        # poll all the repositories now, such as on a push notification
+        for state in self.state.values():
+            state['due'] = 0
+
+
+class CliRepository(object):
+    # Repository backend running the git command line, the fallback of
+    # NativeRepository. The commands are run by execute of the script, which
+    # returns the exit code, stdout and stderr. stdout is decoded with
+    # surrogateescape, so the bytes of the blobs are encoded back as they were.
+
+    def __init__(self, repo_dir, execute):
+        self.repo_dir = repo_dir
+        self.execute = execute
+
+    def resolve(self, name):
+        cmd = ['git', 'rev-parse', '--verify', '-q', name + '^{commit}']
+        ret, out, err = self.execute(cmd, cwd=self.repo_dir)
+        if ret != 0:
+            return None
+        return out.strip()
+
+    def head(self):
+        return self.resolve('HEAD')
+
+    def commit(self, name):
+        sha = self.resolve(name)
+        if sha is None:
+            return None
+        cmd = ['git', 'cat-file', 'commit', sha]
+        ret, out, err = self.execute(cmd, cwd=self.repo_dir)
+        if ret != 0:
+            return None
+        return parse_commit(out.encode('utf8', 'surrogateescape'))
+
+    def blob(self, sha):
+        cmd = ['git', 'cat-file', 'blob', sha]
+        ret, out, err = self.execute(cmd, cwd=self.repo_dir)
+        if ret != 0:
+            logging.error('Failed executing %s, due to %s.' % (cmd, err))
+            return None
+        return out.encode('utf8', 'surrogateescape')
+
+    def blobs(self, shas):
+        # {sha: content} of blobs, read by one cat-file process
+        cmd = ['git', 'cat-file', '--batch']
+        ret, out, err = self.execute(cmd, cwd=self.repo_dir, input=('\n'.join(shas) + '\n').encode('utf8'))
+        if ret != 0:
+            logging.error('Failed executing %s, due to %s.' % (cmd, err))
+            return {}
+        out = out.encode('utf8', 'surrogateescape')
+        contents = {}
+        pos = 0
+        for sha in shas:
+            header_end = out.index(b'\n', pos)
+            header = out[pos:header_end].split()
+            pos = header_end + 1
+            if len(header) < 3:
+                continue
+            size = int(header[2])
+            contents[sha] = out[pos:pos + size]
+            pos += size + 1
+        return contents
+
+    def files(self, name):
+        # (path, blob SHA) of each file in a commit
+        cmd = ['git', 'ls-tree', '-r', '-z', '--full-tree', name]
+        ret, out, err = self.execute(cmd, cwd=self.repo_dir)
+        if ret != 0:
+            logging.error('Failed executing %s, due to %s.' % (cmd, err))
+            return None
+
+        files = []
+        # each entry is "<mode> <type> <sha>\t<path>"
+        for entry in out.split('\0'):
+            meta, _, path = entry.partition('\t')
+            fields = meta.split()
+            if len(fields) == 3 and fields[1] == 'blob':
+                files.append((path, fields[2]))
+        return files
+
+    def diff(self, old_commit, new_commit):
+        # Return (path, old blob SHA, new blob SHA) for each changed file. The
+        # SHA of a file missing on one side is NULL_SHA.
+        cmd = ['git', 'diff', '--raw', '--no-abbrev', '--no-renames', '-z', old_commit, new_commit]
+        ret, out, err = self.execute(cmd, cwd=self.repo_dir)
+        if ret != 0:
+            logging.error('Failed executing %s, due to %s.' % (cmd, err))
+            return None
+
+        changes = []
+        fields = out.split('\0')
+        # each entry is ":<old mode> <new mode> <old sha> <new sha> <status>" and the path
+        for i in range(0, len(fields) - 1, 2):
+            meta = fields[i].split()
+            if len(meta) < 5:
+                continue
+            changes.append((fields[i + 1], meta[2], meta[3]))
+        return changes
+
+
+def parse_commit(data):
+    # tree, parents and committer time of a commit object
+    commit = {'tree': None, 'parents': [], 'time': None}
+    for line in data.split(b'\n'):
+        if line == b'':
+            break
+        key, _, value = line.partition(b' ')
+        if key == b'tree':
+            commit['tree'] = value.decode('ascii')
+        elif key == b'parent':
+            commit['parents'].append(value.decode('ascii'))
+        elif key == b'committer':
+            commit['time'] = int(value.rsplit(b' ', 2)[1])
+    return commit
+
+
+class GitObjectStore(object):
+    # Read-only objects of a git objects directory: loose objects, packs with
+    # version 2 indexes, which are memory mapped, and the objects directories
+    # of alternates. Inflated objects are kept in a bounded LRU cache.
+
+    pack_types = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+
+    def __init__(self, objects_dir, cache_size=4096):
+        self.objects_dir = objects_dir
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.packs = {}
+        self.load_packs()
+        self.alternates = {}
+        self.load_alternates()
+
+    def load_alternates(self):
+        # the stores of the alternates added since the last load
+        try:
+            with open(os.path.join(self.objects_dir, 'info', 'alternates')) as f:
+                paths = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        except (IOError, OSError):
+            paths = []
+        for path in paths:
+            path = os.path.join(self.objects_dir, path)
+            if path not in self.alternates:
+                self.alternates[path] = GitObjectStore(path, self.cache_size)
+
+    def load_packs(self):
+        # map the packs not mapped yet, and forget the removed ones
+        pack_dir = os.path.join(self.objects_dir, 'pack')
+        try:
+            names = set(name[:-len('.idx')] for name in os.listdir(pack_dir) if name.endswith('.idx'))
+        except (IOError, OSError):
+            names = set()
+        for name in set(self.packs) - names:
+            del self.packs[name]
+        for name in names - set(self.packs):
+            base = os.path.join(pack_dir, name)
+            try:
+                with open(base + '.idx', 'rb') as f:
+                    idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                with open(base + '.pack', 'rb') as f:
+                    pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (IOError, OSError, ValueError):
+                continue
+            if idx[:8] != b'\377tOc\0\0\0\2':
+                raise ValueError('Unsupported pack index version of %s.' % base)
+            fanout = struct.unpack('>256I', idx[8:1032])
+            self.packs[name] = {'idx': idx, 'pack': pack, 'fanout': fanout, 'count': fanout[255]}
+
+    def find_offset(self, pack, binsha):
+        # binary search of the SHA table of a pack index
+        idx, fanout, count = pack['idx'], pack['fanout'], pack['count']
+        first = binsha[0]
+        lo = fanout[first - 1] if first > 0 else 0
+        hi = fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = idx[1032 + 20 * mid:1052 + 20 * mid]
+            if value < binsha:
+                lo = mid + 1
+            elif value > binsha:
+                hi = mid
+            else:
+                pos = 1032 + 24 * count + 4 * mid
+                offset = struct.unpack('>I', idx[pos:pos + 4])[0]
+                if offset & 0x80000000:
+                    pos = 1032 + 28 * count + 8 * (offset & 0x7fffffff)
+                    offset = struct.unpack('>Q', idx[pos:pos + 8])[0]
+                return offset
+        return None
+
+    @staticmethod
+    def inflate(data, pos):
+        # inflate the zlib stream starting at pos of a mapped pack
+        decompressor = zlib.decompressobj()
+        chunks = []
+        chunk_size = 8192
+        while not decompressor.eof:
+            chunk = data[pos:pos + chunk_size]
+            if len(chunk) == 0:
+                raise ValueError('Truncated object in pack.')
+            chunks.append(decompressor.decompress(chunk))
+            pos += chunk_size
+            chunk_size = min(chunk_size * 2, 1 << 20)
+        return b''.join(chunks)
+
+    @staticmethod
+    def apply_delta(base, delta):
+        def varint(pos):
+            value = shift = 0
+            while True:
+                byte = delta[pos]
+                pos += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+                if not byte & 0x80:
+                    return value, pos
+
+        # the base and result sizes come first
+        _, pos = varint(0)
+        size, pos = varint(pos)
+        out = []
+        while pos < len(delta):
+            op = delta[pos]
+            pos += 1
+            if op & 0x80:
+                # copy from base, with the offset and size bytes given by the op bits
+                offset = length = 0
+                for i in range(4):
+                    if op & (1 << i):
+                        offset |= delta[pos] << (8 * i)
+                        pos += 1
+                for i in range(3):
+                    if op & (1 << (4 + i)):
+                        length |= delta[pos] << (8 * i)
+                        pos += 1
+                out.append(base[offset:offset + (length or 0x10000)])
+            elif op:
+                out.append(delta[pos:pos + op])
+                pos += op
+            else:
+                raise ValueError('Invalid delta opcode.')
+        result = b''.join(out)
+        if len(result) != size:
+            raise ValueError('Delta result size mismatch.')
+        return result
+
+    def read_packed(self, pack, offset):
+        # (type, data) of the object at offset of a pack, resolving deltas
+        key = (id(pack), offset)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        data = pack['pack']
+        byte = data[offset]
+        kind = (byte >> 4) & 7
+        pos = offset + 1
+        while byte & 0x80:
+            byte = data[pos]
+            pos += 1
+
+        if kind == 6:
+            # OFS_DELTA, the base is at a negative offset
+            byte = data[pos]
+            pos += 1
+            base_offset = byte & 0x7f
+            while byte & 0x80:
+                byte = data[pos]
+                pos += 1
+                base_offset = ((base_offset + 1) << 7) | (byte & 0x7f)
+            base_type, base = self.read_packed(pack, offset - base_offset)
+            obj = (base_type, self.apply_delta(base, self.inflate(data, pos)))
+        elif kind == 7:
+            # REF_DELTA, the base is given by its SHA
+            base_type, base = self.read(binascii.hexlify(data[pos:pos + 20]).decode('ascii'))
+            obj = (base_type, self.apply_delta(base, self.inflate(data, pos + 20)))
+        elif kind in self.pack_types:
+            obj = (self.pack_types[kind], self.inflate(data, pos))
+        else:
+            raise ValueError('Unknown object type %d in pack.' % kind)
+        self.remember(key, obj)
+        return obj
+
+    def remember(self, key, obj):
+        with self.lock:
+            self.cache[key] = obj
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def lookup(self, sha):
+        # (type, data) of an object, None if it is not in this store
+        with self.lock:
+            if sha in self.cache:
+                self.cache.move_to_end(sha)
+                return self.cache[sha]
+
+        try:
+            with open(os.path.join(self.objects_dir, sha[:2], sha[2:]), 'rb') as f:
+                raw = zlib.decompress(f.read())
+            header, _, data = raw.partition(b'\0')
+            obj = (header.split(b' ')[0].decode('ascii'), data)
+            self.remember(sha, obj)
+            return obj
+        except (IOError, OSError):
+            pass
+
+        binsha = binascii.unhexlify(sha)
+        for reload in (False, True):
+            # a fetch or repack may have added packs or alternates since they were loaded
+            if reload:
+                with self.lock:
+                    self.load_packs()
+                    self.load_alternates()
+            for pack in list(self.packs.values()):
+                offset = self.find_offset(pack, binsha)
+                if offset is not None:
+                    obj = self.read_packed(pack, offset)
+                    self.remember(sha, obj)
+                    return obj
+            for alternate in list(self.alternates.values()):
+                obj = alternate.lookup(sha)
+                if obj is not None:
+                    return obj
+        return None
+
+    def read(self, sha):
+        obj = self.lookup(sha)
+        if obj is None:
+            raise KeyError('Object %s is not found.' % sha)
+        return obj
+
+
+class NativeRepository(object):
+    # Repository backend reading refs and objects in process, falling back to
+    # the git command line for what it cannot read
+
+    def __init__(self, repo_dir, execute):
+        self.repo_dir = repo_dir
+        self.git_dir = os.path.join(repo_dir, '.git')
+        if os.path.isfile(self.git_dir):
+            # a linked worktree or a submodule
+            with open(self.git_dir) as f:
+                self.git_dir = os.path.join(repo_dir, f.read().strip()[len('gitdir: '):])
+        elif not os.path.isdir(self.git_dir):
+            self.git_dir = repo_dir
+        if not os.path.isfile(os.path.join(self.git_dir, 'HEAD')):
+            raise ValueError('%s is not a git repository.' % repo_dir)
+
+        self.common_dir = self.git_dir
+        if os.path.isfile(os.path.join(self.git_dir, 'commondir')):
+            with open(os.path.join(self.git_dir, 'commondir')) as f:
+                self.common_dir = os.path.join(self.git_dir, f.read().strip())
+        with open(os.path.join(self.common_dir, 'config')) as f:
+            if re.search(r'^\s*objectformat\s*=\s*sha256', f.read(), re.M | re.I):
+                raise ValueError('SHA-256 repository %s is not supported.' % repo_dir)
+
+        self.store = GitObjectStore(os.path.join(self.common_dir, 'objects'))
+        self.fallback = CliRepository(repo_dir, execute)
+
+    def read_ref(self, ref):
+        # loose ref firstly, then the packed one
+        for base in (self.git_dir, self.common_dir):
+            try:
+                with open(os.path.join(base, ref)) as f:
+                    value = f.read().strip()
+                if value.startswith('ref: '):
+                    return self.read_ref(value[len('ref: '):])
+                return value
+            except (IOError, OSError):
+                pass
+
+        try:
+            with open(os.path.join(self.common_dir, 'packed-refs')) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[1] == ref:
+                        return fields[0]
+        except (IOError, OSError):
+            pass
+        return None
+
+    def resolve(self, name):
+        if re.match(r'^[0-9a-f]{40}$', name):
+            sha = name
+        elif name == 'HEAD' or name.startswith('refs/'):
+            sha = self.read_ref(name)
+        else:
+            sha = self.read_ref('refs/heads/' + name) or self.read_ref('refs/tags/' + name)
+        if sha is None:
+            return self.fallback.resolve(name)
+        return sha
+
+    def head(self):
+        return self.resolve('HEAD')
+
+    def commit(self, name):
+        sha = self.resolve(name)
+        if sha is None:
+            return None
+        try:
+            kind, data = self.store.read(sha)
+            # an annotated tag points to the commit
+            while kind == 'tag':
+                kind, data = self.store.read(data.split(b'\n', 1)[0].split()[1].decode('ascii'))
+            if kind == 'commit':
+                return parse_commit(data)
+        except (KeyError, ValueError, IndexError, zlib.error) as e:
+            logging.debug('Cannot read commit %s in process: %s.' % (name, e))
+        return self.fallback.commit(name)
+
+    def blob(self, sha):
+        try:
+            kind, data = self.store.read(sha)
+            if kind == 'blob':
+                return data
+        except (KeyError, ValueError, IndexError, zlib.error) as e:
+            logging.debug('Cannot read blob %s in process: %s.' % (sha, e))
+        return self.fallback.blob(sha)
+
+    def blobs(self, shas):
+        # {sha: content} of blobs, the missing ones read by the git command line
+        contents = {}
+        missing = []
+        for sha in shas:
+            try:
+                kind, data = self.store.read(sha)
+                contents[sha] = data
+            except (KeyError, ValueError, IndexError, zlib.error):
+                missing.append(sha)
+        if len(missing) > 0:
+            contents.update(self.fallback.blobs(missing))
+        return contents
+
+    def tree(self, sha):
+        # {name: (mode, sha)} of a tree object
+        kind, data = self.store.read(sha)
+        if kind != 'tree':
+            raise ValueError('Object %s is not a tree.' % sha)
+        entries = {}
+        pos = 0
+        while pos < len(data):
+            space = data.index(b' ', pos)
+            nul = data.index(b'\0', space)
+            name = data[space + 1:nul].decode('utf8', 'surrogateescape')
+            entries[name] = (data[pos:space].decode('ascii'), binascii.hexlify(data[nul + 1:nul + 21]).decode('ascii'))
+            pos = nul + 21
+        return entries
+
+    def walk_tree(self, sha, prefix, files):
+        for name, (mode, entry_sha) in sorted(self.tree(sha).items()):
+            if mode == '40000':
+                self.walk_tree(entry_sha, prefix + name + '/', files)
+            elif mode != '160000':
+                files.append((prefix + name, entry_sha))
+
+    def files(self, name):
+        # (path, blob SHA) of each file in a commit
+        try:
+            commit = self.commit(name)
+            if commit is not None:
+                files = []
+                self.walk_tree(commit['tree'], '', files)
+                return files
+        except (KeyError, ValueError, IndexError, zlib.error) as e:
+            logging.debug('Cannot list files of %s in process: %s.' % (name, e))
+        return self.fallback.files(name)
+
+    def diff_trees(self, old_tree, new_tree, prefix, changes):
+        # subtrees with the same SHA are skipped without reading them
+        old = self.tree(old_tree) if old_tree else {}
+        new = self.tree(new_tree) if new_tree else {}
+        for name in sorted(set(old) | set(new)):
+            old_mode, old_sha = old.get(name, (None, None))
+            new_mode, new_sha = new.get(name, (None, None))
+            if old_mode == new_mode and old_sha == new_sha:
+                continue
+            path = prefix + name
+            old_is_tree = old_mode == '40000'
+            new_is_tree = new_mode == '40000'
+            if old_is_tree or new_is_tree:
+                self.diff_trees(old_sha if old_is_tree else None, new_sha if new_is_tree else None, path + '/', changes)
+            if old_mode is not None and not old_is_tree or new_mode is not None and not new_is_tree:
+                changes.append((path, old_sha if old_mode and not old_is_tree else NULL_SHA,
+                                new_sha if new_mode and not new_is_tree else NULL_SHA))
+
+    def diff(self, old_commit, new_commit):
+        # Return (path, old blob SHA, new blob SHA) for each changed file. The
+        # SHA of a file missing on one side is NULL_SHA.
+        try:
+            old = self.commit(old_commit)
+            new = self.commit(new_commit)
+            if old is not None and new is not None:
+                changes = []
+                self.diff_trees(old['tree'], new['tree'], '', changes)
+                return sorted(changes)
+        except (KeyError, ValueError, IndexError, zlib.error) as e:
+            logging.debug('Cannot diff %s and %s in process: %s.' % (old_commit, new_commit, e))
+        return self.fallback.diff(old_commit, new_commit)
+
+
+def open_repository(repo_dir, backend, execute):
+    # the repository backend of a directory, the in-process one unless the
+    # git command line is chosen by backend or the repository is not supported
+    if backend == 'native':
+        try:
+            return NativeRepository(repo_dir, execute)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning('Falling back to git command line for %s: %s' % (repo_dir, e))
+    return CliRepository(repo_dir, execute)
@@ -24,6 +24,22 @@ import string
 import logging
 from logging import handlers
 import signal
+import threading
+import concurrent.futures
+import contextvars
+import asyncio
+import hashlib
+import glob
+import json
+import fnmatch
+import socket
+import atexit
+import itertools
+import shlex
+
+# the code shared with the other script is in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'common'))
+from gitops import NULL_SHA, open_repository, RefWatcher, Metrics, command_label, git_subcommand, Tracer, profile_report, trace_group, PollScheduler
 
 # Rules for lsf.conf parameter based on IBM LSF Knowledge center
 # Operations:
@@ -99,6 +115,259 @@ operation_map = {
         'lsb.users': set(['mbd-reconfig']),
 }
 
+# Operations for the sections of lsf.cluster.<name>, the other sections take
+# the operations of the whole file above. LIM picks up the hosts, the
+# administrators and the resource locations on a reconfig.
+cluster_section_map = {
+    'ClusterAdmins': set(['lim-reconfig', 'mbd-restart']),
+    'Host': set(['lim-reconfig', 'mbd-restart']),
+    'ResourceMap': set(['lim-reconfig', 'mbd-restart']),
+}
+
+# Operations covered by another one: restarting a daemon also loads the
+# configuration that a reconfig of it would
+operation_dominance = {
+    'lim-restart': set(['lim-reconfig']),
+    'mbd-restart': set(['mbd-reconfig']),
+}
+
+# Command of each operation
+operation_commands = {
+    'lim-reconfig': ['lsadmin', 'reconfig', '-f'],
+    'lim-restart': ['lsadmin', 'limrestart', '-f', 'all'],
+    'res-restart': ['lsadmin', 'resrestart', '-f', 'all'],
+    'sbd-restart': ['badmin', 'hrestart', '-f', 'all'],
+    'mbd-restart': ['badmin', 'mbdrestart', '-f'],
+    'mbd-reconfig': ['badmin', 'reconfig', '-f'],
+}
+known_operations = set(operation_commands)
+
+# Operations which can be taken on given hosts, written as "<operation>@<host>",
+# and the commands listing all hosts for them with the host name in first column
+host_operations = {
+    'res-restart': ['lshosts', '-w'],
+    'sbd-restart': ['bhosts', '-w'],
+}
+
+# Operations to be finished before an operation starts, when they are
+# taken together. LIM goes first as the other daemons get the cluster
+# information from it, and mbatchd goes last as it talks to sbatchd.
+operation_dependencies = {
+    'lim-restart': set(['lim-reconfig']),
+    'res-restart': set(['lim-reconfig', 'lim-restart']),
+    'sbd-restart': set(['lim-reconfig', 'lim-restart']),
+    'mbd-restart': set(['lim-reconfig', 'lim-restart', 'res-restart', 'sbd-restart']),
+    'mbd-reconfig': set(['lim-reconfig', 'lim-restart', 'res-restart', 'sbd-restart', 'mbd-restart']),
+}
+
+# Estimated seconds each operation disrupts the cluster for, used until the
+# cost model has measured it
+operation_costs = {
+    'lim-reconfig': 5,
+    'mbd-reconfig': 10,
+    'res-restart': 10,
+    'lim-restart': 30,
+    'sbd-restart': 60,
+    'mbd-restart': 300,
+}
+
+# Operations deferred by default to the maintenance window or a low load,
+# on all hosts only as the ones on given hosts are cheap
+expensive_operations = ['mbd-restart', 'sbd-restart']
+
+# Weekday names of the maintenance windows, in the order of tm_wday
+weekdays = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+# Suffixes of the copies left by editors and package managers, which are not
+# host names in a "{host}" glob
+backup_suffixes = ['bak', 'orig', 'old', 'save', 'swp', 'tmp', 'rej', 'rpmsave', 'rpmnew', 'rpmorig',
+                   'dpkg-old', 'dpkg-new', 'dpkg-dist']
+
+
+def default_rules():
+    # Rules equivalent to operation_map, also the sample of a rules file
+    lsf_conf = {
+        'default': sorted(operation_map['lsf.conf']['default']),
+        'parameters': dict((name, sorted(ops)) for name, ops in operation_map['lsf.conf'].items() if name != 'default'),
+    }
+    rules = [dict(lsf_conf, path='lsf.conf'), dict(lsf_conf, path='lsf.conf.{host}'), {
+        'path': 'lsf.cluster.{cluster}',
+        'operations': sorted(operation_map['lsf.cluster']),
+        'sections': dict((name, sorted(ops)) for name, ops in cluster_section_map.items()),
+    }]
+    for name in sorted(operation_map):
+        if name not in ('lsf.conf', 'lsf.cluster'):
+            # shared files are usually named after the including file, like lsb.queues.common
+            rules.append({'path': [name, name + '.*'], 'operations': sorted(operation_map[name])})
+    return {'rules': rules}
+
+
+def glob_to_regex(pattern, host_group='host'):
+    # "**" matches across directories, "*" and "?" do not, and "{host}" is
+    # captured as the host name. A host name is made of letters, digits, "-",
+    # "_" and "."; one ending with a backup suffix, like lsf.conf.host1.bak,
+    # is not matched.
+    host = r'(?!(?:[^/]*\.)?(?:%s)\Z)[A-Za-z0-9][\w.-]*' % '|'.join(re.escape(suffix) for suffix in backup_suffixes)
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('{host}', i):
+            regex += '(?P<%s>%s)' % (host_group, host)
+            i += len('{host}')
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and pattern.find(']', i + 2) > 0:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '[%s]' % chars
+            i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex + r'\Z'
+
+
+class OperationRules(object):
+    # Rules mapping a changed file to LSF operations. A rule has one or more
+    # path globs; a glob without "/" matches the file name in any directory,
+    # otherwise it matches the path relative to the repository root, and
+    # "{cluster}" stands for the cluster name. The first matching rule wins.
+    # A rule has either "operations", or "parameters" (parameter globs to
+    # operations) and "default" for parameter based files like lsf.conf.
+    # For the files of Begin/End sections, only the changed sections count,
+    # and "sections" maps a section name, or "<section>.<key>" for a key of
+    # it, to the operations taken instead of "operations".
+    # For a host specific file, "{host}" in the glob captures the host name
+    # and the operations of host_operations are only taken on that host.
+
+    def __init__(self, config, cluster=None):
+        self.rules = []
+        # literal globs are looked up in dicts, the others are compiled in
+        # one regex per kind so that the first matching alternative wins
+        self.literals = {'name': {}, 'path': {}}
+        globs = {'name': [], 'path': []}
+        for index, rule in enumerate(config.get('rules', [])):
+            compiled = self.compile_rule(rule)
+            self.rules.append(compiled)
+            paths = rule.get('path', [])
+            if not isinstance(paths, list):
+                paths = [paths]
+            for path in paths:
+                path = self.expand_cluster(path, cluster)
+                kind = 'path' if '/' in path else 'name'
+                if not re.search(r'[*?\[]|{host}', path):
+                    self.literals[kind].setdefault(path, index)
+                else:
+                    suffix = '%d_%d' % (index, len(globs[kind]))
+                    globs[kind].append('(?P<r%s>%s)' % (suffix, glob_to_regex(path, 'h' + suffix)))
+
+        self.globs = {}
+        for kind, patterns in globs.items():
+            self.globs[kind] = re.compile('|'.join(patterns)) if patterns else None
+        self.cache = {}
+
+    @staticmethod
+    def expand_cluster(path, cluster):
+        if cluster is None:
+            # any single path component
+            return path.replace('{cluster}', '*')
+        return path.replace('{cluster}', glob.escape(cluster))
+
+    @staticmethod
+    def compile_rule(rule):
+        compiled = {'operations': set(rule.get('operations', [])), 'parameters': None}
+        compiled['sections'] = dict((name, set(ops)) for name, ops in rule.get('sections', {}).items())
+        unknown = set(compiled['operations']).union(*compiled['sections'].values())
+        if 'parameters' in rule or 'default' in rule:
+            compiled['default'] = set(rule.get('default', []))
+            compiled['parameters'] = {}
+            compiled['parameter_globs'] = []
+            unknown |= compiled['default']
+            for name, ops in rule.get('parameters', {}).items():
+                unknown |= set(ops)
+                if re.search(r'[*?\[]', name):
+                    compiled['parameter_globs'].append((name, set(ops)))
+                else:
+                    compiled['parameters'][name] = set(ops)
+
+        unknown -= known_operations
+        if unknown:
+            raise ValueError('unknown operations %s in rule %s' % (sorted(unknown), rule.get('path')))
+        return compiled
+
+    def match(self, path):
+        # the rule for a path relative to the repository root, None if no rule
+        if path in self.cache:
+            return self.cache[path]
+
+        subjects = {'name': os.path.basename(path), 'path': path}
+        index = None
+        host = None
+        for kind, subject in subjects.items():
+            candidate = self.literals[kind].get(subject)
+            if candidate is not None and (index is None or candidate < index):
+                index, host = candidate, None
+            if self.globs[kind] is not None:
+                found = self.globs[kind].match(subject)
+                if found is not None:
+                    candidate = int(found.lastgroup[1:].split('_')[0])
+                    if index is None or candidate < index:
+                        index = candidate
+                        host_group = 'h' + found.lastgroup[1:]
+                        host = found.group(host_group) if host_group in found.re.groupindex else None
+
+        rule = None
+        if index is not None:
+            rule = dict(self.rules[index], host=host)
+        self.cache[path] = rule
+        return rule
+
+    @staticmethod
+    def parameter_operations(rule, param):
+        if param in rule['parameters']:
+            return rule['parameters'][param]
+        for pattern, ops in rule['parameter_globs']:
+            if fnmatch.fnmatchcase(param, pattern):
+                return ops
+        return rule['default']
+
+    @staticmethod
+    def section_operations(rule, section, keys):
+        # keys are the changed keys of the section, None for the whole section
+        default = rule['sections'].get(section, rule['operations'])
+        if keys is None:
+            return default
+        return set().union(*[rule['sections'].get('%s.%s' % (section, key), default) for key in keys])
+
+
+def load_rules(rules_file, cluster):
+    if rules_file is None:
+        return OperationRules(default_rules(), cluster)
+    with open(rules_file) as f:
+        return OperationRules(json.load(f), cluster)
+
+
+def detect_cluster_name(lsf_envdir):
+    # the cluster name is the suffix of the only lsf.cluster.<name> file
+    files = glob.glob(os.path.join(glob.escape(lsf_envdir), 'lsf.cluster.*'))
+    if len(files) != 1:
+        return None
+    return os.path.basename(files[0])[len('lsf.cluster.'):]
+
+
+operation_rules = OperationRules(default_rules())
+
 
 class Logger(object):
     level_relations = {
@@ -126,71 +395,857 @@ def signal_fun(signum, frame):
     exit(1)
 
 
-def execute(cmd):
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate()
+# Number of subprocesses and the wall time they took in the current poll
+# cycle, and the name of the cluster the cycle is for in controller mode
+cycle_stats = contextvars.ContextVar('cycle_stats', default=None)
+cycle_cluster = contextvars.ContextVar('cycle_cluster', default=None)
+
+# Numbers of the poll cycles in the trace spans, and the Tracer if --trace
+# is given
+trace_cycles = itertools.count(1)
+tracer = None
+execute_lock = threading.Lock()
+
+# git subcommands reaching the upstream, whose failures back off the polls
+transport_commands = set(['fetch', 'ls-remote'])
+
+# lsf.conf parameter assignment such as "LSB_DEBUG_MBD = LC_TRACE"
+lsf_conf_param_pattern = re.compile(r'^(\w+)\s*=(.*)$')
+
+# Parsed lsf.conf snapshots keyed by blob SHA
+lsf_conf_cache = {}
+
+# Lines of the files made of Begin/End sections, and the parsed section
+# snapshots keyed by blob SHA
+section_pattern = re.compile(r'^(Begin|End)\s+(\S+)', re.IGNORECASE)
+section_key_pattern = re.compile(r'^(\w+)\s*=\s*(.*)$')
+include_pattern = re.compile(r'^#INCLUDE\s+"?([^"]*)"?', re.IGNORECASE)
+section_cache = {}
+
+# #INCLUDE lines in any file, and the paths included by a blob keyed by SHA
+include_line_pattern = re.compile(rb'^[ \t]*#INCLUDE[ \t]+"?([^"\r\n]*)"?', re.IGNORECASE | re.MULTILINE)
+include_cache = {}
+
+# Upstream state for each monitored repository: the url and ref tracked by
+# the current branch, and the ref SHA seen there by the last finished cycle
+upstream_state = {}
+
+# ObjectCache shared by the shared repositories, None if not used
+object_cache = None
+
+# Repository backend of each repository directory, and the kind of backend
+# given by --git_backend
+repositories = {}
+git_backend = 'native'
+
+# Git directory of each repository directory, where the tool state such as
+# the checkpoint, the cost model and deferred operations is kept
+git_dirs = {}
+
+# Commits of history fetched by --depth, 0 for the full history, and the
+# worktree paths of --sparse, None for the whole worktree
+fetch_depth = 0
+sparse_paths = None
+sparse_repos = set()
+
+# Metrics of the subprocesses, poll cycles and LSF operations
+metrics = Metrics('lsf_git')
+metrics.describe('execute_seconds', 'histogram', 'Seconds taken by the external commands.')
+metrics.describe('poll_cycle_seconds', 'histogram', 'Seconds taken by the poll cycles.')
+metrics.describe('commit_applied_seconds', 'histogram', 'Seconds from the commit time to the LSF operations finished.')
+metrics.describe('operations_total', 'counter', 'LSF operations by result.')
+
+
+def metric_labels(**labels):
+    # labels of a metric, with the cluster of the cycle in controller mode
+    cluster = cycle_cluster.get()
+    if cluster is not None:
+        labels['cluster'] = cluster
+    return labels
+
+
+def execute(cmd, timeout=None, cwd=None, env=None, input=None):
+    start = time.time()
+    stdin = subprocess.PIPE if input is not None else None
+    proc = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, env=env)
+    try:
+        out, err = proc.communicate(input=input, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        out, err = proc.communicate()
+        err += ('Timed out after %s seconds' % timeout).encode('utf8')
     ret = proc.returncode
-    return ret, out.decode('utf8'), err.decode('utf8')
+    elapsed = time.time() - start
+    if tracer is not None:
+        tracer.record('execute', start, elapsed, argv=cmd, ret=ret, out_bytes=len(out), err_bytes=len(err))
+    metrics.observe('execute_seconds', metric_labels(command=command_label(cmd)), elapsed)
+    stats = cycle_stats.get()
+    if stats is not None:
+        with execute_lock:
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            # the repository directories where git failed to reach the upstream,
+            # None for git -C. Failed local commands, such as a rev-parse probe
+            # or a merge refused before deepening, are not failed polls.
+            if ret != 0 and cmd[0] == 'git' and git_subcommand(cmd) in transport_commands:
+                stats['failed'].add(cwd)
+    # blobs of any encoding are kept, see CliRepository
+    return ret, out.decode('utf8', 'surrogateescape'), err.decode('utf8', 'replace')
+
+
+def get_upstream(repo_dir):
+    state = upstream_state.get(repo_dir)
+    if state is not None:
+        return state
+
+    state = {'url': None, 'ref': None, 'sha': None, 'remote': None}
+    upstream_state[repo_dir] = state
+
+    cmd = ['git', 'symbolic-ref', '-q', 'HEAD']
+    ret, out, err = execute(cmd, cwd=repo_dir)
+    if ret != 0:
+        logging.warning('Cannot get current branch of %s, upstream changes will not be probed.' % repo_dir)
+        return state
+    branch = out.strip()[len('refs/heads/'):]
+
+    cmd = ['git', 'config', '--get', 'branch.%s.remote' % branch]
+    ret, remote, err = execute(cmd, cwd=repo_dir)
+    cmd = ['git', 'config', '--get', 'branch.%s.merge' % branch]
+    ret_merge, ref, err = execute(cmd, cwd=repo_dir)
+    if ret != 0 or ret_merge != 0:
+        logging.warning('Branch %s of %s has no upstream, upstream changes will not be probed.' % (branch, repo_dir))
+        return state
+
+    cmd = ['git', 'config', '--get', 'remote.%s.url' % remote.strip()]
+    ret, url, err = execute(cmd, cwd=repo_dir)
+    if ret != 0:
+        logging.warning('Cannot get url of remote %s for %s.' % (remote.strip(), repo_dir))
+        return state
+
+    state['url'] = url.strip()
+    state['ref'] = ref.strip()
+    state['remote'] = remote.strip()
+    return state
+
+
+def local_git_dir(url, repo_dir):
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    path = os.path.join(repo_dir, url)
+    if not os.path.isdir(path):
+        return None
+    if os.path.isdir(os.path.join(path, '.git')):
+        path = os.path.join(path, '.git')
+    return path
+
+
+def read_ref(git_dir, ref):
+    # loose ref firstly, then the packed one
+    try:
+        with open(os.path.join(git_dir, ref)) as f:
+            value = f.read().strip()
+        if value.startswith('ref: '):
+            return read_ref(git_dir, value[len('ref: '):])
+        return value
+    except (IOError, OSError):
+        pass
+
+    try:
+        with open(os.path.join(git_dir, 'packed-refs')) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def probe_upstream(repo_dir):
+    # Return the SHA of the upstream ref. For an upstream on the local file
+    # system the ref is read directly, otherwise one ls-remote is needed.
+    state = get_upstream(repo_dir)
+    if state['url'] is None:
+        return None
+
+    git_dir = local_git_dir(state['url'], repo_dir)
+    if git_dir is not None:
+        return read_ref(git_dir, state['ref'])
+
+    cmd = ['git', 'ls-remote', state['url'], state['ref']]
+    ret, out, err = execute(cmd, cwd=repo_dir)
+    if ret != 0:
+        logging.warning('Failed to probe %s of %s, due to %s.' % (state['ref'], state['url'], err))
+        return None
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1] == state['ref']:
+            return fields[0]
+    return None
+
+
+class ObjectCache(object):
+    # A local bare repository for each upstream of shared repositories. It is
+    # fetched at most once every max_age seconds, whatever the number of
+    # clusters sharing it, and the shared repositories borrow its objects
+    # through git alternates, so that updating them is a local fast-forward.
+
+    def __init__(self, cache_dir, max_age):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # per upstream: lock, last fetch time and whether the last fetch succeeded
+        self.caches = {}
+        self.attached = set()
+
+    def cache_path(self, upstream):
+        return os.path.join(self.cache_dir, hashlib.sha1(upstream.encode('utf8')).hexdigest()[:16] + '.git')
+
+    def fetch(self, upstream):
+        with self.lock:
+            cache = self.caches.setdefault(upstream, {'lock': threading.Lock(), 'time': 0, 'ok': False})
+
+        path = self.cache_path(upstream)
+        with cache['lock']:
+            if time.time() - cache['time'] < self.max_age:
+                return cache['ok']
+
+            if not os.path.isdir(path):
+                # objects borrowed by the shared repositories must never be pruned
+                for cmd in (['git', 'init', '--quiet', '--bare', path],
+                            ['git', '-C', path, 'config', 'gc.auto', '0'],
+                            ['git', '-C', path, 'config', 'gc.pruneExpire', 'never']):
+                    ret, out, err = execute(cmd)
+                    if ret != 0:
+                        logging.error('Failed to create object cache %s, due to %s.' % (path, err))
+                        return False
+
+            cmd = ['git', '-C', path, 'fetch', '--quiet', '--prune', upstream, '+refs/heads/*:refs/heads/*']
+            ret, out, err = execute(cmd)
+            cache['time'] = time.time()
+            cache['ok'] = ret == 0
+            if ret != 0:
+                logging.error('Failed to fetch %s into object cache, due to %s.' % (upstream, err))
+            return cache['ok']
+
+    def attach(self, repo_dir, upstream):
+        # make the repository borrow objects from the cache of its upstream
+        if repo_dir in self.attached:
+            return True
+        alternates = os.path.join(repo_dir, '.git', 'objects', 'info', 'alternates')
+        objects = os.path.join(self.cache_path(upstream), 'objects')
+        try:
+            lines = []
+            if os.path.exists(alternates):
+                with open(alternates) as f:
+                    lines = f.read().splitlines()
+            if objects not in lines:
+                os.makedirs(os.path.dirname(alternates), exist_ok=True)
+                with open(alternates, 'a') as f:
+                    f.write(objects + '\n')
+        except (IOError, OSError) as e:
+            logging.error('Failed to attach %s to object cache, due to %s.' % (repo_dir, e))
+            return False
+        self.attached.add(repo_dir)
+        return True
+
+    def upstream(self, repo_dir):
+        # the upstream key of a repository, local paths are made absolute
+        state = get_upstream(repo_dir)
+        if state['url'] is None:
+            return None
+        return local_git_dir(state['url'], repo_dir) or state['url']
+
+    def probe(self, repo_dir):
+        # the upstream ref SHA as fetched in the cache
+        upstream = self.upstream(repo_dir)
+        if upstream is None or not self.fetch(upstream) or not self.attach(repo_dir, upstream):
+            return None
+        return read_ref(self.cache_path(upstream), get_upstream(repo_dir)['ref'])
+
+    def update(self, repo_dir):
+        # fast-forward the repository to the upstream ref in the cache
+        upstream = self.upstream(repo_dir)
+        if upstream is None:
+            return False
+        cmd = ['git', 'fetch', '--quiet', '--no-tags', self.cache_path(upstream), get_upstream(repo_dir)['ref']]
+        ret, out, err = execute(cmd, cwd=repo_dir)
+        if ret != 0:
+            logging.error('Failed to run %s in %s, due to %s.' % (cmd, repo_dir, err))
+            return False
+        return fast_forward(repo_dir)
+
+
+def configure_sparse(repo_dir):
+    # restrict the worktree to the --sparse paths, once for each repository
+    if sparse_paths is None or repo_dir in sparse_repos:
+        return True
+    cmd = ['git', 'sparse-checkout', 'set', '--no-cone'] + sparse_paths
+    ret, out, err = execute(cmd, cwd=repo_dir)
+    if ret != 0:
+        logging.error('Failed to set sparse checkout of %s, due to %s.' % (repo_dir, err))
+        return False
+    sparse_repos.add(repo_dir)
+    return True
+
+
+def fast_forward(repo_dir):
+    # Fast-forward the worktree to FETCH_HEAD, never merge. If it is not
+    # possible, HEAD is either beyond the history of a shallow fetch, which is
+    # deepened until HEAD is found, or diverged from the upstream, which is
+    # refused.
+    deepen = max(fetch_depth, 1)
+    while True:
+        cmd = ['git', 'merge', '--quiet', '--ff-only', 'FETCH_HEAD']
+        ret, out, err = execute(cmd, cwd=repo_dir)
+        if ret == 0:
+            return True
+
+        cmd = ['git', 'rev-list', '--count', 'FETCH_HEAD..HEAD']
+        ret, out, err_count = execute(cmd, cwd=repo_dir)
+        if ret != 0 or out.strip() == '0':
+            logging.error('Failed to fast-forward %s, due to %s.' % (repo_dir, err))
+            return False
+
+        if not is_shallow(repo_dir):
+            logging.error('%s has %s commits not in its upstream, refusing to merge them. '
+                          'Push them or reset the branch to the upstream.' % (repo_dir, out.strip()))
+            return False
+
+        cmd = ['git', 'fetch', '--quiet', '--no-tags', '--deepen=%d' % deepen] + upstream_refspec(repo_dir)
+        ret, out, err = execute(cmd, cwd=repo_dir)
+        if ret != 0:
+            logging.error('Failed to deepen the history of %s, due to %s.' % (repo_dir, err))
+            return False
+        deepen *= 2
+
+
+def is_shallow(repo_dir):
+    path = git_dir(repo_dir)
+    return path is not None and os.path.exists(os.path.join(path, 'shallow'))
 
 
-def git_manager_shared(shared_envdir, log):
+def upstream_refspec(repo_dir):
+    # the remote and the refspec fetching only the tracked branch, also
+    # updating its remote-tracking branch
+    state = get_upstream(repo_dir)
+    tracking = 'refs/remotes/%s/%s' % (state['remote'], state['ref'][len('refs/heads/'):])
+    return [state['remote'], '+%s:%s' % (state['ref'], tracking)]
+
+
+def update_worktree(repo_dir):
+    # Fetch only the branch tracked by the worktree and fast-forward to it.
+    # With fetch_depth, a full repository is made shallow by the first fetch,
+    # and the fetches of a shallow one only bring the new commits.
+    state = get_upstream(repo_dir)
+    if state['url'] is None:
+        logging.error('%s has no upstream branch to update from.' % repo_dir)
+        return False
+    if not configure_sparse(repo_dir):
+        return False
+
+    cmd = ['git', 'fetch', '--quiet', '--no-tags']
+    if fetch_depth > 0 and not is_shallow(repo_dir):
+        cmd += ['--depth', str(fetch_depth)]
+    cmd += upstream_refspec(repo_dir)
+    ret, out, err = execute(cmd, cwd=repo_dir)
+    if ret != 0:
+        logging.error('Failed to fetch %s of %s, due to %s.' % (state['ref'], state['url'], err))
+        return False
+    return fast_forward(repo_dir)
+
+
+def create_watcher(repo_dirs, socket_path):
+    # watch the refs of upstream repositories on the local file system
+    ref_files = []
+    for repo_dir in repo_dirs:
+        state = get_upstream(repo_dir)
+        if state['url'] is None:
+            continue
+        git_dir = local_git_dir(state['url'], repo_dir)
+        if git_dir is None:
+            logging.warning('Upstream %s of %s is not local, it cannot be watched.' % (state['url'], repo_dir))
+            continue
+        ref_files.append((git_dir, state['ref']))
+
+    return RefWatcher(ref_files, socket_path)
+
+
+def git_dir(repo_dir):
+    path = git_dirs.get(repo_dir)
+    if path is None:
+        cmd = ['git', 'rev-parse', '--absolute-git-dir']
+        ret, out, err = execute(cmd, cwd=repo_dir)
+        if ret != 0:
+            logging.warning('Cannot find git directory of %s, due to %s.' % (repo_dir, err))
+            return None
+        path = out.strip()
+        git_dirs[repo_dir] = path
+    return path
+
+
+def state_path(repo_dir, name):
+    path = git_dir(repo_dir)
+    if path is None:
+        return None
+    return os.path.join(path, 'lsf-git-ops', name)
+
+
+def write_state(path, state):
+    # replace a state file at once, so a crash leaves the old or the new one
+    tmp = path + '.tmp'
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=4, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except (IOError, OSError) as e:
+        logging.warning('Cannot write %s: %s.' % (path, e))
+
+
+def read_checkpoint(repo_dir):
+    # the last commit whose LSF operations were applied, None if unknown
+    path = state_path(repo_dir, 'checkpoint.json')
+    if path is None:
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)['commit']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_checkpoint(repo_dir, commit_id):
+    path = state_path(repo_dir, 'checkpoint.json')
+    if path is None or commit_id is None:
+        return
+    write_state(path, {'commit': commit_id, 'time': time.time()})
+
+
+def applied_commit(repo_dir, commit_id):
+    # The commit to take the changes since: the last applied one, so the
+    # changes pulled but not applied before a failure or a restart are not
+    # lost, or the current one if there is no checkpoint readable
+    checkpoint = read_checkpoint(repo_dir)
+    if checkpoint is None or checkpoint == commit_id:
+        return commit_id
+    if repository(repo_dir).commit(checkpoint) is None:
+        logging.warning('Applied commit %s of %s cannot be read, taking the changes since %s.' % (checkpoint, repo_dir, commit_id))
+        return commit_id
+    logging.info('Taking the changes of %s since applied commit %s.' % (repo_dir, checkpoint))
+    return checkpoint
+
+
+def is_upstream_changed(repo_dir, remote_sha):
+    if remote_sha is None or remote_sha != get_upstream(repo_dir)['sha']:
+        return True
+    # the changes pulled but not applied, such as after a failed operation,
+    # are taken again until they are applied
+    checkpoint = read_checkpoint(repo_dir)
+    return checkpoint is not None and checkpoint != repository(repo_dir).head()
+
+
+def repository(repo_dir):
+    # the repository backend of a directory, the in-process one unless the
+    # git command line is chosen by --git_backend or the repository is not supported
+    repo = repositories.get(repo_dir)
+    if repo is None:
+        repo = repositories[repo_dir] = open_repository(repo_dir, git_backend, execute)
+    return repo
+
+
+def diff_tree(repo_dir, old_commit, new_commit):
+    # Return (path, old blob SHA, new blob SHA) for each changed file. The
+    # SHA of a file missing on one side is NULL_SHA.
+    return repository(repo_dir).diff(old_commit, new_commit)
+
+
+def parse_lsf_conf(text):
+    # Parse lsf.conf content into a dict of parameter to value. Comment and
+    # blank lines are skipped, a backslash at the end of line continues the
+    # value on the next line, and a value may be single or double quoted.
+    params = {}
+    logical = ''
+    for line in text.splitlines():
+        if not logical and line.lstrip().startswith('#'):
+            continue
+        if line.endswith('\\'):
+            logical += line[:-1]
+            continue
+        logical += line
+        line, logical = logical.strip(), ''
+
+        match = lsf_conf_param_pattern.match(line)
+        if match is None:
+            continue
+        name, value = match.group(1), match.group(2).strip()
+        if value[:1] in ('"', "'"):
+            end = value.find(value[0], 1)
+            value = value[1:] if end < 0 else value[1:end]
+        else:
+            # an unquoted value ends at a trailing comment
+            value = re.split(r'\s+#', value, 1)[0]
+        params[name] = value.strip()
+    return params
+
+
+def lsf_conf_snapshot(repo_dir, blob_sha):
+    # Parameters of an lsf.conf blob, None if the blob cannot be read
+    if blob_sha == NULL_SHA:
+        return {}
+    if blob_sha in lsf_conf_cache:
+        return lsf_conf_cache[blob_sha]
+
+    data = repository(repo_dir).blob(blob_sha)
+    if data is None:
+        return None
+
+    params = parse_lsf_conf(data.decode('utf8', 'replace'))
+    lsf_conf_cache[blob_sha] = params
+    return params
+
+
+def section_line(line):
+    # A line of a section file with the comment at its end removed and the
+    # spaces out of quotes collapsed, so they make no difference. A quote
+    # starts a quoted value only at the start of a word, like in "Joe's".
+    words = []
+    quote = None
+    for i, char in enumerate(line):
+        if quote is not None:
+            words.append(char)
+            if char == quote:
+                quote = None
+        elif char.isspace():
+            if len(words) > 0 and words[-1] != ' ':
+                words.append(' ')
+        elif char == '#' and (i == 0 or line[i - 1].isspace()):
+            break
+        else:
+            if char in ('"', "'") and (i == 0 or line[i - 1].isspace() or line[i - 1] in '=('):
+                quote = char
+            words.append(char)
+    return ''.join(words).strip()
+
+
+def section_content(section, lines, counts):
+    # The key and the content of a section: a dict for "KEY = value" lines,
+    # keyed by the first *NAME value, otherwise the tuple of the lines, keyed
+    # by its position among the sections of the same name
+    pairs = [section_key_pattern.match(line) for line in lines if not line.startswith('#INCLUDE')]
+    if len(pairs) > 0 and all(pairs):
+        content = dict(match.groups() for match in pairs)
+        includes = tuple(line for line in lines if line.startswith('#INCLUDE'))
+        if includes:
+            content['#INCLUDE'] = includes
+        names = [match.group(2) for match in pairs if match.group(1).endswith('NAME')]
+        if names:
+            return '%s %s' % (section, names[0]), content
+    else:
+        content = tuple(lines)
+    counts[section] = counts.get(section, 0) + 1
+    return '%s #%d' % (section, counts[section]), content
+
+
+def parse_sections(text):
+    # Parse the content of a file made of "Begin <Section>" / "End <Section>"
+    # blocks, such as lsb.queues or lsf.cluster.<name>, into a dict of
+    # section key to (section name, content). Comments, blank lines and the
+    # spaces out of quotes make no difference. #INCLUDE lines are kept, under
+    # the "#INCLUDE" key when out of sections, and the other lines out of
+    # sections are kept under the "" key.
+    model = {}
+    counts = {}
+    section = None
+    lines = []
+    outside = {'#INCLUDE': [], '': []}
+    logical = ''
+    for line in text.splitlines():
+        include = not logical and include_pattern.match(line.strip())
+        if not logical and not include and line.lstrip().startswith('#'):
+            continue
+        if line.endswith('\\'):
+            logical += line[:-1] + ' '
+            continue
+        if include:
+            line, logical = '#INCLUDE "%s"' % include.group(1).strip(), ''
+        else:
+            line, logical = section_line(logical + line), ''
+        if not line:
+            continue
+
+        match = section_pattern.match(line)
+        if section is None:
+            if match is not None and match.group(1).lower() == 'begin':
+                section, lines = match.group(2), []
+            else:
+                outside['#INCLUDE' if include else ''].append(line)
+        elif match is not None and match.group(1).lower() == 'end':
+            key, content = section_content(section, lines, counts)
+            model[key] = (section, content)
+            section = None
+        else:
+            lines.append(line)
+
+    # an unterminated section is kept as it is
+    if section is not None:
+        key, content = section_content(section, lines, counts)
+        model[key] = (section, content)
+    for key, lines in outside.items():
+        if lines:
+            model[key] = (key, tuple(lines))
+    return model
+
+
+def section_snapshot(repo_dir, blob_sha):
+    # Sections of a blob, None if the blob cannot be read
+    if blob_sha == NULL_SHA:
+        return {}
+    if blob_sha in section_cache:
+        return section_cache[blob_sha]
+
+    data = repository(repo_dir).blob(blob_sha)
+    if data is None:
+        return None
+
+    model = parse_sections(data.decode('utf8', 'replace'))
+    section_cache[blob_sha] = model
+    return model
+
+
+def changed_sections(old_model, new_model):
+    # (section name, changed keys) of the sections added, removed or changed,
+    # the keys are None unless both sides are "KEY = value" sections
+    changes = []
+    for key in sorted(set(old_model) | set(new_model)):
+        old_section, old_content = old_model.get(key, (None, {}))
+        new_section, new_content = new_model.get(key, (None, {}))
+        if old_content == new_content:
+            continue
+        keys = None
+        if isinstance(old_content, dict) and isinstance(new_content, dict):
+            keys = sorted(name for name in set(old_content) | set(new_content)
+                          if old_content.get(name) != new_content.get(name))
+        changes.append((new_section or old_section, keys))
+    return changes
+
+
+def changed_parameters(old_params, new_params):
+    # parameters added, removed or set to another value
+    names = set(old_params) | set(new_params)
+    return sorted(name for name in names if old_params.get(name) != new_params.get(name))
+
+
+def file_operations(repo_dir, rules, file, old_sha, new_sha, rule=None):
+    # Operations needed for a changed file, None if they cannot be determined.
+    # rule is the one of the file unless given, such as the rule of the file
+    # including a shared file.
+    if rule is None:
+        rule = rules.match(file)
+    if rule is None:
+        logging.debug('There is no operation rule for %s.' % file)
+        return set()
+
+    if rule['parameters'] is None:
+        operations = rule['operations']
+        old_model = section_snapshot(repo_dir, old_sha)
+        new_model = section_snapshot(repo_dir, new_sha)
+        if old_model is None or new_model is None:
+            return None
+
+        # only the changed sections count in the files of Begin/End sections
+        if any(name not in ('', '#INCLUDE') for name in list(old_model) + list(new_model)):
+            operations = set()
+            for section, keys in changed_sections(old_model, new_model):
+                logging.debug('The section %s of %s is changed%s.'
+                              % (section or 'out of sections', file, ' in %s' % ', '.join(keys) if keys else ''))
+                operations = operations.union(rules.section_operations(rule, section, keys))
+    else:
+        # parameter based rule, like the one for lsf.conf
+        old_params = lsf_conf_snapshot(repo_dir, old_sha)
+        new_params = lsf_conf_snapshot(repo_dir, new_sha)
+        if old_params is None or new_params is None:
+            return None
+
+        operations = set()
+        for param in changed_parameters(old_params, new_params):
+            logging.debug('The parameter %s is changed.' % param)
+            operations = operations.union(rules.parameter_operations(rule, param))
+
+    if rule['host'] is not None:
+        operations = set(op + '@' + rule['host'] if op in host_operations else op for op in operations)
+    return operations
+
+
+def included_paths(repo_dir, blob_sha):
+    # paths in the #INCLUDE lines of a blob
+    if blob_sha in include_cache:
+        return include_cache[blob_sha]
+    data = repository(repo_dir).blob(blob_sha)
+    if data is None:
+        return []
+    paths = [path.decode('utf8', 'replace').strip() for path in include_line_pattern.findall(data)]
+    include_cache[blob_sha] = paths
+    return paths
+
+
+class IncludeGraph(object):
+    # The #INCLUDE lines of the files in the private and shared repositories
+    # of a cluster, as the edges from each (repo_dir, path) file to the files
+    # it includes. A repository is read from HEAD when first needed, then only
+    # the changed files are read again.
+
+    def __init__(self, lsf_envdir, shared_envdir):
+        self.lsf_envdir = lsf_envdir
+        self.roots = [(repo_dir, os.path.realpath(repo_dir)) for repo_dir in (lsf_envdir, shared_envdir)]
+        self.includes = {}
+        self.included_by = {}
+        self.built = set()
+
+    def resolve(self, repo_dir, path, target):
+        # the file of an included path, None if out of the repositories
+        if not os.path.isabs(target):
+            target = os.path.join(repo_dir, os.path.dirname(path), target)
+        target = os.path.realpath(target)
+        for root_dir, root in self.roots:
+            if target.startswith(root + os.sep):
+                return root_dir, os.path.relpath(target, root)
+        return None
+
+    def set_file(self, repo_dir, path, blob_sha):
+        node = (repo_dir, path)
+        for target in self.includes.pop(node, set()):
+            self.included_by[target].discard(node)
+        if blob_sha == NULL_SHA:
+            return
+        targets = set(filter(None, [self.resolve(repo_dir, path, target) for target in included_paths(repo_dir, blob_sha)]))
+        if targets:
+            self.includes[node] = targets
+            for target in targets:
+                self.included_by.setdefault(target, set()).add(node)
+
+    def build(self, repo_dir):
+        if repo_dir in self.built:
+            return True
+        files = repository(repo_dir).files('HEAD')
+        if files is None:
+            return False
+        for path, blob_sha in files:
+            self.set_file(repo_dir, path, blob_sha)
+        self.built.add(repo_dir)
+        return True
+
+    def update(self, repo_dir, changes):
+        # a repository not read yet is read from HEAD when needed
+        if repo_dir in self.built:
+            for path, old_sha, new_sha in changes:
+                self.set_file(repo_dir, path, new_sha)
+
+    def including(self, repo_dir, path, local_dir):
+        # the files of local_dir including a file, directly or through other files
+        found = set()
+        seen = set()
+        todo = [(repo_dir, path)]
+        while todo:
+            for includer in self.included_by.get(todo.pop(), set()):
+                if includer not in seen:
+                    seen.add(includer)
+                    todo.append(includer)
+                    if includer[0] == local_dir:
+                        found.add(includer[1])
+        return sorted(found)
+
+
+def shared_file_operations(shared_envdir, rules, graph, file, old_sha, new_sha):
+    # Operations needed for a changed shared file, the ones of the local files
+    # including it as if the included content changed in them, None if they
+    # cannot be determined. Without an IncludeGraph, the file takes the
+    # operations of its own rule.
+    if graph is None:
+        return file_operations(shared_envdir, rules, file, old_sha, new_sha)
+
+    including = graph.including(shared_envdir, file, graph.lsf_envdir)
+    if len(including) == 0:
+        logging.debug('For shared LSF configuration, %s is not included by %s.' % (file, graph.lsf_envdir))
+        return set()
+    logging.debug('For shared LSF configuration, %s is included by %s.' % (file, ', '.join(including)))
+
     operations = set()
-    # 1. change dir to sub
-    os.chdir(shared_envdir)
+    for local_file in including:
+        rule = rules.match(local_file)
+        if rule is None:
+            continue
+        file_ops = file_operations(shared_envdir, rules, file, old_sha, new_sha, rule)
+        if file_ops is None:
+            return None
+        operations = operations.union(file_ops)
+    return operations
 
-    # 2. get current commit id
-    cmd = ['git', 'log', '--pretty=format:%H', '-1']
-    ret, out, err = execute(cmd)
-    if ret is not 0:
-        logging.error('For shared LSF configuration,executing %s failed.' % cmd)
-        return None, operations
 
-    commit_id = out.split('\n')
-    if len(commit_id) <= 0:
-        logging.warning('For shared LSF configuration,cannot get current commit id from git log output <%s>.' % out)
-        return None, operations
+def git_manager_shared(shared_envdir, log, rules=None, graph=None):
+    operations = set()
+    rules = rules or operation_rules
 
-    # 3. pull repo to update the directory
-    cmd = ['git', 'pull']
-    ret, out, err = execute(cmd)
-    if ret is not 0:
+    # 1. skip the cycle if nothing was pushed since the last one
+    if object_cache is not None:
+        remote_sha = object_cache.probe(shared_envdir)
+    else:
+        remote_sha = probe_upstream(shared_envdir)
+    if not is_upstream_changed(shared_envdir, remote_sha):
+        logging.debug('For shared LSF configuration, upstream is not changed.')
         return None, operations
 
-    # 4. get operations for changed files
-    cmd = ['git', 'diff', '--name-only', commit_id[0], 'HEAD']
-    ret, out, err = execute(cmd)
-    if ret is not 0:
+    # 2. get current commit id
+    commit_id = repository(shared_envdir).head()
+    if commit_id is None:
+        logging.warning('For shared LSF configuration,cannot get current commit id.')
+        return None, operations
+    applied_id = applied_commit(shared_envdir, commit_id)
+    if read_checkpoint(shared_envdir) is None:
+        # the commit before the first pull is the applied one, so the changes
+        # pulled are taken again until applied, even across a restart
+        write_checkpoint(shared_envdir, applied_id)
+
+    # 3. fast-forward repo to the upstream, from the object cache if any
+    if object_cache is not None:
+        if not object_cache.update(shared_envdir):
+            return None, operations
+    elif not update_worktree(shared_envdir):
         return None, operations
 
+    # 4. get operations for changed files since the applied commit
+    head_id = repository(shared_envdir).head()
+    changes = diff_tree(shared_envdir, applied_id, head_id) if head_id else None
+    if changes is None:
+        return None, operations
+    get_upstream(shared_envdir)['sha'] = remote_sha
 
-    files = out.split('\n')
-    if len(files) == 0 or len(files[0]) == 0:
+    files = [path for path, old_sha, new_sha in changes]
+    if len(files) == 0:
         logging.debug('For shared LSF configuration, there is no diff comparing with previous git status.')
+        write_checkpoint(shared_envdir, head_id)
         return None,operations
 
-    message = 'For shared LSF configuration, current commit id is %s and updated files are %s.' %(commit_id[0] , files)
+    message = 'For shared LSF configuration, current commit id is %s and updated files are %s.' %(commit_id , files)
     if log is None:
         logging.info(message)
     else:
         log.logger.info(message)
 
-    for file in files:
-        if file == '':
-            continue
+    # the local files including the changed ones are found in the IncludeGraph if any
+    if graph is not None:
+        graph.update(shared_envdir, changes)
+        if not graph.build(graph.lsf_envdir) or not graph.build(shared_envdir):
+            return None, operations
 
-        name = os.path.basename(file)
-        if file.find('lsb.applications'):
-            operations = operations.union(operation_map['lsb.applications'])
-        elif file.find('lsb.queues'):
-             operations = operations.union(operation_map['lsb.queues'])
-        elif file.find('lsb.hosts'):
-             operations = operations.union(operation_map['lsb.hosts'])
-        elif file.find('lsb.resources'):
-             operations = operations.union(operation_map['lsb.resources'])
-        elif file.find('lsb.users'):
-             operations = operations.union(operation_map['lsb.users'])
-        elif file.find('lsf.shared'):
-             operations = operations.union(operation_map['lsf.shared'])
+    for file, old_sha, new_sha in changes:
+        file_ops = shared_file_operations(shared_envdir, rules, graph, file, old_sha, new_sha)
+        if file_ops is None:
+            return None, operations
+        operations = operations.union(file_ops)
 
     message = 'For shared LSF configuration, determined operations are %s.' % operations
     if log is None:
@@ -198,82 +1253,64 @@ def git_manager_shared(shared_envdir, log):
     else:
         log.logger.info(message)
 
-    return commit_id[0], operations
+    # nothing to apply, the changes are applied as they are
+    if len(operations) == 0:
+        write_checkpoint(shared_envdir, head_id)
 
+    return commit_id, operations
 
-def git_manager_private(lsf_envdir, log):
-    operations = set()
 
-    # 0. change dir to lsf_envdir
-    os.chdir(lsf_envdir)
+def git_manager_private(lsf_envdir, log, rules=None, graph=None):
+    operations = set()
+    rules = rules or operation_rules
 
-    # 1. get current commit id
-    cmd = ['git', 'log', '--pretty=format:%H', '-1']
-    ret, out, err = execute(cmd)
-    if ret is not 0:
-        logging.error('Failed executing %s ' % cmd)
+    # 1. skip the cycle if nothing was pushed since the last one
+    remote_sha = probe_upstream(lsf_envdir)
+    if not is_upstream_changed(lsf_envdir, remote_sha):
+        logging.debug('Upstream is not changed.')
         return None, operations
 
-    commit_id = out.split('\n')
-    if len(commit_id) <= 0:
-        logging.warning('Cannot get current commit id from git log output <%s>.' % out)
+    # 2. get current commit id
+    commit_id = repository(lsf_envdir).head()
+    if commit_id is None:
+        logging.warning('Cannot get current commit id.')
         return None, operations
-
-    # 2. pull repo to update the directory
-    cmd = ['git', 'pull']
-    ret, out, err = execute(cmd)
-    if ret is not 0:
+    applied_id = applied_commit(lsf_envdir, commit_id)
+    if read_checkpoint(lsf_envdir) is None:
+        # the commit before the first pull is the applied one, so the changes
+        # pulled are taken again until applied, even across a restart
+        write_checkpoint(lsf_envdir, applied_id)
+
+    # 3. fast-forward repo to the upstream
+    if not update_worktree(lsf_envdir):
         return None, operations
 
-    # 3. get operations for changed files
-    cmd = ['git', 'diff', '--name-only', commit_id[0], 'HEAD']
-    ret, out, err = execute(cmd)
-    if ret is not 0:
+    # 4. get operations for changed files since the applied commit
+    head_id = repository(lsf_envdir).head()
+    changes = diff_tree(lsf_envdir, applied_id, head_id) if head_id else None
+    if changes is None:
         return None, operations
+    if graph is not None:
+        graph.update(lsf_envdir, changes)
+    get_upstream(lsf_envdir)['sha'] = remote_sha
 
-    files = out.split('\n')
-    if len(files) == 0 or len(files[0]) == 0:
+    files = [path for path, old_sha, new_sha in changes]
+    if len(files) == 0:
         logging.debug('There is no diff comparing with previous git status.')
+        write_checkpoint(lsf_envdir, head_id)
         return None, operations
 
-    message = 'Current commit id is %s and updated files are %s.' %(commit_id[0], files)
+    message = 'Current commit id is %s and updated files are %s.' %(commit_id, files)
     if log is None:
         logging.info(message)
     else:
         log.logger.info(message)
 
-    for file in files:
-        if file == '':
-            continue
-
-        if file.startswith('lsf.cluster.'):
-            file = 'lsf.cluster'
-
-        name = os.path.basename(file)
-        if name == 'lsf.conf':
-            # for lsf.conf, it needs to be checked parameter based
-            cmd = ['git', 'diff', '--unified=0', commit_id[0], 'HEAD']
-            ret, out, err = execute(cmd)
-            if ret is not 0:
-                return None,operations
-
-            lines = out.splitlines()
-            for line in lines:
-                kv = re.findall(r'^[+-]\w+=', line)
-                if len(kv) <= 0:
-                    continue
-                param = kv[0][1:-1]
-
-                logging.debug('The parameter %s is changed.' % param)
-
-                if param in operation_map[name]:
-                    op = operation_map[name][param]
-                else:
-                    op = operation_map[name]['default']
-
-                operations = operations.union(op)
-        else:
-            operations = operations.union(operation_map[name])
+    for file, old_sha, new_sha in changes:
+        file_ops = file_operations(lsf_envdir, rules, file, old_sha, new_sha)
+        if file_ops is None:
+            return None, operations
+        operations = operations.union(file_ops)
 
     message = 'Determined operations are %s.' % operations
     if log is None:
@@ -281,17 +1318,28 @@ def git_manager_private(lsf_envdir, log):
     else:
         log.logger.info(message)
 
-    return commit_id[0],operations
+    # nothing to apply, the changes are applied as they are
+    if len(operations) == 0:
+        write_checkpoint(lsf_envdir, head_id)
 
+    return commit_id,operations
 
-def is_execute_success(log, cmd):
-    ret, out, err = execute(cmd)
-    if ret is not 0:
+
+def is_execute_success(log, cmd, timeout=None, retries=0, env=None):
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            # back off 1, 2, 4... seconds before each retry
+            time.sleep(2 ** (attempt - 1))
+        ret, out, err = execute(cmd, timeout, env=env)
+        if ret == 0:
+            break
         message = 'Failed to run %s, due to %s.' %(cmd, err)
         if log is None:
             logging.error(message)
         else:
             log.logger.error(message)
+
+    if ret != 0:
         return False
     else:
         message = 'Success to run command %s.' % cmd
@@ -302,74 +1350,774 @@ def is_execute_success(log, cmd):
         return True
 
 
-def do_actions(log, operations):
-    if 'lim-reconfig' in operations:
-        cmd = ['lsadmin', 'reconfig', '-f']
-        success = is_execute_success(log, cmd)
-        if not success:
+def plan_operations(operations):
+    # Drop the operations dominated by another operation in the set
+    dominated = set()
+    for op in operations:
+        covered = set(operation_dominance.get(op, set()))
+        while covered - dominated:
+            dominated |= covered
+            covered = set().union(*[operation_dominance.get(c, set()) for c in dominated])
+    planned = set(operations) - dominated
+
+    # an operation on all hosts covers the same operation on given hosts
+    return set(op for op in planned if op.partition('@')[0] == op or op.partition('@')[0] not in planned)
+
+
+def list_hosts(op, timeout, env):
+    cmd = host_operations[op]
+    ret, out, err = execute(cmd, timeout, env=env)
+    if ret != 0:
+        logging.warning('Failed to list hosts with %s, due to %s.' % (cmd, err))
+        return None
+    # skip the header line
+    hosts = [line.split()[0] for line in out.splitlines()[1:] if line.strip()]
+    if len(hosts) == 0:
+        # nothing would be restarted, so take the operation on all hosts
+        logging.warning('No host is listed by %s, take %s on all hosts.' % (cmd, op))
+        return None
+    return hosts
+
+
+def restart_hosts(log, op, hosts, timeout, retries, batch_size, batch_interval, env):
+    # Restart in batches of batch_size hosts, stop at the first failed batch
+    if batch_size <= 0:
+        batch_size = len(hosts)
+    for i in range(0, len(hosts), batch_size):
+        if i > 0:
+            time.sleep(batch_interval)
+        cmd = operation_commands[op][:-1] + hosts[i:i + batch_size]
+        if not is_execute_success(log, cmd, timeout, retries, env):
             return False
+    return True
 
-    if 'lim-restart' in operations:
-        cmd = ['lsadmin', 'limrestart', '-f', 'all']
-        success = is_execute_success(log, cmd)
-        if not success:
-            return False
 
-    if 'res-restart' in operations:
-        cmd = ['lsadmin', 'resrestart', '-f', 'all']
-        success = is_execute_success(log, cmd)
-        if not success:
-            return False
+def run_operation(log, op, hosts, timeout, retries, batch_size, batch_interval, env):
+    # hosts is None to take the operation on all hosts
+    start = time.time()
+    trace_group.set(dict(trace_group.get() or {}, operation=op))
+    if hosts is None and batch_size > 0 and op in host_operations:
+        hosts = list_hosts(op, timeout, env)
+
+    if hosts is None:
+        success = is_execute_success(log, operation_commands[op], timeout, retries, env)
+    else:
+        success = restart_hosts(log, op, sorted(hosts), timeout, retries, batch_size, batch_interval, env)
+    return success, time.time() - start
+
+
+def do_actions(log, operations, workers=4, timeout=None, retries=0, batch_size=0, batch_interval=0, env=None, costs=None):
+    # Run the operations as a DAG of operation_dependencies, with independent
+    # ones in parallel. An operation is skipped if one it depends on fails.
+    # env is the environment of the LSF commands, the current one if None,
+    # and the durations are recorded in the CostModel costs if given.
+    planned = plan_operations(operations)
+    if planned != operations:
+        logging.info('Operations %s are covered by %s.' % (operations - planned, planned))
+
+    # the hosts of each operation, None for all hosts
+    hosts = {}
+    for op in planned:
+        op, _, host = op.partition('@')
+        if host:
+            hosts.setdefault(op, set()).add(host)
+        else:
+            hosts[op] = None
+    operations = set(hosts)
+
+    start = time.time()
+    results = {}
+    running = {}
+    remaining = set(operations)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while len(remaining) > 0 or len(running) > 0:
+            for op in sorted(remaining):
+                deps = operation_dependencies.get(op, set()) & operations
+                if any(results.get(dep, (True,))[0] is False for dep in deps):
+                    logging.warning('Skip operation %s as the operations it depends on failed.' % op)
+                    results[op] = (False, None)
+                    remaining.discard(op)
+                elif all(dep in results for dep in deps):
+                    running[pool.submit(contextvars.copy_context().run, run_operation, log, op, hosts[op],
+                                        timeout, retries, batch_size, batch_interval, env)] = op
+                    remaining.discard(op)
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                op = running.pop(future)
+                results[op] = future.result()
+
+    steps = []
+    for op, (ok, seconds) in sorted(results.items()):
+        if seconds is None:
+            steps.append('%s skipped' % op)
+            result = 'skipped'
+        else:
+            steps.append('%s %s in %.3f seconds' % (op, 'succeeded' if ok else 'failed', seconds))
+            result = 'success' if ok else 'failure'
+            if ok and costs is not None and hosts[op] is None:
+                costs.record(op, seconds)
+        metrics.inc('operations_total', metric_labels(operation=op, result=result))
+    message = 'Operations finished in %.3f seconds: %s.' % (time.time() - start, ', '.join(steps))
+    if log is None:
+        logging.info(message)
+    else:
+        log.logger.info(message)
 
-    if 'sbd-restart' in operations:
-        cmd = ['badmin', 'hrestart', '-f', 'all']
-        success = is_execute_success(log, cmd)
-        if not success:
+    if costs is not None:
+        costs.save()
+    return all(ok for ok, seconds in results.values())
+
+def commit_time(repo_dir):
+    # committer time of HEAD, None if unknown
+    commit = repository(repo_dir).commit('HEAD')
+    if commit is None:
+        return None
+    return commit['time']
+
+
+class CostModel(object):
+    # Durations of the operations taken on all hosts, as the exponentially
+    # weighted moving average of the past runs, kept in the git directory of
+    # the private repository
+
+    def __init__(self, path, alpha=0.3):
+        self.path = path
+        self.alpha = alpha
+        self.costs = {}
+        self.changed = False
+        try:
+            with open(path) as f:
+                self.costs = json.load(f)
+        except (IOError, OSError, ValueError, TypeError):
+            pass
+
+    def record(self, op, seconds):
+        cost = self.costs.setdefault(op, {'seconds': seconds, 'runs': 0})
+        cost['seconds'] += self.alpha * (seconds - cost['seconds'])
+        cost['runs'] += 1
+        self.changed = True
+
+    def estimate(self, op):
+        # estimated seconds and the number of runs it is measured from
+        op = op.partition('@')[0]
+        cost = self.costs.get(op)
+        if cost is None:
+            return operation_costs.get(op, 0), 0
+        return cost['seconds'], cost['runs']
+
+    def save(self):
+        if self.changed and self.path is not None:
+            write_state(self.path, self.costs)
+            self.changed = False
+
+
+class DeferredOperations(object):
+    # Expensive operations held back for the maintenance window or a low
+    # load, kept in the git directory of the private repository so they are
+    # taken after a restart, as the checkpoint is already past their commits
+
+    def __init__(self, path):
+        self.path = path
+        self.operations = set()
+        self.since = None
+        self.commits = {}
+        # time of the last failed attempt in this process
+        self.tried = 0
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            self.operations = set(state['operations'])
+            self.since = state['since']
+            self.commits = state.get('commits', {})
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def add(self, operations, private_commit_id, shared_commit_id):
+        if len(self.operations) == 0:
+            self.since = time.time()
+        self.operations |= operations
+        for name, commit_id in (('private', private_commit_id), ('shared', shared_commit_id)):
+            if commit_id is not None:
+                self.commits.setdefault(name, commit_id)
+        self.save()
+
+    def clear(self):
+        self.operations = set()
+        self.since = None
+        self.commits = {}
+        self.save()
+
+    def save(self):
+        if self.path is not None:
+            write_state(self.path, {'operations': sorted(self.operations), 'since': self.since, 'commits': self.commits})
+
+
+def parse_window(text):
+    # A maintenance window "[<days>] HH:MM-HH:MM" in local time, such as
+    # "02:00-04:00", "sat,sun 00:00-06:00" or "mon-fri 22:00-02:00", every
+    # day if the days are omitted. A window past midnight belongs to the day
+    # it starts on. Returns the set of tm_wday and the minutes of the day.
+    fields = text.lower().split()
+    if len(fields) == 1:
+        days = set(range(7))
+    elif len(fields) == 2:
+        days = set()
+        for item in fields[0].split(','):
+            first, _, last = item.partition('-')
+            if first not in weekdays or (last and last not in weekdays):
+                raise ValueError('unknown day %s in maintenance window %s' % (item, text))
+            first = weekdays.index(first)
+            last = weekdays.index(last) if last else first
+            days |= set((first + i) % 7 for i in range((last - first) % 7 + 1))
+    else:
+        raise ValueError('bad maintenance window %s' % text)
+
+    match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$', fields[-1])
+    if match is None:
+        raise ValueError('bad time range in maintenance window %s' % text)
+    start_hour, start_min, end_hour, end_min = [int(v) for v in match.groups()]
+    start, end = start_hour * 60 + start_min, end_hour * 60 + end_min
+    # 24:00 is only an end time
+    if start_min > 59 or end_min > 59 or start >= 24 * 60 or end > 24 * 60:
+        raise ValueError('bad time range in maintenance window %s' % text)
+    return days, start, end
+
+
+def in_window(window, now):
+    days, start, end = window
+    local = time.localtime(now)
+    minute = local.tm_hour * 60 + local.tm_min
+    if start <= end:
+        return local.tm_wday in days and start <= minute < end
+    return (local.tm_wday in days and minute >= start) or ((local.tm_wday - 1) % 7 in days and minute < end)
+
+
+class MaintenancePolicy(object):
+    # When the expensive operations may be taken: in a maintenance window, or
+    # when the load given by the probe command is at most max_load. The probe
+    # prints a number, such as the pending jobs, and runs in the environment
+    # of the LSF commands.
+
+    def __init__(self, windows, max_load, load_probe, expensive, timeout=None):
+        self.windows = [parse_window(window) for window in windows or []]
+        self.max_load = max_load
+        self.load_probe = load_probe
+        self.expensive = set(expensive)
+        self.timeout = timeout
+
+    def defers(self, operations):
+        # the operations to be held back unless allowed
+        return set(op for op in operations if op in self.expensive)
+
+    def probe(self, env=None):
+        # current load, None if unknown
+        if self.load_probe is None:
+            return None
+        ret, out, err = execute(self.load_probe, self.timeout, env=env)
+        try:
+            if ret != 0:
+                raise ValueError(err.strip())
+            return float(out.split()[0])
+        except (ValueError, IndexError) as e:
+            logging.warning('Cannot get load from %s: %s.' % (self.load_probe, e or 'no output'))
+            return None
+
+    def allows(self, env=None):
+        now = time.time()
+        for window in self.windows:
+            if in_window(window, now):
+                return True
+        if self.max_load is not None:
+            load = self.probe(env)
+            if load is not None and load <= self.max_load:
+                logging.info('Load %g is at most %g, expensive operations are allowed.' % (load, self.max_load))
+                return True
+        return False
+
+    def next_window(self, now):
+        # start of the next maintenance window within a week, now if in one,
+        # None if no window
+        if not self.windows:
+            return None
+        if any(in_window(window, now) for window in self.windows):
+            return now
+        start = int(now // 60 + 1) * 60
+        for minute in range(7 * 24 * 60):
+            t = start + minute * 60
+            if any(in_window(window, t) for window in self.windows):
+                return t
+        return None
+
+
+def create_policy(args):
+    # MaintenancePolicy of --maintenance_window and --max_load, None if
+    # expensive operations are taken at once
+    if not args.maintenance_window and args.max_load is None:
+        return None
+    if args.max_load is not None and not args.load_probe:
+        raise ValueError('--max_load needs --load_probe')
+    expensive = [op.strip() for op in args.defer.split(',') if op.strip()]
+    unknown = set(expensive) - known_operations
+    if unknown:
+        raise ValueError('unknown operations %s in --defer' % ', '.join(sorted(unknown)))
+    load_probe = shlex.split(args.load_probe) if args.load_probe else None
+    return MaintenancePolicy(args.maintenance_window, args.max_load, load_probe, expensive, args.timeout)
+
+
+def print_plan(cluster, policy):
+    # The plan subcommand: the deferred operations and their estimated
+    # disruption, and when they may be taken
+    deferred = cluster.deferred
+    print('%s:' % (cluster.name or cluster.lsf_envdir))
+    if len(deferred.operations) == 0:
+        print('  No operation is deferred.')
+    else:
+        print('  Deferred since %s, for commits %s.'
+              % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(deferred.since)),
+                 ', '.join('%s %s' % (name, sha[:12]) for name, sha in sorted(deferred.commits.items())) or 'unknown'))
+        print('  %-16s %12s  %s' % ('OPERATION', 'EST SECONDS', 'MEASURED FROM'))
+        total = 0
+        for op in sorted(plan_operations(deferred.operations)):
+            seconds, runs = cluster.costs.estimate(op)
+            total += seconds
+            print('  %-16s %12.1f  %s' % (op, seconds, '%d runs' % runs if runs else 'default'))
+        print('  Estimated disruption: %.1f seconds.' % total)
+
+    if policy is None:
+        print('  No maintenance window or load threshold, expensive operations are taken at once.')
+        return
+    now = time.time()
+    next_window = policy.next_window(now)
+    if next_window == now:
+        print('  In a maintenance window now.')
+    elif next_window is not None:
+        print('  Next maintenance window: %s.' % time.strftime('%Y-%m-%d %H:%M', time.localtime(next_window)))
+    if policy.max_load is not None:
+        load = policy.probe(cluster.env)
+        print('  Load: %s, at most %g to take expensive operations.' % ('unknown' if load is None else '%g' % load, policy.max_load))
+
+
+class Journal(object):
+    # Journal of the LSF operations of a cluster, kept as the commits of a
+    # dedicated ref in the private repository. The commits are written with
+    # plumbing commands, so the worktree, the index and the branches are not
+    # touched, and they are made and pushed in batches by a background thread
+    # so notification adds no latency to the LSF operations. The journal
+    # pushed by another controller or an earlier clone is taken before
+    # committing, so the push is a fast-forward.
+
+    ref = 'refs/lsf-git-ops/journal'
+    upstream_ref = 'refs/lsf-git-ops/upstream-journal'
+
+    def __init__(self, lsf_envdir, interval):
+        self.lsf_envdir = lsf_envdir
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.messages = []
+        self.entries = []
+        self.pushed = True
+
+        cmd = ['git', 'rev-parse', '--absolute-git-dir']
+        ret, out, err = execute(cmd, cwd=lsf_envdir)
+        if ret != 0:
+            raise ValueError('%s is not a git repository: %s' % (lsf_envdir, err.strip()))
+        self.log_dir = os.path.join(out.strip(), 'lsf-git-ops')
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        identity = 'lsf-git-configure@' + socket.gethostname()
+        self.env = dict(os.environ, GIT_AUTHOR_NAME='lsf-git-configure', GIT_AUTHOR_EMAIL=identity,
+                        GIT_COMMITTER_NAME='lsf-git-configure', GIT_COMMITTER_EMAIL=identity)
+
+        threading.Thread(target=self.run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def add_message(self, record):
+        with self.lock:
+            self.messages.append({'time': record.created, 'level': record.levelname, 'message': record.getMessage()})
+
+    def record(self, cluster, private_commit_id, shared_commit_id, operations, success):
+        # queue an entry with the messages logged since the last one
+        with self.lock:
+            self.entries.append({'time': time.time(), 'cluster': cluster, 'private_commit': private_commit_id,
+                                 'shared_commit': shared_commit_id, 'operations': sorted(operations),
+                                 'success': success, 'messages': self.messages})
+            self.messages = []
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        # commit the queued entries and push the journal, kept for the next
+        # flush if failed
+        with self.flush_lock:
+            with self.lock:
+                entries, self.entries = self.entries, []
+            if len(entries) == 0 and self.pushed:
+                return
+            url = get_upstream(self.lsf_envdir)['url']
+            synced = url is None or self.merge_upstream(url)
+            if len(entries) > 0:
+                if not self.commit(entries):
+                    with self.lock:
+                        self.entries = entries + self.entries
+                    return
+                self.pushed = url is None
+            if not self.pushed and synced:
+                self.pushed = self.git(['push', '--quiet', url, '%s:%s' % (self.ref, self.ref)]) is not None
+
+    def git(self, cmd, data=None):
+        ret, out, err = execute(['git'] + cmd, cwd=self.lsf_envdir, env=self.env, input=data)
+        if ret != 0:
+            logging.error('Failed to update journal with git %s, due to %s.' % (' '.join(cmd), err))
+            return None
+        return out.strip()
+
+    def commit(self, entries):
+        lines = []
+        for entry in entries:
+            if entry['shared_commit'] and entry['private_commit']:
+                line = 'Update git configuration log based on commit id %s for shared LSF configuration updated and %s for private LSF configuration updated' % (entry['shared_commit'], entry['private_commit'])
+            elif entry['private_commit']:
+                line = 'Update git configuration log based on commit id %s for private LSF configuration updated' % entry['private_commit']
+            else:
+                line = 'Update git configuration log based on commit id %s for shared LSF configuration updated' % entry['shared_commit']
+            lines.append('%s: %s %s.' % (line, ', '.join(entry['operations']), 'succeeded' if entry['success'] else 'failed'))
+        message = 'Journal of %d LSF operation cycles\n\n%s\n' % (len(entries), '\n'.join(lines))
+
+        # 1. write the entries as a blob of JSON lines in a tree
+        content = ''.join(json.dumps(entry, sort_keys=True) + '\n' for entry in entries)
+        blob = self.git(['hash-object', '-w', '--stdin'], content.encode('utf8'))
+        if blob is None:
+            return False
+        tree = self.git(['mktree'], ('100644 blob %s\tjournal.jsonl\n' % blob).encode('utf8'))
+        if tree is None:
             return False
 
-    if 'mbd-restart' in operations:
-        cmd = ['badmin', 'mbdrestart', '-f']
-        success = is_execute_success(log, cmd)
-        if not success:
+        # 2. commit on top of the journal, and move the ref only if it is not moved by others
+        parent = self.git(['for-each-ref', '--format=%(objectname)', self.ref])
+        if parent is None:
             return False
+        cmd = ['commit-tree', tree, '-F', '-'] + (['-p', parent] if parent else [])
+        commit = self.git(cmd, message.encode('utf8'))
+        if commit is None:
+            return False
+        return self.git(['update-ref', '-m', 'journal', self.ref, commit, parent or NULL_SHA]) is not None
+
+    def is_ancestor(self, ancestor, commit):
+        cmd = ['git', 'merge-base', '--is-ancestor', ancestor, commit]
+        return execute(cmd, cwd=self.lsf_envdir)[0] == 0
+
+    def merge_upstream(self, url):
+        # Take the journal of the upstream when the local one does not
+        # contain it: fast-forward to it, or merge it when both have new commits
+        out = self.git(['ls-remote', url, self.ref])
+        local = self.git(['for-each-ref', '--format=%(objectname)', self.ref])
+        if out is None or local is None:
+            return False
+        upstream = out.split()[0] if out else None
+        if upstream is None or upstream == local or local and self.is_ancestor(upstream, local):
+            return True
 
-    if 'mbd-reconfig' in operations:
-        cmd = ['badmin', 'reconfig', '-f']
-        success = is_execute_success(log, cmd)
-        if not success:
+        if self.git(['fetch', '--quiet', '--no-tags', url, '+%s:%s' % (self.ref, self.upstream_ref)]) is None:
+            return False
+        upstream = self.git(['rev-parse', '--verify', self.upstream_ref])
+        if upstream is None:
             return False
+        commit = upstream
+        if local and not self.is_ancestor(local, upstream):
+            cmd = ['commit-tree', local + '^{tree}', '-p', local, '-p', upstream, '-m', 'Merge the journal of the upstream']
+            commit = self.git(cmd)
+            if commit is None:
+                return False
+        return self.git(['update-ref', '-m', 'journal', self.ref, commit, local or NULL_SHA]) is not None
+
+
+class JournalHandler(logging.Handler):
+    # adds the messages of the operation logger to the journal entries
+    def __init__(self, journal):
+        logging.Handler.__init__(self)
+        self.journal = journal
+
+    def emit(self, record):
+        self.journal.add_message(record)
+
+
+def create_journal(lsf_envdir, interval):
+    # Journal of a cluster, and the Logger of its operations, writing into
+    # the git directory instead of the worktree
+    journal = Journal(lsf_envdir, interval)
+    log = Logger(os.path.join(journal.log_dir, 'git-configuration.log'), level='debug')
+    log.logger.addHandler(JournalHandler(journal))
+    return log, journal
+
+
+class Cluster(object):
+    # A cluster managed by the tool: its private and shared repositories,
+    # the environment of its LSF commands (None for the current one), the
+    # operations pending in the coalescing window, the expensive ones
+    # deferred by the MaintenancePolicy, and the IncludeGraph mapping the
+    # shared files to the local files including them
+
+    def __init__(self, name, lsf_envdir, shared_envdir, env, rules, log, args):
+        self.name = name
+        self.lsf_envdir = lsf_envdir
+        self.shared_envdir = shared_envdir
+        self.env = env
+        self.rules = rules
+        self.log = log
+        self.args = args
+        self.watcher = None
+        self.watch_socket = args.watch_socket
+        self.journal = None
+        self.policy = None
+
+        self.operations = set()
+        self.pending_since = None
+        self.commit_time = None
+        self.private_commit_id = None
+        self.shared_commit_id = None
+        # HEAD of each repository pulled for the pending operations
+        self.pending_heads = {}
+        self.scheduler = PollScheduler(self.repo_dirs(), args.interval, args.max_interval, args.jitter)
+        self.graph = IncludeGraph(lsf_envdir, shared_envdir) if shared_envdir else None
+        self.costs = CostModel(state_path(lsf_envdir, 'costs.json'))
+        self.deferred = DeferredOperations(state_path(lsf_envdir, 'deferred.json'))
+
+    def repo_dirs(self):
+        if self.shared_envdir:
+            return [self.lsf_envdir, self.shared_envdir]
+        return [self.lsf_envdir]
+
+    def poll(self):
+        # Run one poll cycle and return the seconds to wait for the next one
+        args = self.args
+        cycle_start = time.time()
+        stats = {'calls': 0, 'seconds': 0.0, 'failed': set()}
+        cycle_stats.set(stats)
+        cycle_cluster.set(self.name)
+        trace_group.set({'cycle': '%s-%d' % (self.name or os.getpid(), next(trace_cycles))})
+
+        # only the repositories due by their schedule are polled
+        due = self.scheduler.due()
+        # (changed, failed) of each repository polled, scheduled after the operations
+        polled = {}
 
-    return True
+        # must run git_manager_private firstly, as we will update git.log to private repo
+        private_commit_id = None
+        private_operations = set()
+        if self.lsf_envdir in due:
+            private_commit_id, private_operations = git_manager_private(self.lsf_envdir, self.log, self.rules, self.graph)
+            polled[self.lsf_envdir] = (private_commit_id is not None, self.lsf_envdir in stats['failed'])
+            if private_commit_id is not None:
+                self.pending_heads[self.lsf_envdir] = repository(self.lsf_envdir).head()
+        shared_commit_id = None
+        shared_operations = set()
+        if self.shared_envdir in due:
+            shared_commit_id,shared_operations = git_manager_shared(self.shared_envdir, self.log, self.rules, self.graph)
+            polled[self.shared_envdir] = (shared_commit_id is not None,
+                                          self.shared_envdir in stats['failed'] or None in stats['failed'])
+            if shared_commit_id is not None:
+                self.pending_heads[self.shared_envdir] = repository(self.shared_envdir).head()
+        new_operations = private_operations | shared_operations
+        if len(new_operations) > 0:
+            # changes in the window are acted on together, since the first commit of them
+            if len(self.operations) == 0:
+                self.pending_since = time.time()
+                changed_dirs = [repo_dir for repo_dir, ops in ((self.lsf_envdir, private_operations),
+                                (self.shared_envdir, shared_operations)) if len(ops) > 0]
+                self.commit_time = min([t for t in map(commit_time, changed_dirs) if t is not None] or [None])
+                self.private_commit_id = private_commit_id
+                self.shared_commit_id = shared_commit_id
+            self.private_commit_id = self.private_commit_id or private_commit_id
+            self.shared_commit_id = self.shared_commit_id or shared_commit_id
+            self.operations |= new_operations
+
+        # expensive operations wait for the maintenance window or a low load,
+        # and the deferred ones are retried no sooner than max_interval after a failure
+        held = set()
+        if self.policy is not None:
+            held = self.policy.defers(plan_operations(self.operations | self.deferred.operations))
+        allowed = len(held) == 0 or self.policy.allows(self.env)
+        runnable = set()
+        if allowed and time.time() - self.deferred.tried >= args.max_interval:
+            runnable = self.deferred.operations
 
-def commit_git_log(lsf_envdir, private_commit_id, shared_commit_id):
-    # 1. change dir to lsf_envdir
-    os.chdir(lsf_envdir)
+        # There is no file changed in LSF git configuration for both private repo and shared repo, skip
+        if len(self.operations) == 0 and len(runnable) == 0:
+            logging.debug('No operation needs to be executed. Just continue...')
 
-    # 2. push the changes for git.configuration.*  to private repo
-    cmd = ['git', 'add', 'git-configuration.log*']
-    ret, out, err = execute(cmd)
-    if ret is not 0:
-        logging.error(err)
-        return
+        elif len(self.operations) > 0 and time.time() - self.pending_since < args.coalesce:
+            logging.debug('Operations %s are pending for more changes in %.1f seconds.'
+                          % (self.operations, args.coalesce - (time.time() - self.pending_since)))
 
-    if shared_commit_id and private_commit_id:
-        comments = 'Update git configuration log based on commit id %s for shared LSF configuration updated and %s for private LSF configuration updated.' %(shared_commit_id, private_commit_id)
-    elif private_commit_id:
-        comments = 'Update git configuration log based on commit id %s for private LSF configuration updated.' %(private_commit_id)
-    else:
-        comments = 'Update git configuration log based on commit id %s for shared LSF configuration updated.' %(shared_commit_id)
+        else :
+            operations = self.operations | runnable
+            if not allowed:
+                deferred = held & operations
+                if len(deferred) > 0:
+                    operations = operations - deferred
+                    self.deferred.add(deferred, self.private_commit_id, self.shared_commit_id)
+                    for op in deferred:
+                        metrics.inc('operations_total', metric_labels(operation=op, result='deferred'))
+                    message = 'Operations %s are deferred to the maintenance window or a low load.' % deferred
+                    if self.log is None:
+                        logging.info(message)
+                    else:
+                        self.log.logger.info(message)
+            elif len(runnable) > 0:
+                logging.info('Taking operations %s deferred since %s.'
+                             % (runnable, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.deferred.since))))
+
+            success = True
+            if len(operations) > 0:
+                success = do_actions(self.log, operations, args.workers, args.timeout, args.retries,
+                                     args.batch_size, args.batch_interval, self.env, self.costs)
+                if self.commit_time is not None and len(self.operations) > 0:
+                    metrics.observe('commit_applied_seconds', metric_labels(), time.time() - self.commit_time)
+                if self.journal is not None:
+                    self.journal.record(self.name, self.private_commit_id or self.deferred.commits.get('private'),
+                                        self.shared_commit_id or self.deferred.commits.get('shared'), operations, success)
+            if len(runnable) > 0:
+                if success:
+                    self.deferred.clear()
+                else:
+                    self.deferred.tried = time.time()
+            # the pulled commits are applied, otherwise their changes are taken again
+            # by the next polls of the repositories, backing off as failed polls
+            for repo_dir, head_id in self.pending_heads.items():
+                if success:
+                    write_checkpoint(repo_dir, head_id)
+                else:
+                    polled[repo_dir] = (True, True)
+            self.pending_heads.clear()
+            self.operations.clear()
+
+        logging.debug('Poll cycle took %.3f seconds, including %d subprocesses taking %.3f seconds.'
+                      % (time.time() - cycle_start, stats['calls'], stats['seconds']))
+        metrics.observe('poll_cycle_seconds', metric_labels(), time.time() - cycle_start)
+        if tracer is not None:
+            tracer.record('cycle', cycle_start, time.time() - cycle_start, cluster=self.name,
+                          calls=stats['calls'], operations=sorted(self.operations))
+        if args.metrics_file:
+            try:
+                metrics.write(args.metrics_file)
+            except (IOError, OSError) as e:
+                logging.warning('Cannot write metrics to %s: %s.' % (args.metrics_file, e))
+
+        for repo_dir, (changed, failed) in polled.items():
+            self.scheduler.record(repo_dir, changed, failed)
+        interval = self.scheduler.wait()
+        if len(self.operations) > 0:
+            interval = max(0, min(interval, args.coalesce - (time.time() - self.pending_since)))
+        return interval
+
+
+class ClusterLogFilter(logging.Filter):
+    # prefix messages with the cluster name of the poll cycle in controller mode
+    def filter(self, record):
+        name = cycle_cluster.get()
+        if name is not None:
+            record.msg = '[%s] %s' % (name, record.msg)
+        return True
 
-    cmd = ['git', 'commit', '-m', comments]
-    ret, out, err = execute(cmd)
-    if ret is not 0:
-        logging.error(err)
-        return
 
-    cmd = ['git', 'push']
+def load_profile(profile):
+    # the environment after sourcing an LSF profile
+    cmd = ['bash', '-c', '. "$0" > /dev/null 2>&1 && env -0', profile]
     ret, out, err = execute(cmd)
-    if ret is not 0:
-        logging.error(err)
-        return
+    if ret != 0:
+        raise ValueError('cannot source %s: %s' % (profile, err.strip()))
+    return dict(item.split('=', 1) for item in out.split('\0') if '=' in item)
+
+
+def load_clusters(clusters_file, args):
+    # Clusters are given in a JSON file as
+    # {"clusters": [{"profile": ..., "envdir": ..., "shared_envdir": ..., "name": ..., "rules": ...}]}
+    # where envdir defaults to LSF_ENVDIR set by the profile.
+    with open(clusters_file) as f:
+        config = json.load(f)
+
+    clusters = []
+    for entry in config.get('clusters', []):
+        env = load_profile(entry['profile']) if entry.get('profile') else dict(os.environ)
+        lsf_envdir = entry.get('envdir') or env.get('LSF_ENVDIR')
+        if lsf_envdir is None:
+            raise ValueError('no LSF_ENVDIR for cluster %s' % entry)
+        env['LSF_ENVDIR'] = lsf_envdir
+
+        name = entry.get('name') or detect_cluster_name(lsf_envdir) or lsf_envdir
+        shared_envdir = entry.get('shared_envdir')
+        if shared_envdir:
+            shared_envdir = os.path.abspath(shared_envdir)
+        rules = load_rules(entry.get('rules', args.rules), entry.get('name') or detect_cluster_name(lsf_envdir))
+        log, journal = create_journal(lsf_envdir, args.notify_interval) if args.notify else (None, None)
+
+        cluster = Cluster(name, lsf_envdir, shared_envdir, env, rules, log, args)
+        cluster.watch_socket = entry.get('watch_socket')
+        cluster.journal = journal
+        clusters.append(cluster)
+    return clusters
+
+
+async def run_cluster(cluster, executor):
+    # Poll a cluster in the executor, each cluster on its own schedule
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def on_change():
+        cluster.watcher.drain()
+        changed.set()
+
+    while True:
+        interval = await loop.run_in_executor(executor, contextvars.copy_context().run, cluster.poll)
+
+        if cluster.args.watch and cluster.watcher is None:
+            cluster.watcher = await loop.run_in_executor(executor, create_watcher, cluster.repo_dirs(), cluster.watch_socket)
+            for fd in (cluster.watcher.inotify_fd, cluster.watcher.sock):
+                if fd is not None:
+                    loop.add_reader(fd, on_change)
+
+        try:
+            await asyncio.wait_for(changed.wait(), interval)
+            cluster.scheduler.wake()
+        except asyncio.TimeoutError:
+            pass
+        changed.clear()
+
+
+def run_controller(clusters, args):
+    # Manage all the clusters from one event loop. The blocking git and LSF
+    # commands of a cycle run in a pool with a thread per cluster, so a
+    # cluster waiting on a slow command never delays the polls of the others.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(clusters))
+
+    async def run_all():
+        # a signal cancels the clusters in the loop, as signal_fun cannot
+        # exit from the middle of it
+        loop = asyncio.get_running_loop()
+        tasks = asyncio.gather(*[run_cluster(cluster, executor) for cluster in clusters])
+
+        def on_signal(signum):
+            logging.error('Signal <%d> is received, exit.' % signum)
+            tasks.cancel()
+
+        for signum in (signal.SIGINT, signal.SIGHUP, signal.SIGTERM):
+            loop.add_signal_handler(signum, on_signal, signum)
+        try:
+            await tasks
+        except asyncio.CancelledError:
+            pass
+
+    logging.info('Managing %d clusters: %s.' % (len(clusters), ', '.join(cluster.name for cluster in clusters)))
+    asyncio.run(run_all())
+    # the polls already running finish, so no operation is left half taken
+    executor.shutdown()
+    exit(1)
 
 
 def main(argv):
@@ -380,48 +2128,147 @@ def main(argv):
     signal.signal(signal.SIGTERM, signal_fun)
 
     parser = argparse.ArgumentParser(description='LSF configuration management by git.')
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'plan'], help='run the tool, or show the deferred operations and their estimated disruption')
     parser.add_argument('-d', '--shared_envdir', type=str, default=None, help='set to the full path of shared LSF configuration')
-    parser.add_argument('-i', '--interval', type=int, default=5, help='interval in wainting for next pulling')
-    parser.add_argument('-n', '--notify', action="store_true", help='push LSF operation log into LSF configuration git repository')
+    parser.add_argument('-i', '--interval', type=int, default=5, help='interval in wainting for next pulling, or for the fallback pulling in watch mode')
+    parser.add_argument('--max_interval', type=int, default=300, help='maximum interval the polling of an idle or failing repository backs off to')
+    parser.add_argument('--jitter', type=float, default=0.1, help='fraction of the poll interval randomly added or removed')
+    parser.add_argument('-n', '--notify', action="store_true", help='record LSF operations in the refs/lsf-git-ops/journal ref of LSF configuration git repository and push it')
+    parser.add_argument('--notify_interval', type=float, default=10, help='seconds between two commits and pushes of the journal with --notify')
+    parser.add_argument('-c', '--coalesce', type=float, default=0, help='seconds to wait for more changes after the first one, then act on all of them at once')
+    parser.add_argument('--workers', type=int, default=4, help='maximum number of LSF operations run in parallel')
+    parser.add_argument('--timeout', type=int, default=600, help='seconds before a hung LSF operation is killed')
+    parser.add_argument('--retries', type=int, default=0, help='times to retry a failed LSF operation')
+    parser.add_argument('--batch_size', type=int, default=0, help='restart sbatchd and RES on this many hosts at a time, 0 for all hosts at once')
+    parser.add_argument('--batch_interval', type=float, default=0, help='seconds to wait between two batches of host restarts')
+    parser.add_argument('--maintenance_window', type=str, action='append', default=None, help='"[<days>] HH:MM-HH:MM" in local time when the expensive operations are taken, such as "sat,sun 01:00-05:00", can be repeated')
+    parser.add_argument('--max_load', type=float, default=None, help='also take the expensive operations when the load given by --load_probe is at most this')
+    parser.add_argument('--load_probe', type=str, default=None, help='command printing the current load of the cluster, such as the number of pending jobs')
+    parser.add_argument('--defer', type=str, default=','.join(expensive_operations), help='comma separated expensive operations deferred with --maintenance_window or --max_load')
+    parser.add_argument('-r', '--rules', type=str, default=None, help='JSON file with the rules mapping changed files to LSF operations')
+    parser.add_argument('--cluster', type=str, default=None, help='cluster name for "{cluster}" in rules, by default the suffix of lsf.cluster.<name> in LSF_ENVDIR')
+    parser.add_argument('--dump_rules', action="store_true", help='print the default rules as a sample rules file and exit')
+    parser.add_argument('--clusters', type=str, default=None, help='JSON file listing the clusters to be managed by this process')
+    parser.add_argument('--object_cache', type=str, default=None, help='directory of local repositories fetched once for all the shared repositories of the same upstream')
+    parser.add_argument('-w', '--watch', action="store_true", help='wake up as soon as the local upstream repositories receive a push')
+    parser.add_argument('--watch_socket', type=str, default=None, help='in watch mode, also wake up when a post-receive hook pokes this UNIX socket')
+    parser.add_argument('--metrics_port', type=int, default=None, help='serve metrics in the Prometheus format on this HTTP port')
+    parser.add_argument('--metrics_file', type=str, default=None, help='write metrics in the Prometheus format to this file after each poll cycle, for the textfile collector')
+    parser.add_argument('--depth', type=int, default=0, help='fetch only this many commits of the upstream branch history, deepened as needed to fast-forward, 0 for the full history')
+    parser.add_argument('--sparse', type=str, default=None, help='comma separated patterns of the paths checked out in the repositories, such as "lsf.*,lsbatch/"')
+    parser.add_argument('--git_backend', type=str, default='native', choices=['native', 'cli'], help='read git refs and objects in process, or run the git command line for them')
+    parser.add_argument('--trace', type=str, default=None, help='append a JSON span for each subprocess and poll cycle to this file')
+    parser.add_argument('--profile', type=str, default=None, help='print where the time goes in a file written by --trace and exit')
+    parser.add_argument('--profile_top', type=int, default=10, help='number of commands and cycles listed by --profile')
     args = parser.parse_args()
 
+    if args.dump_rules:
+        print(json.dumps(default_rules(), indent=4, sort_keys=True))
+        sys.exit(0)
+
+    if args.profile:
+        try:
+            profile_report(args.profile, args.profile_top)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            logging.error('Cannot read trace from %s: %s.' % (args.profile, e))
+            sys.exit(-1)
+        sys.exit(0)
+
+    global git_backend
+    git_backend = args.git_backend
+
+    global fetch_depth, sparse_paths
+    fetch_depth = args.depth
+    if args.sparse:
+        sparse_paths = [path.strip() for path in args.sparse.split(',') if path.strip()]
+
+    global tracer
+    if args.trace:
+        tracer = Tracer(os.path.abspath(args.trace))
+
+    try:
+        policy = create_policy(args)
+    except ValueError as e:
+        logging.error('Cannot defer expensive operations: %s.' % e)
+        sys.exit(-1)
+
+    if args.metrics_port is not None and args.command == 'run':
+        try:
+            metrics.serve(args.metrics_port)
+        except (IOError, OSError) as e:
+            logging.error('Cannot serve metrics on port %d: %s.' % (args.metrics_port, e))
+            sys.exit(-1)
+
+    logging.getLogger().addFilter(ClusterLogFilter())
+
+    global object_cache
+    if args.object_cache:
+        object_cache = ObjectCache(args.object_cache, args.interval)
+
+    if args.clusters:
+        try:
+            clusters = load_clusters(args.clusters, args)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            logging.error('Cannot load clusters from %s: %s.' % (args.clusters, e))
+            sys.exit(-1)
+        for cluster in clusters:
+            cluster.policy = policy
+        if args.command == 'plan':
+            for cluster in clusters:
+                print_plan(cluster, policy)
+            sys.exit(0)
+        run_controller(clusters, args)
+        return
+
     if args.shared_envdir:
         if not os.path.exists(args.shared_envdir):
             logging.error('No such file or directory: %s.' % args.shared_envdir )
             sys.exit(-1)
+        args.shared_envdir = os.path.abspath(args.shared_envdir)
 
     lsf_envdir = os.environ.get('LSF_ENVDIR', None)
     if lsf_envdir is None:
         logging.error('This tool should be run in LSF context. Please source your LSF profile.')
         sys.exit(-1)
 
+    global operation_rules
+    cluster = args.cluster or detect_cluster_name(lsf_envdir)
+    try:
+        operation_rules = load_rules(args.rules, cluster)
+    except (IOError, OSError, ValueError) as e:
+        logging.error('Cannot load rules from %s: %s.' % (args.rules, e))
+        sys.exit(-1)
+
     # the logger is used to push LSF operation back to LSF configuration git repository 
     if args.notify:
-        log = Logger(lsf_envdir +'/git-configuration.log', level='debug')
+        try:
+            log, journal = create_journal(lsf_envdir, args.notify_interval)
+        except (IOError, OSError, ValueError) as e:
+            logging.error('Cannot record LSF operations in %s: %s.' % (lsf_envdir, e))
+            sys.exit(-1)
     else:
-        log = None
-
-    operations = set()
+        log, journal = None, None
+
+    cluster = Cluster(None, lsf_envdir, args.shared_envdir, None, operation_rules, log, args)
+    cluster.journal = journal
+    cluster.policy = policy
+    if args.command == 'plan':
+        print_plan(cluster, policy)
+        sys.exit(0)
     while True:
-        # must run git_manager_private firstly, as we will update git.log to private repo
-        private_commit_id, private_operations = git_manager_private(lsf_envdir, log)
-        shared_commit_id = None
-        shared_operations = set()
-        if args.shared_envdir:
-            shared_commit_id,shared_operations = git_manager_shared(args.shared_envdir, log)
-        operations = private_operations | shared_operations
-
-        # There is no file changed in LSF git configuration for both private repo and shared repo, skip
-        if len(operations) == 0:
-            logging.debug('No operation needs to be executed. Just continue...')
+        interval = cluster.poll()
+        if not args.watch:
+            time.sleep(interval)
+            continue
 
-        else :
-            do_actions(log,operations)
-            if args.notify:
-                commit_git_log(lsf_envdir, private_commit_id , shared_commit_id)
-            operations.clear()
+        # the upstream of each repository is known after the first cycle
+        if cluster.watcher is None:
+            cluster.watcher = create_watcher(cluster.repo_dirs(), cluster.watch_socket)
 
-        time.sleep(args.interval)
+        wait_start = time.time()
+        if cluster.watcher.wait(interval):
+            cluster.scheduler.wake()
+            logging.debug('Woken up by upstream change after waiting %.3f seconds.' % (time.time() - wait_start))
 
 
 if __name__ == "__main__":
@@ -21,6 +21,172 @@ import logging
 import time
 import argparse
 import signal
+import concurrent.futures
+import hashlib
+import json
+import xml.etree.ElementTree as ElementTree
+import io
+import re
+import contextvars
+import itertools
+
+# the code shared with the other script is in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'common'))
+from gitops import open_repository, RefWatcher, Metrics, command_label, Tracer, profile_report, trace_group, PollScheduler
+
+
+class FlowState(object):
+    # The flows submitted so far: for each flow definition path, the hash of
+    # its canonicalized XML and the commit it was submitted from. It is kept
+    # in a JSON file so that a restart does not submit unchanged flows again.
+
+    def __init__(self, path):
+        self.path = path
+        self.flows = {}
+        try:
+            with open(path) as f:
+                self.flows = json.load(f).get('flows', {})
+        except (IOError, OSError, ValueError):
+            pass
+
+    @staticmethod
+    def flow_hash(flow):
+        # comments, attribute order and formatting do not change the hash
+        try:
+            content = ElementTree.canonicalize(from_file=flow, strip_text=True).encode('utf8')
+        except (ElementTree.ParseError, ValueError):
+            with open(flow, 'rb') as f:
+                content = f.read()
+        return hashlib.sha256(content).hexdigest()
+
+    def is_changed(self, flow, flow_hash):
+        return self.flows.get(flow, {}).get('hash') != flow_hash
+
+    def record(self, flow, flow_hash, commit_id):
+        self.flows[flow] = {'hash': flow_hash, 'commit': commit_id}
+
+    def prune(self, flows):
+        # forget flows which do not exist any more, so they are submitted
+        # again if added back
+        removed = set(self.flows) - set(flows)
+        for flow in removed:
+            del self.flows[flow]
+        if len(removed) > 0:
+            self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'flows': self.flows}, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except (IOError, OSError) as e:
+            logging.warning('Failed to save flow state to %s, due to %s.' % (self.path, e))
+
+
+class DataIndex(object):
+    # Index from the data files referenced by file event conditions of flows
+    # to the flows and jobs waiting for them. Flow definitions are parsed
+    # per blob SHA, so only the changed ones are parsed again. It is only
+    # used to log the jobs a pushed data file is ready for: PPM starts them
+    # on its own file events, so no flow is submitted or triggered for data.
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        self.flow_blobs = {}
+        self.parsed = {}
+        self.index = {}
+
+    def data_path(self, path):
+        # the data path relative to the repository root, None if outside
+        path = path.strip()
+        if os.path.isabs(path):
+            path = os.path.realpath(path)
+            if path.startswith(self.root + os.sep):
+                return os.path.relpath(path, self.root)
+        # flows may be written for the repository cloned at another place
+        pos = path.find('workflow/')
+        if pos == 0 or (pos > 0 and path[pos - 1] == '/'):
+            return path[pos:]
+        return None
+
+    def parse(self, content):
+        # (data path, job) of each FileAgent event of the activities
+        found = []
+        for event, elem in ElementTree.iterparse(io.BytesIO(content)):
+            if elem.tag != 'ActivityDef':
+                continue
+            job = elem.get('ImplementRefer')
+            for condition in elem.iter('Event'):
+                if not condition.get('GeneratorType', '').startswith('FileAgent'):
+                    continue
+                match = re.search(r'"([^"]+)"', condition.get('Name', '')) or \
+                        re.search(r'\((.*)\)\s*$', condition.text or '')
+                if match is None:
+                    continue
+                path = self.data_path(match.group(1))
+                if path is not None:
+                    found.append((path, job))
+            elem.clear()
+        return found
+
+    def update(self):
+        # parse the flow definitions whose blob changed, in one cat-file process
+        cmd = ['git', 'ls-files', '-s', '--', 'workflow/*/*.xml']
+        ret, out, err = execute(cmd)
+        if ret != 0:
+            return
+        blobs = {}
+        for line in out.splitlines():
+            meta, path = line.split('\t', 1)
+            if len(path.split('/')) == 3:
+                blobs[path] = meta.split()[1]
+
+        missing = sorted(set(blobs.values()) - set(self.parsed))
+        if len(missing) > 0:
+            for sha, content in repository(self.root).blobs(missing).items():
+                try:
+                    self.parsed[sha] = self.parse(content)
+                except ElementTree.ParseError as e:
+                    logging.warning('Failed to parse flow definition blob %s, due to %s.' % (sha, e))
+                    self.parsed[sha] = []
+
+        for flow in set(self.flow_blobs) | set(blobs):
+            if self.flow_blobs.get(flow) == blobs.get(flow):
+                continue
+            for path, job in self.parsed.get(self.flow_blobs.get(flow), []):
+                self.index.get(path, set()).discard((flow, job))
+            for path, job in self.parsed.get(blobs.get(flow), []):
+                self.index.setdefault(path, set()).add((flow, job))
+        self.flow_blobs = blobs
+
+    def lookup(self, path):
+        # the (flow, job) waiting for a data file
+        return self.index.get(path, set())
+
+
+# FlowState of the repository, loaded by init_submit
+flow_state = None
+
+# DataIndex of the repository, built by init_submit
+data_index = None
+
+# Metrics of the subprocesses, poll cycles and flow submissions
+metrics = Metrics('ppm_git')
+metrics.describe('execute_seconds', 'histogram', 'Seconds taken by the external commands.')
+metrics.describe('poll_cycle_seconds', 'histogram', 'Seconds taken by the poll cycles.')
+metrics.describe('commit_applied_seconds', 'histogram', 'Seconds from the commit time to the flows submitted.')
+metrics.describe('flows_total', 'counter', 'Flow submissions by result.')
+
+# Numbers of the poll cycles in the trace spans, and the Tracer if --trace
+# is given
+trace_cycles = itertools.count(1)
+tracer = None
+
+# Repository backend of each repository directory, and the kind of backend
+# given by --git_backend
+repositories = {}
+git_backend = 'native'
 
 
 def signal_fun(signum, frame):
@@ -54,6 +220,16 @@ def init_submit(args):
         logging.error('The workflow directory must exist under the path or repo.')
         sys.exit(-1)
     
+    global flow_state
+    state_file = args.state_file
+    if state_file is None:
+        cmd = ['git', 'rev-parse', '--absolute-git-dir']
+        ret, out, err = execute(cmd)
+        if ret != 0:
+            sys.exit(-1)
+        state_file = os.path.join(out.strip(), 'ppm-git-trigger.state')
+    flow_state = FlowState(state_file)
+
     operations = set() 
     #submit the existing flows
     for i in os.listdir("workflow"):
@@ -63,61 +239,160 @@ def init_submit(args):
                 if extension == '.xml':
                     operations.add("workflow/" + i +"/"+j)
 
+    flow_state.prune(operations)
     submit_and_trigger_flow(operations, args)
 
+    global data_index
+    data_index = DataIndex(os.getcwd())
+    data_index.update()
+
+
+def submit_flow(flow, args):
+    # submit, release and trigger one flow in order, return True if submitted
+    trace_group.set(dict(trace_group.get() or {}, flow=flow))
+    if not os.path.exists(flow):
+        logging.warning('Flow %s does not exist.' % flow)
+        return False
+
+    flow_name=flow.split("/")[-1].split(".")[0]
+    cmd = ['jsub', '-r', flow]
+    for attempt in range(args.retries + 1):
+        if attempt > 0:
+            delay = args.backoff * 2 ** (attempt - 1)
+            logging.info('Retry to submit flow %s in %.1f seconds.' % (flow, delay))
+            time.sleep(delay)
+        ret, out, err = execute(cmd)
+        if ret == 0:
+            break
+    if ret is not 0:
+        logging.warning('Failed to submit flow %s.' % flow)
+        return False
+    else:
+        logging.debug('Flow %s submitted.' % flow_name)
+    # trigger implies release
+    if args.operation == 'release' or args.operation == 'trigger':
+        cmd = ['jrelease', flow_name]
+        ret, out, err = execute(cmd)
+        if ret is not 0:
+            logging.warning('Failed to release flow %s.' % flow_name)
+        else:
+            logging.debug('Flow %s released.' % flow_name)
+    if args.operation == 'trigger':
+        cmd = ['jtrigger', flow_name]
+        ret, out, err = execute(cmd)
+        if ret is not 0:
+            logging.warning('Failed to trigger flow %s.' % flow_name)
+        else:
+            logging.debug('Flow %s triggered.' % flow_name)
+    return True
+
 
 def submit_and_trigger_flow(flows, args):
+    # Flows are submitted in parallel, each by its own ordered chain of
+    # commands. Flows submitted before with the same definition are skipped.
+    hashes = {}
     for flow in flows:
-        if os.path.exists(flow):
-            flow_name=flow.split("/")[-1].split(".")[0]
-            cmd = ['jsub', '-r', flow]
-            ret, out, err = execute(cmd)
-            if ret is not 0:
-                logging.warning('Failed to submit flow %s.' % flow)
-                continue
-            else:
-                logging.debug('Flow %s submitted.' % flow_name)
-            # trigger implies release
-            if args.operation == 'release' or args.operation == 'trigger':
-                cmd = ['jrelease', flow_name]
-                ret, out, err = execute(cmd)
-                if ret is not 0:
-                    logging.warning('Failed to release flow %s.' % flow_name)
-                else:
-                    logging.debug('Flow %s released.' % flow_name)
-            if args.operation == 'trigger':
-                cmd = ['jtrigger', flow_name]
-                ret, out, err = execute(cmd)
-                if ret is not 0:
-                    logging.warning('Failed to trigger flow %s.' % flow_name)
-                else:
-                    logging.debug('Flow %s triggered.' % flow_name)
-        else:
-            logging.warning('Flow %s does not exist.' % flow)
+        flow_hash = FlowState.flow_hash(flow) if os.path.exists(flow) else None
+        if flow_hash is not None and not flow_state.is_changed(flow, flow_hash):
+            logging.debug('Flow %s is not changed since it was submitted.' % flow)
+            continue
+        hashes[flow] = flow_hash
+    flows = sorted(hashes)
+    if len(flows) == 0:
+        return
+
+    repo = repository(os.getcwd())
+    commit_id = repo.head()
+    commit = repo.commit(commit_id) if commit_id is not None else None
+    commit_time = commit['time'] if commit is not None else None
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, submit_flow, flow, args) for flow in flows]
+        results = [future.result() for future in futures]
+
+    for flow, submitted in zip(flows, results):
+        metrics.inc('flows_total', {'result': 'success' if submitted else 'failure'})
+        if submitted:
+            flow_state.record(flow, hashes[flow], commit_id)
+    flow_state.save()
+    if commit_time is not None:
+        metrics.observe('commit_applied_seconds', {}, time.time() - int(commit_time))
 
+    elapsed = time.time() - start
+    logging.info('Submitted %d of %d flows in %.3f seconds, %.1f flows per second.'
+                 % (sum(results), len(flows), elapsed, sum(results) / elapsed if elapsed > 0 else 0))
 
-def execute(cmd):
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate()    
+
+def execute(cmd, cwd=None, input=None):
+    start = time.time()
+    stdin = subprocess.PIPE if input is not None else None
+    proc = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    out, err = proc.communicate(input=input)
     ret = proc.returncode
-    out = out.decode('utf8')
-    err = err.decode('utf8')
+    elapsed = time.time() - start
+    metrics.observe('execute_seconds', {'command': command_label(cmd)}, elapsed)
+    if tracer is not None:
+        tracer.record('execute', start, elapsed, argv=cmd, ret=ret, out_bytes=len(out), err_bytes=len(err))
+    # blobs of any encoding are kept, see CliRepository
+    out = out.decode('utf8', 'surrogateescape')
+    err = err.decode('utf8', 'replace')
     if ret is not 0:
         logging.error('Failed to run %s, due to %s %s.' %(cmd ,err, out))
 
     return ret, out, err
 
 
-def git_manager(args):
-    # 1. get current commit id
-    cmd = ['git', 'log', '--pretty=format:%H', '-1']
+def repository(repo_dir):
+    # the repository backend of a directory, the in-process one unless the
+    # git command line is chosen by --git_backend or the repository is not supported
+    repo = repositories.get(repo_dir)
+    if repo is None:
+        repo = repositories[repo_dir] = open_repository(repo_dir, git_backend, execute)
+    return repo
+
+
+def get_upstream_ref():
+    # Return the git dir and ref tracked by the current branch when the
+    # upstream is on the local file system, otherwise None
+    cmd = ['git', 'symbolic-ref', '-q', 'HEAD']
     ret, out, _ = execute(cmd)
-    if ret is not 0:
-        return
+    if ret != 0:
+        return None
+    branch = out.strip()[len('refs/heads/'):]
+
+    cmd = ['git', 'config', '--get', 'branch.%s.remote' % branch]
+    ret, remote, _ = execute(cmd)
+    if ret != 0:
+        return None
+    cmd = ['git', 'config', '--get', 'branch.%s.merge' % branch]
+    ret, ref, _ = execute(cmd)
+    if ret != 0:
+        return None
+    cmd = ['git', 'config', '--get', 'remote.%s.url' % remote.strip()]
+    ret, url, _ = execute(cmd)
+    if ret != 0:
+        return None
 
-    commit_id = out.split('\n')     
-    if len(commit_id) == 0:
-        logging.warning('Cannot get current commit id from git log output <%s>.' % out)
+    url = url.strip()
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    git_dir = os.path.abspath(url)
+    if not os.path.isdir(git_dir):
+        logging.warning('Upstream %s is not local, it cannot be watched.' % url)
+        return None
+    if os.path.isdir(os.path.join(git_dir, '.git')):
+        git_dir = os.path.join(git_dir, '.git')
+    return git_dir, ref.strip()
+
+
+def git_manager(args):
+    # Return True if the repository changed, False if not and None if polling failed
+    # 1. get current commit id
+    repo = repository(os.getcwd())
+    commit_id = repo.head()
+    if commit_id is None:
+        logging.warning('Cannot get current commit id.')
         return
 
     logging.info('Current commint id is <%s>.' % commit_id)
@@ -127,19 +402,20 @@ def git_manager(args):
     if ret is not 0:
         return
     # 3. get operations for changed files
-    cmd = ['git', 'diff', '--name-only', commit_id[0], 'HEAD']
-    ret, out, err = execute(cmd)
-    if ret is not 0:
+    changes = repo.diff(commit_id, 'HEAD')
+    if changes is None:
         return
     
     # 4. get the flow list to be submitted/triggerred 
-    files = out.split('\n')     
+    files = [path for path, old_sha, new_sha in changes]
     if len(files) == 0:
         logging.info('There is no diff comparing with previous git status.')
-        return
+        return False
 
     logging.info('Updated files are %s.' % files)
     
+    data_index.update()
+
     operations = set() 
     for file in files:
         if file == '':
@@ -149,11 +425,17 @@ def git_manager(args):
             #maybe deleted
             if os.path.exists(file):
                 operations.add(file)
+        elif os.path.exists(file):
+            # data files are waited for by the file events of PPM, only log
+            # the jobs they are ready for
+            for flow, job in sorted(data_index.lookup(file)):
+                logging.info('Data %s is ready for job %s of flow %s.' % (file, job, flow))
 
     logging.info('Determined flows to be triggerred are %s.' % operations)
 
     # 5. submitted/triggerred flows
     submit_and_trigger_flow(operations,args)
+    return True
 
 
 def main(argv):
@@ -162,27 +444,90 @@ def main(argv):
     signal.signal(signal.SIGHUP, signal_fun)
     signal.signal(signal.SIGTERM, signal_fun)
 
-    js_envdir = os.environ.get('JS_ENVDIR', None)
-    if js_envdir is None:
-        logging.error('This tool should be run in PM context. Please source your PM profile.')
-        sys.exit(-1)
-
     parser = argparse.ArgumentParser(description='PPM workload triggerred by git.')
     parser.add_argument('-p', '--path', type=str, default=os.getcwd(), help='absolute path with PPM workload and managed by git')
     parser.add_argument('-r', '--repo', type=str, help='repo managed by git that will be cloned to current directory. eg: git@github.com:exmaple/xxx.git')
     parser.add_argument('-o', '--operation', type=str, default='trigger', help='trigger the flow or only release the flow after the repo changed, valid values: release, trigger')
-    parser.add_argument('-i', '--interval', type=int, default=5, help='interval in wainting for next pulling')
+    parser.add_argument('-i', '--interval', type=int, default=5, help='interval in wainting for next pulling, or for the fallback pulling in watch mode')
+    parser.add_argument('--max_interval', type=int, default=300, help='maximum interval the polling of an idle or failing repository backs off to')
+    parser.add_argument('--jitter', type=float, default=0.1, help='fraction of the poll interval randomly added or removed')
+    parser.add_argument('--parallel', type=int, default=4, help='maximum number of flows submitted at the same time')
+    parser.add_argument('--retries', type=int, default=2, help='times to retry submitting a flow when jsub fails')
+    parser.add_argument('--backoff', type=float, default=1, help='seconds to wait before the first retry, doubled for each next retry')
+    parser.add_argument('-s', '--state_file', type=str, default=None, help='file recording the submitted flows, by default ppm-git-trigger.state in the git directory')
+    parser.add_argument('-w', '--watch', action="store_true", help='wake up as soon as the local upstream repository receives a push')
+    parser.add_argument('--watch_socket', type=str, default=None, help='in watch mode, also wake up when a post-receive hook pokes this UNIX socket')
+    parser.add_argument('--metrics_port', type=int, default=None, help='serve metrics in the Prometheus format on this HTTP port')
+    parser.add_argument('--metrics_file', type=str, default=None, help='write metrics in the Prometheus format to this file after each poll cycle, for the textfile collector')
+    parser.add_argument('--git_backend', type=str, default='native', choices=['native', 'cli'], help='read git refs and objects in process, or run the git command line for them')
+    parser.add_argument('--trace', type=str, default=None, help='append a JSON span for each subprocess and poll cycle to this file')
+    parser.add_argument('--profile', type=str, default=None, help='print where the time goes in a file written by --trace and exit')
+    parser.add_argument('--profile_top', type=int, default=10, help='number of commands and cycles listed by --profile')
     args = parser.parse_args()
 
+    if args.profile:
+        try:
+            profile_report(args.profile, args.profile_top)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            logging.error('Cannot read trace from %s: %s.' % (args.profile, e))
+            sys.exit(-1)
+        sys.exit(0)
+
+    js_envdir = os.environ.get('JS_ENVDIR', None)
+    if js_envdir is None:
+        logging.error('This tool should be run in PM context. Please source your PM profile.')
+        sys.exit(-1)
+
+    global git_backend
+    git_backend = args.git_backend
+
+    global tracer
+    if args.trace:
+        tracer = Tracer(os.path.abspath(args.trace))
+
     if args.operation != 'release' and args.operation != 'trigger':
         logging.error('You specified operation: %s is not supported, only support "release" or "trigger".' % args.operation)
         sys.exit(-1)
 
+    if args.metrics_port is not None:
+        try:
+            metrics.serve(args.metrics_port)
+        except (IOError, OSError) as e:
+            logging.error('Cannot serve metrics on port %d: %s.' % (args.metrics_port, e))
+            sys.exit(-1)
+    if args.metrics_file:
+        args.metrics_file = os.path.abspath(args.metrics_file)
+
+    trace_group.set({'cycle': '%d-%d' % (os.getpid(), next(trace_cycles))})
     init_submit(args)
-  
+
+    watcher = None
+    if args.watch:
+        ref_file = get_upstream_ref()
+        watcher = RefWatcher([ref_file] if ref_file else [], args.watch_socket)
+
+    scheduler = PollScheduler([os.getcwd()], args.interval, args.max_interval, args.jitter)
     while True:
-        git_manager(args)
-        time.sleep(args.interval)
+        cycle_start = time.time()
+        trace_group.set({'cycle': '%d-%d' % (os.getpid(), next(trace_cycles))})
+        changed = git_manager(args)
+        scheduler.record(os.getcwd(), changed is True, changed is None)
+        metrics.observe('poll_cycle_seconds', {}, time.time() - cycle_start)
+        if tracer is not None:
+            tracer.record('cycle', cycle_start, time.time() - cycle_start)
+        if args.metrics_file:
+            try:
+                metrics.write(args.metrics_file)
+            except (IOError, OSError) as e:
+                logging.warning('Cannot write metrics to %s: %s.' % (args.metrics_file, e))
+
+        if watcher is None:
+            time.sleep(scheduler.wait())
+            continue
+
+        wait_start = time.time()
+        if watcher.wait(scheduler.wait()):
+            logging.debug('Woken up by upstream change after waiting %.3f seconds.' % (time.time() - wait_start))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+import os
+import sys
+import argparse
+import subprocess
+import importlib.util
+
+import pytest
+
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+sys.path.insert(0, os.path.join(src_dir, 'common'))
+
+# commits of the test repositories do not depend on the user and the clock
+git_env = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com',
+               GIT_AUTHOR_DATE='1600000000 +0000', GIT_COMMITTER_DATE='1600000000 +0000',
+               GIT_CONFIG_GLOBAL=os.devnull, GIT_CONFIG_NOSYSTEM='1')
+
+
+def load_script(path, name):
+    # the scripts have dashes in their names, so they are loaded by path
+    spec = importlib.util.spec_from_file_location(name, os.path.join(src_dir, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def git(repo_dir, *args):
+    return subprocess.check_output(('git',) + args, cwd=repo_dir, env=git_env).decode('utf8').strip()
+
+
+def execute(cmd, cwd=None, input=None):
+    # the execute given to the repository backends by the scripts
+    proc = subprocess.run(cmd, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, env=git_env)
+    return proc.returncode, proc.stdout.decode('utf8', 'surrogateescape'), proc.stderr.decode('utf8', 'replace')
+
+
+@pytest.fixture
+def repo(tmp_path):
+    repo_dir = str(tmp_path / 'repo')
+    os.mkdir(repo_dir)
+    git(repo_dir, 'init', '-q', '-b', 'master')
+    return repo_dir
+
+
+@pytest.fixture(scope='session')
+def lsf():
+    return load_script(os.path.join('lsf', 'lsf-git-configure.py'), 'lsf_git_configure')
+
+
+@pytest.fixture(scope='session')
+def ppm():
+    return load_script(os.path.join('ppm', 'ppm-git-trigger.py'), 'ppm_git_trigger')
+
+
+# LSF and PPM commands replaced by stubs logging their arguments. A stub fails when
+# a "<name>.fail" file is in its directory, and bhosts and lshosts list the
+# hosts of the "hosts" file.
+stub_template = '''#!/bin/sh
+dir=$(dirname "$0")
+echo "$(basename "$0") $*" >> "$dir/calls.log"
+case "$(basename "$0")" in
+    bhosts|lshosts)
+        echo HOST_NAME
+        cat "$dir/hosts" 2>/dev/null
+        ;;
+esac
+[ -e "$dir/$(basename "$0").fail" ] && exit 1
+exit 0
+'''
+
+
+class Stubs(object):
+
+    def __init__(self, bin_dir):
+        self.bin_dir = bin_dir
+        os.mkdir(bin_dir)
+        for name in ('lsadmin', 'badmin', 'bhosts', 'lshosts', 'jsub', 'jrelease', 'jtrigger'):
+            path = os.path.join(bin_dir, name)
+            with open(path, 'w') as f:
+                f.write(stub_template)
+            os.chmod(path, 0o755)
+        self.env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'])
+
+    def fail(self, name, failed=True):
+        path = os.path.join(self.bin_dir, name + '.fail')
+        if failed:
+            open(path, 'w').close()
+        elif os.path.exists(path):
+            os.unlink(path)
+
+    def set_hosts(self, hosts):
+        with open(os.path.join(self.bin_dir, 'hosts'), 'w') as f:
+            f.write(''.join(host + '\n' for host in hosts))
+
+    def calls(self):
+        # the calls since the last one
+        path = os.path.join(self.bin_dir, 'calls.log')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            calls = f.read().splitlines()
+        os.unlink(path)
+        return calls
+
+
+@pytest.fixture
+def stubs(tmp_path):
+    return Stubs(str(tmp_path / 'bin'))
+
+
+def commit_files(repo_dir, files, message='change'):
+    for path, content in files.items():
+        path = os.path.join(repo_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+    git(repo_dir, 'add', '-A')
+    git(repo_dir, 'commit', '-q', '-m', message)
+    return git(repo_dir, 'rev-parse', 'HEAD')
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    # a bare upstream repository with LSF configuration files, and a clone
+    # pushing to it; clone() makes more clones, such as the managed LSF_ENVDIR
+    bare = str(tmp_path / 'upstream.git')
+    git(str(tmp_path), 'init', '-q', '--bare', '-b', 'master', bare)
+    pusher = clone(bare, str(tmp_path / 'pusher'))
+    commit_files(pusher, {'lsf.conf': 'LSF_LOG_MASK=LOG_WARNING\n',
+                          'lsbatch/cluster1/configdir/lsb.queues': 'Begin Queue\nQUEUE_NAME = normal\nEnd Queue\n'},
+                 'first')
+    git(pusher, 'push', '-q', 'origin', 'master')
+    return bare, pusher
+
+
+def clone(url, repo_dir):
+    git(os.path.dirname(repo_dir), 'clone', '-q', url, repo_dir)
+    return repo_dir
+
+
+def cluster_args(**options):
+    args = dict(watch_socket=None, interval=0, max_interval=0, jitter=0, coalesce=0, workers=4, timeout=None,
+                retries=0, batch_size=0, batch_interval=0, metrics_file=None)
+    args.update(options)
+    return argparse.Namespace(**args)
+
+
+@pytest.fixture
+def envdir(upstream, tmp_path):
+    # the LSF_ENVDIR managed by the tool, a clone of the upstream
+    return clone(upstream[0], str(tmp_path / 'envdir'))
+
+
+def new_cluster(lsf, envdir, stubs):
+    # a cluster as created when the tool starts, with nothing cached
+    lsf.upstream_state.pop(envdir, None)
+    lsf.repositories.pop(envdir, None)
+    return lsf.Cluster('cluster1', envdir, None, stubs.env, lsf.operation_rules, None, cluster_args())
+
+
+def push_queue_change(pusher, name):
+    commit_files(pusher, {'lsbatch/cluster1/configdir/lsb.queues':
+                          'Begin Queue\nQUEUE_NAME = %s\nEnd Queue\n' % name})
+    git(pusher, 'push', '-q', 'origin', 'master')
+    return git(pusher, 'rev-parse', 'HEAD')
+
+
+def poll(cluster):
+    cluster.scheduler.wake()
+    cluster.poll()
@@ -0,0 +1,278 @@
+import os
+import shutil
+import struct
+import hashlib
+import itertools
+
+import pytest
+
+import gitops
+from conftest import git, execute
+
+
+def write(repo_dir, path, content):
+    path = os.path.join(repo_dir, path)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def remove(repo_dir, path):
+    path = os.path.join(repo_dir, path)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def text(seed, lines=200):
+    # long enough for the repack to store the next versions as deltas
+    return ''.join('Begin Queue %d line %d\n' % (seed if i == 7 else 0, i) for i in range(lines))
+
+
+def commit(repo_dir, message):
+    git(repo_dir, 'add', '-A')
+    git(repo_dir, 'commit', '-q', '--allow-empty', '-m', message)
+    return git(repo_dir, 'rev-parse', 'HEAD')
+
+
+@pytest.fixture
+def history(repo):
+    # commits changing, adding and deleting files, turning a file into a
+    # directory and back, and changing a file mode
+    commits = []
+    write(repo, 'lsb.queues', text(1))
+    write(repo, 'conf/lsf.conf', text(2))
+    write(repo, 'conf/hosts', 'host1\n')
+    write(repo, 'mode', 'x\n')
+    commits.append(commit(repo, 'first'))
+
+    write(repo, 'lsb.queues', text(3))
+    write(repo, 'conf/deep/lsb.hosts', text(4))
+    commits.append(commit(repo, 'nested'))
+
+    remove(repo, 'conf/hosts')
+    write(repo, 'conf/hosts/part', 'host2\n')
+    write(repo, 'lsb.queues', text(5))
+    os.chmod(os.path.join(repo, 'mode'), 0o755)
+    commits.append(commit(repo, 'file to directory'))
+
+    remove(repo, 'conf/hosts')
+    write(repo, 'conf/hosts', 'host3\n')
+    remove(repo, 'conf/deep')
+    write(repo, 'conf', text(6))
+    commits.append(commit(repo, 'directory to file'))
+
+    commits.append(commit(repo, 'empty'))
+    return commits
+
+
+def pack_kinds(store):
+    # object types of the entries of the packs, 6 for OFS_DELTA and 7 for REF_DELTA
+    kinds = set()
+    for pack in store.packs.values():
+        idx, count = pack['idx'], pack['count']
+        for i in range(count):
+            pos = 1032 + 24 * count + 4 * i
+            offset = struct.unpack('>I', idx[pos:pos + 4])[0]
+            kinds.add((pack['pack'][offset] >> 4) & 7)
+    return kinds
+
+
+def assert_parity(repo_dir, commits):
+    native = gitops.NativeRepository(repo_dir, execute)
+    cli = gitops.CliRepository(repo_dir, execute)
+    for old, new in itertools.permutations(commits, 2):
+        assert native.diff(old, new) == sorted(cli.diff(old, new))
+    for name in commits + ['HEAD', 'master']:
+        assert native.commit(name) == cli.commit(name)
+        assert native.files(name) == sorted(cli.files(name))
+        for path, sha in cli.files(name):
+            assert native.blob(sha) == cli.blob(sha)
+    return native
+
+
+def test_diff_parity_loose(repo, history):
+    native = assert_parity(repo, history)
+    assert native.store.packs == {}
+
+
+def test_diff_parity_ofs_delta(repo, history):
+    git(repo, '-c', 'pack.window=50', 'repack', '-q', '-a', '-d', '-f')
+    git(repo, 'prune-packed')
+    native = assert_parity(repo, history)
+    assert 6 in pack_kinds(native.store)
+    assert 7 not in pack_kinds(native.store)
+
+
+def test_diff_parity_ref_delta(repo, history):
+    git(repo, '-c', 'repack.useDeltaBaseOffset=false', '-c', 'pack.window=50', 'repack', '-q', '-a', '-d', '-f')
+    git(repo, 'prune-packed')
+    native = assert_parity(repo, history)
+    assert 7 in pack_kinds(native.store)
+    assert 6 not in pack_kinds(native.store)
+
+
+def test_file_directory_change(repo, history):
+    native = gitops.NativeRepository(repo, execute)
+    changes = native.diff(history[1], history[2])
+    null = gitops.NULL_SHA
+    paths = dict((path, (old != null, new != null)) for path, old, new in changes)
+    assert paths['conf/hosts'] == (True, False)
+    assert paths['conf/hosts/part'] == (False, True)
+
+    changes = native.diff(history[2], history[3])
+    paths = dict((path, (old != null, new != null)) for path, old, new in changes)
+    assert paths['conf'] == (False, True)
+    assert paths['conf/lsf.conf'] == (True, False)
+    assert paths['conf/hosts/part'] == (True, False)
+
+
+def large_offset_idx(idx):
+    # rewrite a version 2 index with the offsets but the first one in the 64
+    # bit table, git allows at most count - 1 entries there
+    count = struct.unpack('>I', idx[1028:1032])[0]
+    offsets_pos = 1032 + 24 * count
+    offsets = struct.unpack('>%dI' % count, idx[offsets_pos:offsets_pos + 4 * count])
+    pack_checksum = idx[-40:-20]
+    data = idx[:offsets_pos]
+    data += struct.pack('>%dI' % count, offsets[0], *[0x80000000 | i for i in range(count - 1)])
+    data += struct.pack('>%dQ' % (count - 1), *offsets[1:])
+    data += pack_checksum
+    return data + hashlib.sha1(data).digest()
+
+
+def test_idx_large_offsets(repo, history):
+    git(repo, 'repack', '-q', '-a', '-d')
+    git(repo, 'prune-packed')
+    pack_dir = os.path.join(repo, '.git', 'objects', 'pack')
+    for name in os.listdir(pack_dir):
+        if name.endswith('.idx'):
+            path = os.path.join(pack_dir, name)
+            with open(path, 'rb') as f:
+                idx = f.read()
+            os.chmod(path, 0o644)
+            with open(path, 'wb') as f:
+                f.write(large_offset_idx(idx))
+    assert git(repo, 'fsck', '--no-dangling') == ''
+    assert_parity(repo, history)
+
+
+def test_idx_lookup():
+    # an index of objects starting with 00, 7f and ff bytes, one of them beyond 4 GiB
+    shas = sorted([b'\0' * 20, b'\0' + b'\1' * 19, b'\x7f' * 20, b'\xff' * 20])
+    offsets = [12, 0x123456789, 300, 0x7fffffff]
+    fanout = [sum(1 for sha in shas if sha[0] <= i) for i in range(256)]
+    idx = b'\377tOc\0\0\0\2' + struct.pack('>256I', *fanout) + b''.join(shas) + b'\0' * 4 * len(shas)
+    large = []
+    for offset in offsets:
+        if offset >= 0x80000000:
+            idx += struct.pack('>I', 0x80000000 | len(large))
+            large.append(offset)
+        else:
+            idx += struct.pack('>I', offset)
+    idx += b''.join(struct.pack('>Q', offset) for offset in large)
+
+    store = gitops.GitObjectStore('/nonexistent')
+    pack = {'idx': idx, 'fanout': fanout, 'count': fanout[255]}
+    for sha, offset in zip(shas, offsets):
+        assert store.find_offset(pack, sha) == offset
+    assert store.find_offset(pack, b'\0' * 19 + b'\1') is None
+    assert store.find_offset(pack, b'\x80' * 20) is None
+    assert store.find_offset(pack, b'\xff' * 19 + b'\xfe') is None
+
+
+def test_idx_version(repo, history):
+    git(repo, 'repack', '-q', '-a', '-d')
+    pack_dir = os.path.join(repo, '.git', 'objects', 'pack')
+    path = os.path.join(pack_dir, [name for name in os.listdir(pack_dir) if name.endswith('.idx')][0])
+    os.chmod(path, 0o644)
+    with open(path, 'r+b') as f:
+        f.seek(7)
+        f.write(b'\3')
+    with pytest.raises(ValueError):
+        gitops.GitObjectStore(os.path.join(repo, '.git', 'objects'))
+    assert isinstance(gitops.open_repository(repo, 'native', execute), gitops.CliRepository)
+
+
+def recording(calls):
+    def execute_recorded(cmd, cwd=None, input=None):
+        calls.append(cmd[1])
+        return execute(cmd, cwd=cwd, input=input)
+    return execute_recorded
+
+
+def test_open_repository(repo, history, tmp_path):
+    assert isinstance(gitops.open_repository(repo, 'native', execute), gitops.NativeRepository)
+    assert isinstance(gitops.open_repository(repo, 'cli', execute), gitops.CliRepository)
+    assert isinstance(gitops.open_repository(str(tmp_path), 'native', execute), gitops.CliRepository)
+
+    with open(os.path.join(repo, '.git', 'config'), 'a') as f:
+        f.write('[extensions]\n\tobjectformat = sha256\n')
+    assert isinstance(gitops.open_repository(repo, 'native', execute), gitops.CliRepository)
+
+
+def test_fallback(repo, history):
+    calls = []
+    native = gitops.NativeRepository(repo, recording(calls))
+    cli = gitops.CliRepository(repo, execute)
+
+    # names other than refs and SHAs are resolved by git
+    assert native.resolve('HEAD~2') == history[2]
+    assert calls == ['rev-parse']
+    assert native.commit('HEAD~2') == cli.commit(history[2])
+
+    # objects the store cannot read are read by git
+    del calls[:]
+    def missing(sha):
+        raise KeyError('Object %s is not found.' % sha)
+    native.store.read = missing
+    assert native.diff(history[0], history[3]) == cli.diff(history[0], history[3])
+    assert native.files(history[1]) == cli.files(history[1])
+    sha = cli.files(history[1])[0][1]
+    assert native.blob(sha) == cli.blob(sha)
+    assert native.blobs([sha]) == {sha: cli.blob(sha)}
+    assert set(calls) == set(['rev-parse', 'cat-file', 'diff', 'ls-tree'])
+
+
+def test_blobs(repo, history):
+    native = gitops.NativeRepository(repo, execute)
+    cli = gitops.CliRepository(repo, execute)
+    shas = [sha for path, sha in cli.files(history[3])]
+    assert native.blobs(shas) == cli.blobs(shas)
+    assert sorted(cli.blobs(shas)) == sorted(shas)
+
+
+@pytest.mark.parametrize('cmd, label', [
+    (['git', 'pull', '--ff-only'], 'git pull'),
+    (['git', '-C', '/repo', '-c', 'gc.auto=0', 'fetch', 'origin'], 'git fetch'),
+    (['git', '-C', '/repo'], 'git'),
+    (['/usr/bin/git', 'ls-remote', 'origin'], 'git ls-remote'),
+    (['badmin', 'hrestart', '-f', 'host1'], 'badmin hrestart'),
+    (['lsadmin'], 'lsadmin'),
+    (['bhosts', '-w'], 'bhosts'),
+])
+def test_command_label(cmd, label):
+    assert gitops.command_label(cmd) == label
+
+
+def test_binary_blobs(repo):
+    # blobs and paths which are not UTF-8 are read as they are by both backends
+    data = b'LSB_NAME="\xe9t\xe9"\n\xff\xfe\x00\x01'
+    path = os.path.join(repo.encode(), b'lsb.\xe9t\xe9')
+    with open(path, 'wb') as f:
+        f.write(data)
+    first = commit(repo, 'binary')
+    with open(path, 'wb') as f:
+        f.write(data + b'\x80')
+    second = commit(repo, 'binary change')
+
+    native = gitops.NativeRepository(repo, execute)
+    cli = gitops.CliRepository(repo, execute)
+    shas = [sha for path, sha in cli.files(first) + cli.files(second)]
+    assert [cli.blob(sha) for sha in shas] == [data, data + b'\x80']
+    assert cli.blobs(shas) == native.blobs(shas) == {shas[0]: data, shas[1]: data + b'\x80'}
+    assert cli.diff(first, second) == native.diff(first, second)
+    assert cli.files(second) == native.files(second)
@@ -0,0 +1,73 @@
+import pytest
+
+
+@pytest.mark.parametrize('hosts, calls', [
+    (['host2', 'host1', 'host3'],
+     ['bhosts -w', 'badmin hrestart -f host1 host2', 'badmin hrestart -f host3']),
+    # with no host listed the operation is taken on all hosts
+    ([], ['bhosts -w', 'badmin hrestart -f all']),
+])
+def test_batches(lsf, stubs, hosts, calls):
+    stubs.set_hosts(hosts)
+    assert lsf.do_actions(None, set(['sbd-restart']), batch_size=2, env=stubs.env)
+    assert stubs.calls() == calls
+
+
+def test_batches_failed_listing(lsf, stubs):
+    stubs.fail('bhosts')
+    assert lsf.do_actions(None, set(['sbd-restart']), batch_size=2, env=stubs.env)
+    assert stubs.calls() == ['bhosts -w', 'badmin hrestart -f all']
+
+
+@pytest.mark.parametrize('operations, planned', [
+    (['mbd-restart', 'mbd-reconfig'], ['mbd-restart']),
+    (['lim-restart', 'lim-reconfig', 'mbd-reconfig'], ['lim-restart', 'mbd-reconfig']),
+    (['lim-reconfig', 'mbd-reconfig'], ['lim-reconfig', 'mbd-reconfig']),
+    # an operation on all hosts covers the same operation on given hosts
+    (['sbd-restart', 'sbd-restart@host1', 'res-restart@host2'], ['sbd-restart', 'res-restart@host2']),
+    (['sbd-restart@host1', 'sbd-restart@host2'], ['sbd-restart@host1', 'sbd-restart@host2']),
+    ([], []),
+])
+def test_plan_operations(lsf, operations, planned):
+    assert lsf.plan_operations(set(operations)) == set(planned)
+
+
+def test_dominated_operation_not_taken(lsf, stubs):
+    assert lsf.do_actions(None, set(['mbd-reconfig', 'mbd-restart', 'lim-reconfig']), env=stubs.env)
+    assert stubs.calls() == ['lsadmin reconfig -f', 'badmin mbdrestart -f']
+
+
+def test_dependency_order(lsf, stubs):
+    operations = set(['mbd-restart', 'sbd-restart', 'res-restart', 'lim-restart'])
+    assert lsf.do_actions(None, operations, env=stubs.env)
+    calls = stubs.calls()
+    # LIM first and MBD last, sbatchd and RES in between in any order
+    assert calls[0] == 'lsadmin limrestart -f all'
+    assert sorted(calls[1:3]) == ['badmin hrestart -f all', 'lsadmin resrestart -f all']
+    assert calls[3:] == ['badmin mbdrestart -f']
+
+
+def test_failure_skips_dependents(lsf, stubs):
+    stubs.fail('lsadmin')
+    operations = set(['lim-restart', 'lim-reconfig', 'sbd-restart', 'mbd-reconfig'])
+    assert not lsf.do_actions(None, operations, env=stubs.env)
+    assert stubs.calls() == ['lsadmin limrestart -f all']
+
+
+def test_failure_keeps_independents(lsf, stubs):
+    stubs.fail('badmin')
+    operations = set(['lim-reconfig', 'res-restart', 'sbd-restart', 'mbd-reconfig'])
+    assert not lsf.do_actions(None, operations, env=stubs.env)
+    calls = stubs.calls()
+    # RES is restarted though sbatchd failed, and MBD is not reconfigured
+    assert calls[0] == 'lsadmin reconfig -f'
+    assert sorted(calls[1:]) == ['badmin hrestart -f all', 'lsadmin resrestart -f all']
+
+
+def test_retries(lsf, stubs, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(lsf.time, 'sleep', sleeps.append)
+    stubs.fail('badmin')
+    assert not lsf.do_actions(None, set(['mbd-reconfig']), retries=2, env=stubs.env)
+    assert stubs.calls() == ['badmin reconfig -f'] * 3
+    assert sleeps == [1, 2]
@@ -0,0 +1,68 @@
+import os
+
+from conftest import git, new_cluster, push_queue_change, poll
+
+
+def test_checkpoint_advances(lsf, upstream, envdir, stubs):
+    cluster = new_cluster(lsf, envdir, stubs)
+    poll(cluster)
+    head = push_queue_change(upstream[1], 'night')
+    poll(cluster)
+    assert stubs.calls() == ['badmin reconfig -f']
+    assert lsf.read_checkpoint(envdir) == head
+
+    # nothing new, nothing taken
+    poll(cluster)
+    assert stubs.calls() == []
+
+
+def test_failed_apply_retried_without_checkpoint(lsf, upstream, envdir, stubs):
+    # the first poll pulls a change before any checkpoint is written
+    first = git(envdir, 'rev-parse', 'HEAD')
+    head = push_queue_change(upstream[1], 'night')
+    stubs.fail('badmin')
+    cluster = new_cluster(lsf, envdir, stubs)
+    poll(cluster)
+    assert stubs.calls() == ['badmin reconfig -f']
+    assert git(envdir, 'rev-parse', 'HEAD') == head
+    assert lsf.read_checkpoint(envdir) == first
+
+    # retried by the next poll until it succeeds
+    poll(cluster)
+    assert stubs.calls() == ['badmin reconfig -f']
+    stubs.fail('badmin', False)
+    poll(cluster)
+    assert stubs.calls() == ['badmin reconfig -f']
+    assert lsf.read_checkpoint(envdir) == head
+    poll(cluster)
+    assert stubs.calls() == []
+
+
+def test_failed_apply_resumed_after_restart(lsf, upstream, envdir, stubs):
+    cluster = new_cluster(lsf, envdir, stubs)
+    poll(cluster)
+    applied = lsf.read_checkpoint(envdir)
+    head = push_queue_change(upstream[1], 'night')
+    stubs.fail('badmin')
+    poll(cluster)
+    assert stubs.calls() == ['badmin reconfig -f']
+    assert lsf.read_checkpoint(envdir) == applied
+
+    # the changes since the checkpoint are taken by the restarted tool
+    stubs.fail('badmin', False)
+    cluster = new_cluster(lsf, envdir, stubs)
+    poll(cluster)
+    assert stubs.calls() == ['badmin reconfig -f']
+    assert lsf.read_checkpoint(envdir) == head
+
+
+def test_unreadable_checkpoint(lsf, upstream, envdir, stubs):
+    cluster = new_cluster(lsf, envdir, stubs)
+    poll(cluster)
+    with open(os.path.join(envdir, '.git', 'lsf-git-ops', 'checkpoint.json'), 'w') as f:
+        f.write('{"commit": "%s"}' % ('1' * 40))
+    head = push_queue_change(upstream[1], 'night')
+    poll(cluster)
+    # the changes since the HEAD before the pull are taken
+    assert stubs.calls() == ['badmin reconfig -f']
+    assert lsf.read_checkpoint(envdir) == head
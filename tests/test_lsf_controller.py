@@ -0,0 +1,39 @@
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+
+import pytest
+
+from conftest import src_dir, clone
+
+
+@pytest.mark.parametrize('signum', [signal.SIGTERM, signal.SIGINT])
+def test_signal(upstream, stubs, tmp_path, signum):
+    # clusters managed by one event loop stop on a signal without a traceback
+    clusters = [{'envdir': clone(upstream[0], str(tmp_path / name)), 'name': name} for name in ('c1', 'c2')]
+    clusters_file = str(tmp_path / 'clusters.json')
+    with open(clusters_file, 'w') as f:
+        json.dump({'clusters': clusters}, f)
+
+    log_path = str(tmp_path / 'run.log')
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen([sys.executable, os.path.join(src_dir, 'lsf', 'lsf-git-configure.py'),
+                                 '--clusters', clusters_file], stdout=log, stderr=subprocess.STDOUT, env=stubs.env)
+    try:
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            with open(log_path) as f:
+                if f.read().count('Next poll') >= 2:
+                    break
+            time.sleep(0.1)
+        proc.send_signal(signum)
+        assert proc.wait(30) == 1
+    finally:
+        proc.kill()
+    with open(log_path) as f:
+        output = f.read()
+    assert 'Signal <%d> is received, exit.' % signum in output
+    assert 'Traceback' not in output
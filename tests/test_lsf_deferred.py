@@ -0,0 +1,91 @@
+import os
+import json
+
+from conftest import new_cluster, push_queue_change, poll
+
+
+def test_state(lsf, tmp_path):
+    path = str(tmp_path / 'deferred.json')
+    deferred = lsf.DeferredOperations(path)
+    deferred.add(set(['mbd-restart']), '1' * 40, None)
+    since = deferred.since
+    # the first commits and time of the deferred operations are kept
+    deferred.add(set(['sbd-restart']), '2' * 40, '3' * 40)
+
+    deferred = lsf.DeferredOperations(path)
+    assert deferred.operations == set(['mbd-restart', 'sbd-restart'])
+    assert deferred.since == since
+    assert deferred.commits == {'private': '1' * 40, 'shared': '3' * 40}
+
+    deferred.clear()
+    deferred = lsf.DeferredOperations(path)
+    assert deferred.operations == set()
+    assert deferred.since is None
+
+
+def test_unreadable_state(lsf, tmp_path):
+    path = str(tmp_path / 'deferred.json')
+    for content in ('{', '[]', '{"operations": 1}', '{"since": 0}'):
+        with open(path, 'w') as f:
+            f.write(content)
+        assert lsf.DeferredOperations(path).operations == set()
+
+
+def set_load(tmp_path, load):
+    with open(str(tmp_path / 'load'), 'w') as f:
+        f.write('%d\n' % load)
+
+
+def policy(lsf, tmp_path):
+    # mbd-reconfig is taken when the load is at most 10
+    return lsf.MaintenancePolicy(None, 10, ['cat', str(tmp_path / 'load')], ['mbd-reconfig'])
+
+
+def test_deferred_across_restart(lsf, upstream, envdir, stubs, tmp_path):
+    cluster = new_cluster(lsf, envdir, stubs)
+    cluster.policy = policy(lsf, tmp_path)
+    set_load(tmp_path, 100)
+    poll(cluster)
+    head = push_queue_change(upstream[1], 'night')
+    poll(cluster)
+    assert stubs.calls() == []
+    # the commit is applied, and the operation is kept to be taken later
+    assert lsf.read_checkpoint(envdir) == head
+    with open(os.path.join(envdir, '.git', 'lsf-git-ops', 'deferred.json')) as f:
+        assert json.load(f)['operations'] == ['mbd-reconfig']
+
+    # taken by the restarted tool when the load is low
+    cluster = new_cluster(lsf, envdir, stubs)
+    cluster.policy = policy(lsf, tmp_path)
+    poll(cluster)
+    assert stubs.calls() == []
+    set_load(tmp_path, 1)
+    poll(cluster)
+    assert stubs.calls() == ['badmin reconfig -f']
+    assert cluster.deferred.operations == set()
+    poll(cluster)
+    assert stubs.calls() == []
+
+
+def test_deferred_failure_retried(lsf, upstream, envdir, stubs, tmp_path):
+    cluster = new_cluster(lsf, envdir, stubs)
+    cluster.policy = policy(lsf, tmp_path)
+    set_load(tmp_path, 100)
+    poll(cluster)
+    push_queue_change(upstream[1], 'night')
+    poll(cluster)
+    set_load(tmp_path, 1)
+    stubs.fail('badmin')
+    poll(cluster)
+    assert stubs.calls() == ['badmin reconfig -f']
+    assert cluster.deferred.operations == set(['mbd-reconfig'])
+
+    # retried no sooner than max_interval after the failure
+    cluster.args.max_interval = 3600
+    stubs.fail('badmin', False)
+    poll(cluster)
+    assert stubs.calls() == []
+    cluster.deferred.tried = 0
+    poll(cluster)
+    assert stubs.calls() == ['badmin reconfig -f']
+    assert cluster.deferred.operations == set()
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from conftest import git, clone
+
+
+ref = 'refs/lsf-git-ops/journal'
+
+
+@pytest.fixture
+def journals(lsf, upstream, tmp_path):
+    # journals of two clones of the upstream, flushed by the tests only
+    return [lsf.Journal(clone(upstream[0], str(tmp_path / name)), 3600) for name in ('clone1', 'clone2')]
+
+
+def record(journal, commit_id):
+    journal.record('cluster1', commit_id, None, set(['mbd-reconfig']), True)
+
+
+def journal_entries(repo_dir, name=ref):
+    # private commits of the entries of a journal, oldest first
+    entries = []
+    for commit in git(repo_dir, 'rev-list', '--reverse', '--topo-order', '--no-merges', name).split():
+        for line in git(repo_dir, 'cat-file', 'blob', commit + ':journal.jsonl').splitlines():
+            entries.append(json.loads(line)['private_commit'])
+    return entries
+
+
+def test_flush(upstream, journals):
+    bare = upstream[0]
+    record(journals[0], '1' * 40)
+    record(journals[0], '2' * 40)
+    journals[0].flush()
+    assert journal_entries(bare) == ['1' * 40, '2' * 40]
+    assert journals[0].pushed
+
+    # nothing new, nothing written
+    head = git(bare, 'rev-parse', ref)
+    journals[0].flush()
+    assert git(bare, 'rev-parse', ref) == head
+
+
+def test_push_from_two_clones(upstream, journals):
+    bare = upstream[0]
+    record(journals[0], '1' * 40)
+    journals[0].flush()
+    # the second clone takes the journal of the first one before committing
+    record(journals[1], '2' * 40)
+    journals[1].flush()
+    assert journals[1].pushed
+    assert journal_entries(bare) == ['1' * 40, '2' * 40]
+    assert git(bare, 'rev-list', '--merges', ref) == ''
+
+
+def test_push_diverged(upstream, journals):
+    bare = upstream[0]
+    record(journals[0], '1' * 40)
+    journals[0].flush()
+    # the second clone commits without taking the journal of the first
+    # one, as if its push had failed, and the first one pushes again
+    record(journals[1], '3' * 40)
+    assert journals[1].commit(journals[1].entries)
+    journals[1].entries = []
+    journals[1].pushed = False
+    record(journals[0], '2' * 40)
+    journals[0].flush()
+    journals[1].flush()
+    assert journals[1].pushed
+    assert sorted(journal_entries(bare)) == ['1' * 40, '2' * 40, '3' * 40]
+    assert len(git(bare, 'rev-list', '--merges', ref).split()) == 1
+
+    # the first clone fast-forwards to the merge
+    record(journals[0], '4' * 40)
+    journals[0].flush()
+    assert journals[0].pushed
+    assert sorted(journal_entries(bare)) == ['1' * 40, '2' * 40, '3' * 40, '4' * 40]
+    assert journal_entries(journals[0].lsf_envdir) == journal_entries(bare)
+
+
+def test_failed_push_kept(lsf, upstream, journals, tmp_path):
+    envdir = journals[0].lsf_envdir
+    record(journals[0], '1' * 40)
+    git(envdir, 'remote', 'set-url', 'origin', str(tmp_path / 'missing.git'))
+    journals[0].flush()
+    assert not journals[0].pushed
+    assert journal_entries(envdir) == ['1' * 40]
+
+    # pushed by the next flush once the upstream is back
+    git(envdir, 'remote', 'set-url', 'origin', upstream[0])
+    lsf.upstream_state.pop(envdir)
+    journals[0].flush()
+    assert journals[0].pushed
+    assert journal_entries(upstream[0]) == ['1' * 40]
@@ -0,0 +1,92 @@
+import pytest
+
+
+@pytest.mark.parametrize('text, params', [
+    ('LSF_LOG_MASK=LOG_WARNING', {'LSF_LOG_MASK': 'LOG_WARNING'}),
+    ('LSB_DEBUG_MBD = LC_TRACE LC_SCHED   # debug', {'LSB_DEBUG_MBD': 'LC_TRACE LC_SCHED'}),
+    ('LSF_SERVERDIR = "/opt/lsf # dir"  # comment', {'LSF_SERVERDIR': '/opt/lsf # dir'}),
+    ("LSB_QUEUE='night  queue'", {'LSB_QUEUE': 'night  queue'}),
+    ('LSF_STRIP=a#b', {'LSF_STRIP': 'a#b'}),
+    ('LSF_EMPTY=', {'LSF_EMPTY': ''}),
+    ('# LSF_OFF=1\n   # LSF_INDENTED=1\n\n', {}),
+    ('not a parameter\nLSF_ON=1', {'LSF_ON': '1'}),
+    ('LSB_DEBUG_MBD = LC_TRACE \\\nLC_SCHED', {'LSB_DEBUG_MBD': 'LC_TRACE LC_SCHED'}),
+    ('LSF_LIST="a \\\nb"', {'LSF_LIST': 'a b'}),
+    ('LSF_TWICE=1\nLSF_TWICE=2', {'LSF_TWICE': '2'}),
+])
+def test_parse_lsf_conf(lsf, text, params):
+    assert lsf.parse_lsf_conf(text) == params
+
+
+queue_normal = '''Begin Queue
+QUEUE_NAME = normal
+PRIORITY = 30
+End Queue
+'''
+
+
+@pytest.mark.parametrize('text, model', [
+    # key/value sections are keyed by their name
+    (queue_normal, {'Queue normal': ('Queue', {'QUEUE_NAME': 'normal', 'PRIORITY': '30'})}),
+    ('Begin Queue\n  QUEUE_NAME   =  normal  # the default\n# PRIORITY = 10\n\nPRIORITY=30\nEnd Queue',
+     {'Queue normal': ('Queue', {'QUEUE_NAME': 'normal', 'PRIORITY': '30'})}),
+    ('Begin Queue\nQUEUE_NAME = normal\nDESCRIPTION = "two  spaces # kept"   # comment\nEnd Queue',
+     {'Queue normal': ('Queue', {'QUEUE_NAME': 'normal', 'DESCRIPTION': '"two  spaces # kept"'})}),
+    ("Begin Queue\nQUEUE_NAME = normal\nDESCRIPTION = Joe's   queue # comment\nEnd Queue",
+     {'Queue normal': ('Queue', {'QUEUE_NAME': 'normal', 'DESCRIPTION': "Joe's queue"})}),
+    ('Begin Queue\nQUEUE_NAME = normal\nUSERS = user1 \\\n    user2\nEnd Queue',
+     {'Queue normal': ('Queue', {'QUEUE_NAME': 'normal', 'USERS': 'user1 user2'})}),
+    # sections of the same name
+    (queue_normal + queue_normal.replace('normal', 'night'),
+     {'Queue normal': ('Queue', {'QUEUE_NAME': 'normal', 'PRIORITY': '30'}),
+      'Queue night': ('Queue', {'QUEUE_NAME': 'night', 'PRIORITY': '30'})}),
+    ('Begin Queue\nPRIORITY = 30\nEnd Queue\nBegin Queue\nPRIORITY = 40\nEnd Queue',
+     {'Queue #1': ('Queue', {'PRIORITY': '30'}), 'Queue #2': ('Queue', {'PRIORITY': '40'})}),
+    # table sections are kept as lines
+    ('Begin Host\nHOST_NAME  MXJ   r1m\nhost1      4     ()    # master\ndefault    !     ()\nEnd Host',
+     {'Host #1': ('Host', ('HOST_NAME MXJ r1m', 'host1 4 ()', 'default ! ()'))}),
+    ('Begin Host\nHOST_NAME MXJ\nhost1 4\nEnd Host\nBegin Host\nHOST_NAME MXJ\nhost2 8\nEnd Host',
+     {'Host #1': ('Host', ('HOST_NAME MXJ', 'host1 4')), 'Host #2': ('Host', ('HOST_NAME MXJ', 'host2 8'))}),
+    ('Begin HostGroup\nGROUP_NAME GROUP_MEMBER\nhg1 (host1 \\\n host2)\nEnd HostGroup',
+     {'HostGroup #1': ('HostGroup', ('GROUP_NAME GROUP_MEMBER', 'hg1 (host1 host2)'))}),
+    # lines out of sections and #INCLUDE lines
+    ('#INCLUDE "/shared/lsb.queues"\nstray line\nBegin Queue\nQUEUE_NAME = q\n#INCLUDE  /shared/q\nEnd Queue',
+     {'#INCLUDE': ('#INCLUDE', ('#INCLUDE "/shared/lsb.queues"',)), '': ('', ('stray line',)),
+      'Queue q': ('Queue', {'QUEUE_NAME': 'q', '#INCLUDE': ('#INCLUDE "/shared/q"',)})}),
+    # an unterminated section is kept
+    ('Begin Queue\nQUEUE_NAME = normal', {'Queue normal': ('Queue', {'QUEUE_NAME': 'normal'})}),
+])
+def test_parse_sections(lsf, text, model):
+    assert lsf.parse_sections(text) == model
+
+
+@pytest.mark.parametrize('old, new, same', [
+    ('Begin Queue\nQUEUE_NAME = normal\nEnd Queue', 'Begin Queue\n   QUEUE_NAME=normal   \nEnd Queue', True),
+    ('Begin Queue\nQUEUE_NAME = normal\nEnd Queue', 'Begin Queue\nQUEUE_NAME = normal # comment\nEnd Queue', True),
+    ('Begin Host\nhost1 4 ()\nEnd Host', 'Begin Host\nhost1   4   ()   # comment\nEnd Host', True),
+    ('Begin Queue\nDESCRIPTION = "a b"\nEnd Queue', 'Begin Queue\nDESCRIPTION = "a  b"\nEnd Queue', False),
+    ('Begin Host\nhost1 4 ()\nEnd Host', 'Begin Host\nhost1 8 ()\nEnd Host', False),
+])
+def test_section_changes(lsf, old, new, same):
+    assert (lsf.changed_sections(lsf.parse_sections(old), lsf.parse_sections(new)) == []) == same
+
+
+@pytest.mark.parametrize('text, window', [
+    ('02:00-04:00', (set(range(7)), 120, 240)),
+    ('sat,sun 00:00-06:00', (set([5, 6]), 0, 360)),
+    ('mon-fri 22:00-02:00', (set([0, 1, 2, 3, 4]), 1320, 120)),
+    ('fri-mon 1:30-2:00', (set([4, 5, 6, 0]), 90, 120)),
+    ('SAT 00:00-24:00', (set([5]), 0, 1440)),
+    ('wed,mon-tue 03:00-03:30', (set([0, 1, 2]), 180, 210)),
+])
+def test_parse_window(lsf, text, window):
+    assert lsf.parse_window(text) == window
+
+
+@pytest.mark.parametrize('text', [
+    '', 'funday 01:00-02:00', 'mon-xyz 01:00-02:00', 'mon tue 01:00-02:00',
+    '01:00', '1-2', '25:00-26:00', '01:60-02:00', '22:00-24:30', '24:00-02:00',
+])
+def test_parse_window_errors(lsf, text):
+    with pytest.raises(ValueError):
+        lsf.parse_window(text)
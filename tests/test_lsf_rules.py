@@ -0,0 +1,42 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def rules(lsf):
+    return lsf.OperationRules(lsf.default_rules(), 'cluster1')
+
+
+@pytest.mark.parametrize('path, rule_path, host', [
+    ('lsf.conf', 'lsf.conf', None),
+    ('conf/lsf.conf', 'lsf.conf', None),
+    ('lsf.conf.host1', 'lsf.conf.{host}', 'host1'),
+    ('lsf.conf.host-1.example.com', 'lsf.conf.{host}', 'host-1.example.com'),
+    ('lsf.conf.node_01', 'lsf.conf.{host}', 'node_01'),
+    ('lsf.cluster.cluster1', 'lsf.cluster.{cluster}', None),
+    ('lsbatch/cluster1/configdir/lsb.queues', ['lsb.queues', 'lsb.queues.*'], None),
+    ('lsb.queues.common', ['lsb.queues', 'lsb.queues.*'], None),
+])
+def test_match(lsf, rules, path, rule_path, host):
+    rule = rules.match(path)
+    index = [item['path'] for item in lsf.default_rules()['rules']].index(rule_path)
+    assert rule == dict(rules.rules[index], host=host)
+
+
+@pytest.mark.parametrize('path', [
+    'lsf.conf.bak', 'lsf.conf.orig', 'lsf.conf.rpmsave', 'lsf.conf.rpmnew', 'lsf.conf.host1.bak',
+    'lsf.conf.host1.dpkg-old', 'lsf.conf.host1~', 'lsf.conf.#host1#', 'lsf.conf.', 'lsf.cluster.cluster2',
+    'README.md',
+])
+def test_no_match(rules, path):
+    assert rules.match(path) is None
+
+
+def test_first_rule_wins(lsf):
+    rules = lsf.OperationRules({'rules': [
+        {'path': 'hosts/{host}/lsf.conf', 'operations': ['sbd-restart']},
+        {'path': '**/lsf.conf', 'operations': ['lim-reconfig']},
+        {'path': 'lsf.conf', 'operations': ['mbd-restart']},
+    ]})
+    assert rules.match('hosts/host1/lsf.conf') == dict(rules.rules[0], host='host1')
+    assert rules.match('conf/lsf.conf') == dict(rules.rules[1], host=None)
+    assert rules.match('lsf.conf') == dict(rules.rules[2], host=None)
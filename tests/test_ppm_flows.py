@@ -0,0 +1,100 @@
+import os
+import argparse
+
+import pytest
+
+from conftest import git, clone, commit_files
+
+
+def flow_xml(name, command='sleep 1'):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<!-- flow %s -->\n<JobFlowReq MainEntry="%s">\n'
+            '<JobDef ExecutionType="lsf" Name="%s:J1">\n  <JobCmdLine Value="%s"/>\n</JobDef>\n</JobFlowReq>\n'
+            % (name, name, name, command))
+
+
+def flow_files(names):
+    return dict(('workflow/%s/%s.xml' % (name, name), flow_xml(name)) for name in names)
+
+
+def submitted(name):
+    return ['jsub -r workflow/%s/%s.xml' % (name, name), 'jrelease %s' % name, 'jtrigger %s' % name]
+
+
+def ppm_args(path):
+    return argparse.Namespace(repo=None, path=path, operation='trigger', parallel=2, retries=0, backoff=0,
+                              state_file=None)
+
+
+@pytest.fixture
+def flows_repo(repo, stubs, monkeypatch):
+    # init_submit changes to the repository, monkeypatch changes back
+    monkeypatch.chdir(repo)
+    monkeypatch.setenv('PATH', stubs.env['PATH'])
+    commit_files(repo, flow_files(['flow1', 'flow2']), 'flows')
+    return repo
+
+
+def test_restart_without_changes(ppm, flows_repo, stubs):
+    ppm.init_submit(ppm_args(flows_repo))
+    assert sorted(stubs.calls()) == sorted(submitted('flow1') + submitted('flow2'))
+
+    # the flows submitted before the restart are not submitted again
+    ppm.init_submit(ppm_args(flows_repo))
+    assert stubs.calls() == []
+
+
+def test_restart_with_changes(ppm, flows_repo, stubs):
+    ppm.init_submit(ppm_args(flows_repo))
+    stubs.calls()
+
+    # comments and formatting do not change a flow
+    with open(os.path.join(flows_repo, 'workflow/flow1/flow1.xml'), 'w') as f:
+        f.write(flow_xml('flow1').replace('<!-- flow flow1 -->', '<!-- edited -->').replace('  <', '<'))
+    ppm.init_submit(ppm_args(flows_repo))
+    assert stubs.calls() == []
+
+    with open(os.path.join(flows_repo, 'workflow/flow2/flow2.xml'), 'w') as f:
+        f.write(flow_xml('flow2', 'sleep 2'))
+    ppm.init_submit(ppm_args(flows_repo))
+    assert stubs.calls() == submitted('flow2')
+
+
+def test_failed_submission_retried_on_restart(ppm, flows_repo, stubs):
+    stubs.fail('jsub')
+    ppm.init_submit(ppm_args(flows_repo))
+    assert sorted(stubs.calls()) == ['jsub -r workflow/flow1/flow1.xml', 'jsub -r workflow/flow2/flow2.xml']
+
+    stubs.fail('jsub', False)
+    ppm.init_submit(ppm_args(flows_repo))
+    assert sorted(stubs.calls()) == sorted(submitted('flow1') + submitted('flow2'))
+
+
+def test_removed_flow_forgotten(ppm, flows_repo, stubs):
+    ppm.init_submit(ppm_args(flows_repo))
+    stubs.calls()
+    git(flows_repo, 'rm', '-q', '-r', 'workflow/flow2')
+    ppm.init_submit(ppm_args(flows_repo))
+    assert list(ppm.flow_state.flows) == ['workflow/flow1/flow1.xml']
+
+    # a flow added back is submitted again
+    git(flows_repo, 'checkout', '-q', 'HEAD', '--', 'workflow/flow2')
+    ppm.init_submit(ppm_args(flows_repo))
+    assert stubs.calls() == submitted('flow2')
+
+
+def test_pulled_flow_submitted(ppm, upstream, stubs, tmp_path, monkeypatch):
+    bare, pusher = upstream
+    commit_files(pusher, flow_files(['flow1', 'flow2']), 'flows')
+    git(pusher, 'push', '-q', 'origin', 'master')
+    work = clone(bare, str(tmp_path / 'work'))
+    monkeypatch.chdir(work)
+    monkeypatch.setenv('PATH', stubs.env['PATH'])
+    ppm.init_submit(ppm_args(work))
+    stubs.calls()
+
+    assert ppm.git_manager(ppm_args(work)) is False
+    commit_files(pusher, {'workflow/flow1/flow1.xml': flow_xml('flow1', 'sleep 3')})
+    git(pusher, 'push', '-q', 'origin', 'master')
+    assert ppm.git_manager(ppm_args(work)) is True
+    assert stubs.calls() == submitted('flow1')
+    assert ppm.flow_state.flows['workflow/flow1/flow1.xml']['commit'] == git(work, 'rev-parse', 'HEAD')